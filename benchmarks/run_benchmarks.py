@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This Source Code Form is subject to the terms of the
+# Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+# with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Times pcap2yaml, yaml2pcap and every process flag on a synthetic capture. Every run is a process of
+# its own, so the peak RSS is measured per command and includes the interpreter start. The best time of
+# the repeats is kept. Results are saved as JSON and can be compared with the results of another commit.
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from synthetic_capture import CaptureGenerator, DEFAULT_MIX, DEFAULT_PAYLOAD_SIZES, parse_mix, parse_sizes
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROCESS_FLAGS = [
+    ('copy', []),
+    ('clean-mac', ['--clean-mac']),
+    ('move-timeline', ['--move-timeline', '2021-01-01']),
+    ('fix-lengths', ['--fix-lengths']),
+    ('fix-checksums', ['--fix-checksums']),
+    ('incremental-checksums', ['--incremental-checksums']),
+    ('fix-tcp-streams', ['--fix-tcp-streams']),
+]
+
+
+def scenarios(pcapng_file, yaml_file, work_dir):
+    # (name, input file, arguments of wiregr)
+    yield 'pcap2yaml', pcapng_file, ['pcap2yaml', pcapng_file, os.path.join(work_dir, 'out.yaml')]
+    yield 'yaml2pcap', yaml_file, ['yaml2pcap', yaml_file, os.path.join(work_dir, 'out.pcapng')]
+    for ext, input_file in (('pcapng', pcapng_file), ('yaml', yaml_file)):
+        for name, flags in PROCESS_FLAGS:
+            output_file = os.path.join(work_dir, 'out.' + ext)
+            yield 'process {} {}'.format(ext, name), input_file, ['process', input_file, output_file] + flags
+
+
+def run_wiregr(arguments, yaml_backend):
+    # the checkout is measured, not an installed copy
+    env = dict(os.environ)
+    env['PYTHONPATH'] = ROOT_DIR + os.pathsep + env.get('PYTHONPATH', '')
+    command = [sys.executable, '-c', 'import wiregr; wiregr.main()', '--yaml-backend', yaml_backend] + arguments
+
+    start = time.perf_counter()
+    process = subprocess.Popen(command, env=env)
+    if hasattr(os, 'wait4'):
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        # kilobytes on linux, bytes on macos
+        peak_rss = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    else:
+        process.wait()
+        peak_rss = None
+    seconds = time.perf_counter() - start
+
+    if process.returncode != 0:
+        raise RuntimeError('{} failed with {}'.format(' '.join(arguments), process.returncode))
+    return seconds, peak_rss
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args, work_dir):
+    pcapng_file = os.path.join(work_dir, 'capture.pcapng')
+    yaml_file = os.path.join(work_dir, 'capture.yaml')
+    with open(pcapng_file, 'wb') as stream:
+        CaptureGenerator(args.mix, args.payload_sizes, args.seed).write(stream, args.packets)
+    run_wiregr(['pcap2yaml', pcapng_file, yaml_file], args.yaml_backend)
+
+    report = {
+        'commit': git_commit(),
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'yaml_backend': args.yaml_backend,
+        'capture': {
+            'packets': args.packets,
+            'mix': args.mix,
+            'payload_sizes': list(args.payload_sizes),
+            'seed': args.seed,
+            'pcapng_bytes': os.path.getsize(pcapng_file),
+            'yaml_bytes': os.path.getsize(yaml_file),
+        },
+        'results': {},
+    }
+
+    print('{:40} {:>9} {:>12} {:>9} {:>9}'.format('scenario', 'seconds', 'packets/s', 'MB/s', 'RSS MB'))
+    for name, input_file, arguments in scenarios(pcapng_file, yaml_file, work_dir):
+        if args.only is not None and not any(x in name for x in args.only):
+            continue
+
+        runs = [run_wiregr(arguments, args.yaml_backend) for _ in range(args.repeat)]
+        seconds = min(x[0] for x in runs)
+        peak_rss = None if runs[0][1] is None else max(x[1] for x in runs)
+        result = {
+            'command': ['wiregr'] + [os.path.basename(x) if x.startswith(work_dir) else x for x in arguments],
+            'seconds': seconds,
+            'packets_per_second': args.packets / seconds,
+            'mb_per_second': os.path.getsize(input_file) / seconds / 1e6,
+            'peak_rss_mb': None if peak_rss is None else peak_rss / 1e6,
+        }
+        report['results'][name] = result
+        print('{:40} {:9.3f} {:12.0f} {:9.2f} {:>9}'.format(
+            name, seconds, result['packets_per_second'], result['mb_per_second'],
+            '-' if peak_rss is None else '{:.1f}'.format(result['peak_rss_mb'])))
+
+    return report
+
+
+def compare(report, baseline, max_regression):
+    # packets/s of the scenarios run by both, negative changes are slowdowns
+    print()
+    print('{:40} {:>12} {:>12} {:>8}'.format('scenario', 'baseline', 'current', 'change'))
+    regressions = []
+    for name, result in report['results'].items():
+        if name not in baseline['results']:
+            continue
+        old = baseline['results'][name]['packets_per_second']
+        new = result['packets_per_second']
+        change = 100 * (new / old - 1)
+        print('{:40} {:12.0f} {:12.0f} {:+7.1f}%'.format(name, old, new, change))
+        if max_regression is not None and change < -max_regression:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark wiregr commands on a synthetic capture.')
+    parser.add_argument('--packets', type=int, default=50000, help='number of packets of the capture')
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help='weights of the traffic kinds, e.g. rtp=6,tcp=3,other=1')
+    parser.add_argument('--payload-sizes', type=parse_sizes, default=DEFAULT_PAYLOAD_SIZES,
+                        help='payload sizes picked uniformly, e.g. 0,20,160,512,1400')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the capture generator')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of every scenario, the best time is kept')
+    parser.add_argument('--only', action='append', help='run only scenarios containing the text, can be repeated')
+    parser.add_argument('--yaml-backend', choices=['auto', 'c', 'python'], default='auto',
+                        help='yaml backend of all runs')
+    parser.add_argument('--work-dir', help='directory for the capture and outputs, a temporary one by default')
+    parser.add_argument('--output', help='save results as JSON')
+    parser.add_argument('--compare', help='JSON results of another run to compare packets/s with')
+    parser.add_argument('--max-regression', type=float,
+                        help='with --compare, fail when a scenario is slower by more percent')
+    args = parser.parse_args()
+
+    if args.work_dir is not None:
+        os.makedirs(args.work_dir, exist_ok=True)
+        report = run(args, args.work_dir)
+    else:
+        work_dir = tempfile.mkdtemp(prefix='wiregr-bench-')
+        try:
+            report = run(args, work_dir)
+        finally:
+            shutil.rmtree(work_dir)
+
+    if args.output is not None:
+        with open(args.output, 'w') as stream:
+            json.dump(report, stream, indent=2)
+            stream.write('\n')
+
+    if args.compare is not None:
+        with open(args.compare) as stream:
+            regressions = compare(report, json.load(stream), args.max_regression)
+        if regressions:
+            print('slower than allowed:', ', '.join(regressions), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
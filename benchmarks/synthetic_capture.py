@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This Source Code Form is subject to the terms of the
+# Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+# with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Deterministic synthetic pcapng captures for the benchmarks. The packets are built with struct only,
+# not with wiregr, so a bug of the code under test cannot hide in its own input. Lengths and checksums
+# are valid, so --fix-lengths and --fix-checksums keep the packets and --incremental-checksums can be used.
+
+import argparse
+import random
+import struct
+
+DEFAULT_MIX = {'rtp': 6, 'tcp': 3, 'other': 1}
+DEFAULT_PAYLOAD_SIZES = (0, 20, 160, 512, 1400)
+
+# 2020-01-01 00:00:00 in microseconds since the epoch
+START_TIME = 1577836800 * 1000000
+
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_PSH = 0x08
+TCP_ACK = 0x10
+
+CLIENT_MAC = b'\x02\x00\x00\x00\x00\x01'
+SERVER_MAC = b'\x02\x00\x00\x00\x00\x02'
+BROADCAST_MAC = b'\xff' * 6
+
+
+def checksum(data):
+    if len(data) % 2:
+        data += b'\x00'
+    total = sum(struct.unpack('>{}H'.format(len(data) // 2), data))
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+
+def ethernet(destination, source, ether_type, payload):
+    return destination + source + struct.pack('>H', ether_type) + payload
+
+
+def ipv4(source, destination, protocol, identification, payload):
+    header = struct.pack('>BBHHHBBH4s4s', 0x45, 0, 20 + len(payload), identification, 0x4000, 64,
+                         protocol, 0, source, destination)
+    return header[:10] + struct.pack('>H', checksum(header)) + header[12:] + payload
+
+
+def transport_checksum(source, destination, protocol, segment):
+    return checksum(struct.pack('>4s4sBBH', source, destination, 0, protocol, len(segment)) + segment)
+
+
+def udp(source, destination, source_port, destination_port, payload):
+    segment = struct.pack('>HHHH', source_port, destination_port, 8 + len(payload), 0) + payload
+    value = transport_checksum(source, destination, 17, segment) or 0xffff
+    return segment[:6] + struct.pack('>H', value) + segment[8:]
+
+
+def tcp(source, destination, source_port, destination_port, seq_num, ack_num, flags, options, payload):
+    header_length = 5 + len(options) // 4
+    segment = struct.pack('>HHLLHHHH', source_port, destination_port, seq_num, ack_num,
+                          header_length << 12 | flags, 502, 0, 0) + options + payload
+    value = transport_checksum(source, destination, 6, segment)
+    return segment[:16] + struct.pack('>H', value) + segment[18:]
+
+
+def tcp_options(syn, tsval, tsecr):
+    timestamps = struct.pack('>BBLL', 8, 10, tsval, tsecr)
+    if syn:
+        # max_segment_size, sack_permitted, timestamps, nop, window_scale
+        return struct.pack('>BBH', 2, 4, 1460) + b'\x04\x02' + timestamps + b'\x01' + struct.pack('>BBB', 3, 3, 7)
+    return b'\x01\x01' + timestamps
+
+
+class RtpFlow:
+
+    def __init__(self, rng, number):
+        self.source = bytes([10, 0, 1, number % 250 + 1])
+        self.destination = bytes([10, 0, 2, number % 250 + 1])
+        self.source_port = 20000 + 2 * number
+        self.destination_port = 5004
+        self.ssrc = rng.getrandbits(32)
+        self.seq_num = rng.getrandbits(16)
+        self.timestamp = rng.getrandbits(32)
+
+    def packet(self, generator, payload):
+        rtp = struct.pack('>BBHLL', 0x80, 0, self.seq_num, self.timestamp, self.ssrc) + payload
+        self.seq_num = (self.seq_num + 1) & 0xffff
+        self.timestamp = (self.timestamp + 160) & 0xffffffff
+        segment = udp(self.source, self.destination, self.source_port, self.destination_port, rtp)
+        return ethernet(SERVER_MAC, CLIENT_MAC, 0x0800,
+                        ipv4(self.source, self.destination, 17, generator.identification(), segment))
+
+
+class TcpFlow:
+
+    # handshake, data segments in both directions and a teardown, then the flow is replaced by a new one
+
+    def __init__(self, rng, number):
+        self.rng = rng
+        self.client = bytes([192, 168, 0, number % 250 + 1])
+        self.server = bytes([192, 168, 1, 1])
+        self.client_port = 40000 + number % 20000
+        self.server_port = 3306
+        self.seq_nums = [rng.getrandbits(32), rng.getrandbits(32)]
+        self.segments = rng.randint(20, 200)
+        self.state = 0
+
+    @property
+    def closed(self):
+        return self.state > self.segments + 5
+
+    def packet(self, generator, payload):
+        state = self.state
+        self.state += 1
+        if state == 0:
+            return self.__segment(generator, 0, TCP_SYN, b'', True)
+        if state == 1:
+            return self.__segment(generator, 1, TCP_SYN | TCP_ACK, b'', True)
+        if state == 2:
+            return self.__segment(generator, 0, TCP_ACK, b'', False)
+        if state < self.segments + 3:
+            return self.__segment(generator, self.rng.getrandbits(1), TCP_PSH | TCP_ACK, payload, False)
+        if state < self.segments + 5:
+            return self.__segment(generator, state - self.segments - 3, TCP_FIN | TCP_ACK, b'', False)
+        return self.__segment(generator, 0, TCP_ACK, b'', False)
+
+    def __segment(self, generator, side, flags, payload, syn):
+        source, destination = (self.client, self.server) if side == 0 else (self.server, self.client)
+        source_port, destination_port = (self.client_port, self.server_port) if side == 0 \
+            else (self.server_port, self.client_port)
+        seq_num = self.seq_nums[side]
+        ack_num = self.seq_nums[1 - side] if flags & TCP_ACK else 0
+        self.seq_nums[side] = (seq_num + len(payload) + (1 if flags & (TCP_SYN | TCP_FIN) else 0)) & 0xffffffff
+
+        tsval = generator.time // 1000 & 0xffffffff
+        segment = tcp(source, destination, source_port, destination_port, seq_num, ack_num, flags,
+                      tcp_options(syn, tsval, (tsval - 1) & 0xffffffff if flags & TCP_ACK else 0), payload)
+        return ethernet(SERVER_MAC if side == 0 else CLIENT_MAC, CLIENT_MAC if side == 0 else SERVER_MAC,
+                        0x0800, ipv4(source, destination, 6, generator.identification(), segment))
+
+
+def other_packet(rng, payload):
+    # arp requests and udp over ipv6, both stay unknown_payload after the ethernet header
+    if rng.getrandbits(1):
+        arp = struct.pack('>HHBBH6s4s6s4s', 1, 0x0800, 6, 4, 1, CLIENT_MAC, bytes([10, 0, 1, 1]),
+                          bytes(6), bytes([10, 0, 1, rng.randint(2, 254)]))
+        return ethernet(BROADCAST_MAC, CLIENT_MAC, 0x0806, arp)
+
+    ipv6 = struct.pack('>LHBB16s16s', 0x60000000, 8 + len(payload), 17, 64,
+                       b'\xfd' + bytes(14) + b'\x01', b'\xfd' + bytes(14) + b'\x02')
+    return ethernet(SERVER_MAC, CLIENT_MAC, 0x86dd, ipv6 + struct.pack('>HHHH', 5353, 5353, 8 + len(payload), 0)
+                    + payload)
+
+
+class CaptureGenerator:
+
+    def __init__(self, mix=None, payload_sizes=DEFAULT_PAYLOAD_SIZES, seed=0, rtp_flows=8, tcp_flows=16):
+        self.rng = random.Random(seed)
+        self.mix = mix if mix is not None else DEFAULT_MIX
+        self.payload_sizes = payload_sizes
+        self.time = START_TIME
+        self.payload_pool = bytes(self.rng.getrandbits(8) for _ in range(max(payload_sizes) + 4096))
+        self.rtp_flows = [RtpFlow(self.rng, x) for x in range(rtp_flows)]
+        self.tcp_flows = [TcpFlow(self.rng, x) for x in range(tcp_flows)]
+        self.flow_count = tcp_flows
+        self.__identification = 0
+
+    def identification(self):
+        self.__identification = (self.__identification + 1) & 0xffff
+        return self.__identification
+
+    def packets(self, count):
+        kinds = list(self.mix)
+        weights = [self.mix[x] for x in kinds]
+        for _ in range(count):
+            self.time += self.rng.randint(1, 2000)
+            kind = self.rng.choices(kinds, weights)[0]
+            size = self.rng.choice(self.payload_sizes)
+            offset = self.rng.randint(0, len(self.payload_pool) - size)
+            payload = self.payload_pool[offset:offset + size]
+
+            if kind == 'rtp':
+                yield self.time, self.rng.choice(self.rtp_flows).packet(self, payload)
+            elif kind == 'tcp':
+                index = self.rng.randrange(len(self.tcp_flows))
+                flow = self.tcp_flows[index]
+                yield self.time, flow.packet(self, payload)
+                if flow.closed:
+                    self.tcp_flows[index] = TcpFlow(self.rng, self.flow_count)
+                    self.flow_count += 1
+            else:
+                yield self.time, other_packet(self.rng, payload)
+
+    def write(self, stream, count):
+        stream.write(struct.pack('<LLLHHqL', 0x0A0D0D0A, 28, 0x1A2B3C4D, 1, 0, -1, 28))
+        stream.write(struct.pack('<LLHHLL', 1, 20, 1, 0, 65535, 20))
+        for timestamp, data in self.packets(count):
+            padding = -len(data) % 4
+            length = 32 + len(data) + padding
+            stream.write(struct.pack('<LLLLLLL', 6, length, 0, timestamp >> 32, timestamp & 0xffffffff,
+                                     len(data), len(data)))
+            stream.write(data + bytes(padding) + struct.pack('<L', length))
+
+
+def parse_mix(value):
+    mix = {}
+    for item in value.split(','):
+        kind, _, weight = item.partition('=')
+        if kind not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError('unknown traffic kind {}'.format(kind))
+        mix[kind] = float(weight)
+    return mix
+
+
+def parse_sizes(value):
+    return tuple(int(x) for x in value.split(','))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a deterministic synthetic pcapng capture.')
+    parser.add_argument('output_file', help='output pcapng file')
+    parser.add_argument('--packets', type=int, default=100000, help='number of packets')
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help='weights of the traffic kinds, e.g. rtp=6,tcp=3,other=1')
+    parser.add_argument('--payload-sizes', type=parse_sizes, default=DEFAULT_PAYLOAD_SIZES,
+                        help='payload sizes picked uniformly, e.g. 0,20,160,512,1400')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the generator')
+    args = parser.parse_args()
+
+    with open(args.output_file, 'wb') as stream:
+        CaptureGenerator(args.mix, args.payload_sizes, args.seed).write(stream, args.packets)
+
+
+if __name__ == "__main__":
+    main()
@@ -32,6 +32,10 @@ setup(
 
     packages=find_packages(),
     install_requires = ['pyyaml', 'python-dateutil'],
+    extras_require = {
+        'numpy': ['numpy'],
+        'zstd': ['zstandard'],
+    },
 
     entry_points={
         'console_scripts': [
@@ -1,16 +1,58 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import bz2
+import copy
+import datetime
 import filecmp
+import gzip
+import io
+import lzma
 import shutil
+import subprocess
 import tempfile
 import os
+import pickle
 import sys
 
 import unittest
 import unittest.mock as mock
+import yaml
 
 import wiregr
+import wiregr.block_index
+import wiregr.common
+import wiregr.compression
+import wiregr.pcap_reader
+import wiregr.yaml_processor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'benchmarks'))
+import synthetic_capture
+
+class PipeStream(io.RawIOBase):
+
+    # non-seekable stream handing out data in small pieces, like a capture piped from tcpdump
+
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), len(self.data) - self.offset, 100)
+        buffer[:size] = self.data[self.offset:self.offset + size]
+        self.offset += size
+        return size
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.data += bytes(data)
+        return len(data)
+
 
 class TestBasicScenarios(unittest.TestCase):
 
@@ -40,6 +82,13 @@ class TestBasicScenarios(unittest.TestCase):
                         'output and ref file are not equal')
 
 
+    def run_from_pipe_and_check(self, argv):
+        with open(self.input_file, 'rb') as stream:
+            stdin = io.TextIOWrapper(io.BufferedReader(PipeStream(stream.read())))
+        with mock.patch.object(sys, 'stdin', stdin):
+            self.run_and_check(argv)
+
+
     def test_pcap2yaml_rtp(self):
         self.configure_files('rtp_sample.pcapng', 'rtp_sample.yaml')
         self.run_and_check(['wiregr', 'pcap2yaml', self.input_file, self.output_file])
@@ -50,6 +99,23 @@ class TestBasicScenarios(unittest.TestCase):
         self.run_and_check(['wiregr', 'pcap2yaml', self.copied_file])
 
 
+    def test_pcap2yaml_rtp_mmap(self):
+        self.configure_files('rtp_sample.pcapng', 'rtp_sample.yaml')
+        self.run_and_check(['wiregr', 'pcap2yaml', self.input_file, self.output_file, '--mmap'])
+
+
+    def test_pcap2yaml_rtp_jobs(self):
+        self.configure_files('rtp_sample.pcapng', 'rtp_sample.yaml')
+        self.run_and_check(['wiregr', 'pcap2yaml', self.input_file, self.output_file, '--jobs', '2'])
+
+
+    def test_pcap2yaml_rtp_jobs_block_chunks(self):
+        # every block is a chunk of its own, so every packet is converted with the replayed context
+        self.configure_files('rtp_sample.pcapng', 'rtp_sample.yaml')
+        with mock.patch.object(wiregr.pcap_reader, 'JOBS_CHUNK_SIZE', 1):
+            self.run_and_check(['wiregr', 'pcap2yaml', self.input_file, self.output_file, '--jobs', '3'])
+
+
     def test_yaml2pcap_rtp(self):
         self.configure_files('rtp_sample.yaml', 'rtp_sample.pcapng')
         self.run_and_check(['wiregr', 'yaml2pcap', self.input_file, self.output_file])
@@ -90,6 +156,11 @@ class TestBasicScenarios(unittest.TestCase):
         self.run_and_check(['wiregr', 'pcap2yaml', self.input_file, self.output_file])
 
 
+    def test_pcap2yaml_rtsp_mmap(self):
+        self.configure_files('rtsp_sample.pcapng', 'rtsp_sample.yaml')
+        self.run_and_check(['wiregr', 'pcap2yaml', self.input_file, self.output_file, '--mmap'])
+
+
     def test_yaml2pcap_mixed_payload_mysql(self):
         self.configure_files('mysql_sample.yaml', 'mysql_sample.pcapng')
         self.run_and_check(['wiregr', 'yaml2pcap', self.input_file, self.output_file])
@@ -125,6 +196,32 @@ class TestBasicScenarios(unittest.TestCase):
         self.run_and_check(['wiregr', 'process', self.input_file, self.output_file, '--fix-tcp-streams'])
 
 
+    def test_yaml_process_fix_stream_incremental_checksums_mysql(self):
+        self.configure_files('mysql_sample_start_seq.yaml', 'mysql_sample_start.yaml')
+        self.run_and_check(['wiregr', 'process', self.input_file, self.output_file,
+                            '--fix-tcp-streams', '--incremental-checksums'])
+
+
+    def test_yaml_process_fix_stream_incremental_checksums_mysql_jobs(self):
+        self.configure_files('mysql_sample_start_seq.yaml', 'mysql_sample_start.yaml')
+        self.run_and_check(['wiregr', 'process', self.input_file, self.output_file,
+                            '--fix-tcp-streams', '--incremental-checksums', '--jobs', '2'])
+
+
+    def test_yaml_process_fix_stream_mysql_jobs_rounds(self):
+        # a round of two blocks, so the stream state has to survive between rounds in the workers
+        self.configure_files('mysql_sample_start.yaml', 'mysql_sample_start.yaml')
+        with mock.patch.object(wiregr.yaml_processor.YamlProcessor, 'SHARD_ROUND_SIZE', 2):
+            self.run_and_check(['wiregr', 'process', self.input_file, self.output_file,
+                                '--fix-tcp-streams', '--jobs', '3'])
+
+
+    def test_pcap_process_move_timeline_mysql_jobs(self):
+        self.configure_files('mysql_sample.pcapng', 'mysql_sample.pcapng')
+        self.run_and_check(['wiregr', 'process', self.input_file, self.output_file,
+                            '--move-timeline', '2008-07-17 07:50:48.287657', '--jobs', '2'])
+
+
     def test_yaml_process_mixed_payload_mysql(self):
         self.configure_files('mysql_sample.yaml', 'mysql_sample.yaml')
         self.run_and_check(['wiregr', 'process', self.input_file, self.output_file, '--fix-lengths', '--fix-checksums'])
@@ -140,5 +237,492 @@ class TestBasicScenarios(unittest.TestCase):
         self.run_and_check(['wiregr', 'process', self.input_file, self.output_file, '--move-timeline', '2018-01-01'])
 
 
+    def test_pcap2yaml_rtsp_python_backend(self):
+        self.configure_files('rtsp_sample.pcapng', 'rtsp_sample.yaml')
+        self.run_and_check(['wiregr', '--yaml-backend', 'python', 'pcap2yaml', self.input_file, self.output_file])
+
+
+    def test_yaml2pcap_mixed_payload_mysql_python_backend(self):
+        self.configure_files('mysql_sample.yaml', 'mysql_sample.pcapng')
+        self.run_and_check(['wiregr', '--yaml-backend', 'python', 'yaml2pcap', self.input_file, self.output_file])
+
+
+    def test_yaml_process_mixed_payload_mysql_python_backend(self):
+        self.configure_files('mysql_sample.yaml', 'mysql_sample.yaml')
+        self.run_and_check(['wiregr', '--yaml-backend', 'python', 'process', self.input_file, self.output_file,
+                            '--fix-lengths', '--fix-checksums'])
+
+
+    def test_pcap2yaml_options(self):
+        self.configure_files('options_sample.pcapng', 'options_sample.yaml')
+        self.run_and_check(['wiregr', 'pcap2yaml', self.input_file, self.output_file])
+
+
+    def test_yaml2pcap_options(self):
+        self.configure_files('options_sample.yaml', 'options_sample.pcapng')
+        self.run_and_check(['wiregr', 'yaml2pcap', self.input_file, self.output_file])
+
+
+    def test_yaml_process_options(self):
+        self.configure_files('options_sample.yaml', 'options_sample.yaml')
+        self.run_and_check(['wiregr', 'process', self.input_file, self.output_file, '--fix-lengths', '--fix-checksums'])
+
+
+    def test_pcap2yaml_rtsp_from_pipe(self):
+        self.configure_files('rtsp_sample.pcapng', 'rtsp_sample.yaml')
+        self.run_from_pipe_and_check(['wiregr', 'pcap2yaml', '-', self.output_file])
+
+
+    def test_pcap_process_move_timeline_mysql_from_pipe(self):
+        self.configure_files('mysql_sample.pcapng', 'mysql_sample.pcapng')
+        self.run_from_pipe_and_check(['wiregr', 'process', '-', self.output_file,
+                                      '--move-timeline', '2008-07-17 07:50:48.287657', '--jobs', '2'])
+
+
+    def test_yaml_process_mysql_from_pipe(self):
+        self.configure_files('mysql_sample.yaml', 'mysql_sample.yaml')
+        self.run_from_pipe_and_check(['wiregr', 'process', '-', self.output_file, '--fix-lengths', '--fix-checksums'])
+
+
+    def test_yaml2pcap_options_to_pipe(self):
+        self.configure_files('options_sample.yaml', 'options_sample.pcapng')
+        stdout = io.TextIOWrapper(io.BufferedWriter(PipeStream(b'')))
+        with mock.patch.object(sys, 'stdout', stdout), \
+             mock.patch.object(sys, 'argv', ['wiregr', 'yaml2pcap', self.input_file, '-']):
+            wiregr.main()
+        with open(self.ref_file, 'rb') as stream:
+            self.assertEqual(stdout.buffer.raw.data, stream.read())
+
+
+    def test_binary_blocks_pipeline_rtsp(self):
+        self.configure_files('rtsp_sample.pcapng', 'rtsp_sample.pcapng')
+        binary_file = os.path.join(self.test_dir, 'rtsp_sample.wgb')
+        with mock.patch.object(sys, 'argv', ['wiregr', 'pcap2yaml', self.input_file, binary_file]):
+            wiregr.main()
+        with open(binary_file, 'rb') as stream:
+            self.assertEqual(stream.read(8), wiregr.common.BINARY_BLOCKS_MAGIC)
+        self.run_and_check(['wiregr', 'yaml2pcap', binary_file, self.output_file])
+
+
+    def test_binary_blocks_round_trip_yaml(self):
+        for name in ('mysql_sample.yaml', 'rtsp_sample_hexdump.yaml', 'options_sample.yaml', 'nanosecond_sample.yaml',
+                     'timezone_sample.yaml'):
+            self.configure_files(name, name)
+            binary_file = os.path.join(self.test_dir, 'blocks.bin')
+            with mock.patch.object(sys, 'argv', ['wiregr', 'process', self.input_file, binary_file,
+                                                 '--output-format', 'binary']):
+                wiregr.main()
+            self.run_and_check(['wiregr', 'process', binary_file, self.output_file, '--output-format', 'yaml'])
+
+
+    def compress_file(self, source, target, codec):
+        with open(source, 'rb') as input_stream, codec.open(target, 'wb') as output_stream:
+            output_stream.write(input_stream.read())
+
+
+    def test_binary_blocks_values(self):
+        import wiregr.binary_blocks
+        record = self.read_blocks(os.path.join(self.data_dir, 'rtp_sample.pcapng'))[2]['udp_data']
+        for number in range(300):
+            record['extra_{}'.format(number)] = number
+        info = {'record': record, 'timestamps': [wiregr.common.Timestamp(-1, (10, 9)),
+                                                 wiregr.common.Timestamp(1 << 64, (10, 12))]}
+
+        stream = io.BytesIO()
+        wiregr.binary_blocks.BinaryBlockWriter(stream).write(info)
+        stream.seek(0)
+        copied = wiregr.binary_blocks.BinaryBlockReader(stream).read_block()
+        self.assertEqual(copied, info)
+        self.assertEqual(list(copied['record'].items()), list(record.items()))
+
+
+    def test_compressed_input_and_output(self):
+        for command, input_name, input_codec, output_name, output_codec in (
+                ('pcap2yaml', 'rtp_sample.pcapng.gz', gzip, 'rtp_sample.yaml.bz2', bz2),
+                ('yaml2pcap', 'rtsp_sample.yaml.bz2', bz2, 'rtsp_sample.pcapng.xz', lzma),
+                ('process', 'mysql_sample.pcapng.xz', lzma, 'mysql_sample.pcapng.gz', gzip)):
+            self.configure_files(os.path.splitext(input_name)[0], os.path.splitext(output_name)[0])
+            compressed_input = os.path.join(self.test_dir, input_name)
+            compressed_output = os.path.join(self.test_dir, output_name)
+            self.compress_file(self.input_file, compressed_input, input_codec)
+
+            with mock.patch.object(sys, 'argv', ['wiregr', command, compressed_input, compressed_output]):
+                wiregr.main()
+
+            with output_codec.open(compressed_output, 'rb') as stream, open(self.ref_file, 'rb') as ref_stream:
+                self.assertEqual(stream.read(), ref_stream.read())
+
+
+    def test_yaml_process_compressed_shorten_args(self):
+        # the output is compressed like the input and the input is kept as a compressed backup
+        self.configure_files('mysql_sample.yaml', 'mysql_sample.yaml')
+        compressed_file = os.path.join(self.test_dir, 'mysql_sample.yaml.xz')
+        self.compress_file(self.input_file, compressed_file, lzma)
+        with open(compressed_file, 'rb') as stream:
+            compressed_data = stream.read()
+
+        with mock.patch.object(sys, 'argv', ['wiregr', 'process', compressed_file]):
+            wiregr.main()
+
+        with lzma.open(compressed_file, 'rb') as stream, open(self.ref_file, 'rb') as ref_stream:
+            self.assertEqual(stream.read(), ref_stream.read())
+        with open(os.path.join(self.test_dir, 'mysql_sample_bkup.yaml.xz'), 'rb') as stream:
+            self.assertEqual(stream.read(), compressed_data)
+
+
+    def test_pcap2yaml_rtsp_compressed_from_pipe(self):
+        self.configure_files('rtsp_sample.pcapng', 'rtsp_sample.yaml')
+        with open(self.input_file, 'rb') as stream:
+            stdin = io.TextIOWrapper(io.BufferedReader(PipeStream(gzip.compress(stream.read()))))
+        with mock.patch.object(sys, 'stdin', stdin):
+            self.run_and_check(['wiregr', 'pcap2yaml', '-', self.output_file])
+
+
+    def test_synthetic_capture(self):
+        # the benchmark capture is deterministic, round trips and has valid lengths and checksums
+        capture_files = [os.path.join(self.test_dir, name) for name in ('one.pcapng', 'two.pcapng')]
+        for capture_file in capture_files:
+            with open(capture_file, 'wb') as stream:
+                synthetic_capture.CaptureGenerator(seed=1).write(stream, 1000)
+        self.assertTrue(filecmp.cmp(*capture_files, shallow=False))
+
+        yaml_file = os.path.join(self.test_dir, 'one.yaml')
+        self.ref_file = capture_files[0]
+        self.output_file = os.path.join(self.test_dir, 'fixed.pcapng')
+        self.run_and_check(['wiregr', 'process', capture_files[0], self.output_file, '--fix-lengths', '--fix-checksums'])
+        with mock.patch.object(sys, 'argv', ['wiregr', 'pcap2yaml', capture_files[0], yaml_file]):
+            wiregr.main()
+        self.output_file = os.path.join(self.test_dir, 'back.pcapng')
+        self.run_and_check(['wiregr', 'yaml2pcap', yaml_file, self.output_file])
+
+
+    def test_pcap2yaml_nanosecond_timestamps(self):
+        self.configure_files('nanosecond_sample.pcapng', 'nanosecond_sample.yaml')
+        self.run_and_check(['wiregr', 'pcap2yaml', self.input_file, self.output_file])
+
+
+    def test_yaml2pcap_nanosecond_timestamps(self):
+        self.configure_files('nanosecond_sample.yaml', 'nanosecond_sample.pcapng')
+        self.run_and_check(['wiregr', '--yaml-backend', 'python', 'yaml2pcap', self.input_file, self.output_file])
+
+
+    def test_yaml_process_move_timeline_nanosecond_timestamps(self):
+        self.configure_files('nanosecond_sample.yaml', 'nanosecond_sample_2018.yaml')
+        self.run_and_check(['wiregr', 'process', self.input_file, self.output_file, '--move-timeline', '2018-01-01'])
+
+
+    def test_pcap_process_move_timeline_nanosecond_timestamps(self):
+        self.configure_files('nanosecond_sample.pcapng', 'nanosecond_sample_2018.pcapng')
+        self.run_and_check(['wiregr', 'process', self.input_file, self.output_file, '--move-timeline', '2018-01-01'])
+
+
+    def test_pcap2yaml_hex_payload_rtsp(self):
+        self.configure_files('rtsp_sample.pcapng', 'rtsp_sample_hex.yaml')
+        self.run_and_check(['wiregr', 'pcap2yaml', self.input_file, self.output_file, '--payload-format', 'hex'])
+
+
+    def test_yaml2pcap_hexdump_payload_rtsp(self):
+        self.configure_files('rtsp_sample_hexdump.yaml', 'rtsp_sample.pcapng')
+        self.run_and_check(['wiregr', 'yaml2pcap', self.input_file, self.output_file])
+
+
+    def test_yaml_process_hex_payload_rtsp(self):
+        self.configure_files('rtsp_sample_hexdump.yaml', 'rtsp_sample_hex.yaml')
+        self.run_and_check(['wiregr', 'process', self.input_file, self.output_file, '--payload-format', 'hex',
+                            '--fix-lengths', '--fix-checksums'])
+
+
+    def test_yaml_process_list_payload_rtsp(self):
+        self.configure_files('rtsp_sample_hex.yaml', 'rtsp_sample.yaml')
+        self.run_and_check(['wiregr', 'process', self.input_file, self.output_file, '--payload-format', 'list'])
+
+
+    def test_pcap_process_fix_checksums_rtsp(self):
+        self.configure_files('rtsp_sample.pcapng', 'rtsp_sample.pcapng')
+        self.run_and_check(['wiregr', 'process', self.input_file, self.output_file, '--fix-lengths', '--fix-checksums'])
+
+
+    def test_pcap_process_clean_mac_rtsp(self):
+        self.configure_files('rtsp_sample.pcapng', 'rtsp_sample_zeromac.pcapng')
+        self.run_and_check(['wiregr', 'process', self.input_file, self.output_file, '--clean-mac', '--mmap'])
+
+
+    def test_pcap_process_clean_mac_rtsp_to_yaml(self):
+        self.configure_files('rtsp_sample.pcapng', 'rtsp_sample_zeromac.yaml')
+        self.run_and_check(['wiregr', 'process', self.input_file, self.output_file, '--clean-mac'])
+
+
+    def test_pcap_process_dummy_rtp_shorten_args(self):
+        self.configure_files('rtp_sample.pcapng', 'rtp_sample.pcapng', True)
+        self.run_and_check(['wiregr', 'process', self.copied_file])
+
+
+    def test_pcap_process_move_timeline_mysql_keeps_payload(self):
+        self.configure_files('mysql_sample.pcapng', 'mysql_sample.pcapng')
+        self.run_and_check(['wiregr', 'process', self.input_file, self.output_file,
+                            '--move-timeline', '2008-07-17 07:50:48.287657'])
+
+
+    def test_slice_packets_rtp(self):
+        self.configure_files('rtp_sample.pcapng', 'rtp_sample_slice.pcapng')
+        self.run_and_check(['wiregr', 'slice', self.input_file, self.output_file, '--packets', '1:3'])
+
+
+    def test_slice_time_rtp_yaml(self):
+        self.configure_files('rtp_sample.yaml', 'rtp_sample_slice.yaml')
+        self.run_and_check(['wiregr', 'slice', self.input_file, self.output_file,
+                            '--from', '2005-07-04 09:56:25.418358', '--to', '2005-07-04 09:56:25.427557'])
+
+
+    def test_slice_time_rtp_aware_bounds(self):
+        # aware bounds are compared in utc, the capture times are utc
+        self.configure_files('rtp_sample.yaml', 'rtp_sample_slice.yaml')
+        self.run_and_check(['wiregr', 'slice', self.input_file, self.output_file,
+                            '--from', '2005-07-04T12:56:25.418358+03:00', '--to', '2005-07-04T09:56:25.427557Z'])
+
+
+    def test_slice_packets_rtp_to_yaml(self):
+        self.configure_files('rtp_sample.pcapng', 'rtp_sample_slice.yaml')
+        self.run_and_check(['wiregr', 'slice', self.input_file, self.output_file, '--packets', '1:3'])
+
+
+    def test_pcap2yaml_filter_rtp(self):
+        self.configure_files('rtp_sample.pcapng', 'rtp_sample_filter.yaml')
+        self.run_and_check(['wiregr', 'pcap2yaml', self.input_file, self.output_file,
+                            '--filter', 'udp and dst port 40392 and ip.id >= 0x6bfe'])
+
+
+    def test_yaml_process_filter_rtp(self):
+        self.configure_files('rtp_sample.yaml', 'rtp_sample_filter.yaml')
+        self.run_and_check(['wiregr', 'process', self.input_file, self.output_file,
+                            '--filter', 'udp and dst port 40392 and ip.id >= 0x6bfe'])
+
+
+    def test_slice_filter_rtp(self):
+        self.configure_files('rtp_sample.pcapng', 'rtp_sample_filter.pcapng')
+        self.run_and_check(['wiregr', 'slice', self.input_file, self.output_file,
+                            '--filter', '(udp.port == 40392 || tcp) and not ip.id < 0x6bfe'])
+
+
+    def test_slice_rejects_compressed_input(self):
+        self.configure_files('rtp_sample.pcapng', 'rtp_sample_part.pcapng')
+        compressed_file = os.path.join(self.test_dir, 'rtp_sample.pcapng.gz')
+        self.compress_file(self.input_file, compressed_file, gzip)
+        with mock.patch.object(sys, 'argv', ['wiregr', 'slice', compressed_file, self.output_file, '--packets', '0:2']):
+            with self.assertRaises(ValueError):
+                wiregr.main()
+        self.assertFalse(os.path.exists(self.output_file))
+
+
+    def test_slice_rejects_binary_blocks(self):
+        self.configure_files('rtp_sample.yaml', 'rtp_sample_part.yaml')
+        binary_file = os.path.join(self.test_dir, 'rtp_sample.wgb')
+        with mock.patch.object(sys, 'argv', ['wiregr', 'process', self.input_file, binary_file]):
+            wiregr.main()
+
+        for input_file, output_file in ((binary_file, self.output_file), (self.input_file, os.path.join(self.test_dir, 'part.wgb'))):
+            with mock.patch.object(sys, 'argv', ['wiregr', 'slice', input_file, output_file, '--packets', '0:2']):
+                with self.assertRaises(ValueError):
+                    wiregr.main()
+            self.assertFalse(os.path.exists(output_file))
+
+
+    def read_blocks(self, file_name, index=None, number=None):
+        with open(file_name, 'rb' if file_name.endswith('.pcapng') else 'r') as stream:
+            if file_name.endswith('.pcapng'):
+                reader = wiregr.pcap_reader.PcapBlockReader(wiregr.common.StructReader(stream))
+            else:
+                reader = wiregr.common.YamlReader(stream)
+            if index is None:
+                return list(reader.read())
+            reader.seek_block(index, number)
+            return list(reader.read())
+
+
+    def test_block_index_seek_pcap(self):
+        self.configure_files('rtp_sample.pcapng', 'rtp_sample.yaml', True)
+        blocks = self.read_blocks(self.copied_file)
+        index = wiregr.block_index.load_block_index(self.copied_file)
+
+        self.assertTrue(os.path.exists(self.copied_file + '.idx'))
+        self.assertEqual(self.read_blocks(self.copied_file, index, 3), blocks[3:])
+        self.assertEqual(self.read_blocks(self.copied_file, index, index.find_time(blocks[4]['datetime'])), blocks[4:])
+        self.assertEqual(self.read_blocks(self.copied_file, index, len(blocks)), [])
+
+
+    def test_block_index_rebuild_yaml(self):
+        self.configure_files('rtp_sample.yaml', 'rtp_sample.yaml', True)
+        index = wiregr.block_index.load_block_index(self.copied_file)
+        self.assertEqual(self.read_blocks(self.copied_file, index, 5), self.read_blocks(self.copied_file)[5:])
+
+        with open(self.copied_file, 'a') as stream:
+            stream.write('\nblock_type: 0x5\ninterface_id: 0\ndatetime: 2030-01-01 00:00:00\n')
+        index = wiregr.block_index.load_block_index(self.copied_file)
+        self.assertEqual(len(index), 8)
+        self.assertEqual(self.read_blocks(self.copied_file, index, 7), self.read_blocks(self.copied_file)[7:])
+
+
+    def test_yaml_load_zoned_timestamps_with_long_fraction(self):
+        # only a fraction ending the timestamp is kept as ticks, zoned ones load as datetime like before
+        utc = datetime.timezone.utc
+        for loader, _ in wiregr.common.YAML_BACKENDS.values():
+            for text, value in (
+                    ('a: 2018-01-01 00:00:00.1234567+03:00',
+                     datetime.datetime(2017, 12, 31, 21, 0, 0, 123456, tzinfo=utc)),
+                    ('a: 2018-01-01T00:00:00.1234567Z', datetime.datetime(2018, 1, 1, 0, 0, 0, 123456, tzinfo=utc)),
+                    ('a: 2018-01-01 00:00:00.1234567', wiregr.common.Timestamp(15147648001234567, (10, 7)))):
+                self.assertEqual(yaml.load(text, Loader=loader)['a'], value)
+
+
+    def test_timestamp_compares_with_datetime(self):
+        value = datetime.datetime(1970, 1, 1, 0, 0, 0, 1)
+        for timestamp in (wiregr.common.Timestamp(1), wiregr.common.Timestamp(1000, (10, 9))):
+            self.assertTrue(timestamp == value and value == timestamp and timestamp <= value <= timestamp)
+            self.assertEqual(hash(timestamp), hash(value))
+        later = wiregr.common.Timestamp(1001, (10, 9))
+        self.assertTrue(later != value and later > value and not later <= value)
+        self.assertNotEqual(wiregr.common.Timestamp(1), value.replace(tzinfo=datetime.timezone.utc))
+
+
+    def test_yaml_reader_seek_by_byte_offsets(self):
+        # offsets count bytes, so they hold after multi-byte characters, compressed input cannot seek
+        first, second = 'comment: \u00fcber caf\u00e9\n\n', 'block_type: 0x5\ninterface_id: 0\n'
+        yaml_file = os.path.join(self.test_dir, 'blocks.yaml')
+        with open(yaml_file, 'w', encoding='utf-8') as stream:
+            stream.write(first + second)
+
+        with open(yaml_file, encoding='utf-8') as stream:
+            reader = wiregr.common.YamlReader(stream)
+            self.assertEqual(reader.read_block()['comment'], '\u00fcber caf\u00e9')
+            for _ in range(2):
+                reader.seek(len(first.encode('utf-8')))
+                self.assertEqual(reader.read_block()['interface_id'], 0)
+
+        self.compress_file(yaml_file, yaml_file + '.gz', gzip)
+        with wiregr.compression.open_input(yaml_file + '.gz', False, wiregr.common.BUFFER_SIZE) as stream:
+            with self.assertRaises(io.UnsupportedOperation):
+                wiregr.common.YamlReader(stream).seek(len(first.encode('utf-8')))
+
+
+    def test_header_records_as_mappings(self):
+        pcap_blocks = self.read_blocks(os.path.join(self.data_dir, 'mysql_sample.pcapng'))
+        yaml_blocks = self.read_blocks(os.path.join(self.data_dir, 'mysql_sample.yaml'))
+        tcp_data = next(x['tcp_data'] for x in pcap_blocks if 'options' in x.get('tcp_data', ()))
+        self.assertIsInstance(tcp_data, wiregr.common.HeaderRecord)
+        self.assertIn(tcp_data.to_dict(), [x.get('tcp_data') for x in yaml_blocks])
+        self.assertEqual(list(tcp_data)[-1], 'options')
+
+        copied = pickle.loads(pickle.dumps(tcp_data))
+        self.assertEqual(copied, tcp_data)
+        copied['window_size'] = 1
+        copied['extra'] = 2
+        del copied['options']
+        self.assertEqual((copied['window_size'], copied.get('extra'), 'options' in copied), (1, 2, False))
+        self.assertNotEqual(copied, tcp_data)
+        with self.assertRaises(KeyError):
+            copied['options']
+
+        ipv4_data = pcap_blocks[2]['ipv4_data']
+        self.assertEqual(list(ipv4_data['source']), yaml_blocks[2]['ipv4_data']['source'])
+
+        # a fresh interpreter has not compiled the headers before unpickling
+        root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        loaded = subprocess.run(
+            [sys.executable, '-c', 'import pickle, sys; print(dict(pickle.loads(sys.stdin.buffer.read())))'],
+            input=pickle.dumps(ipv4_data), stdout=subprocess.PIPE, check=True,
+            env=dict(os.environ, PYTHONPATH=root_dir))
+        self.assertEqual(loaded.stdout.decode().strip(), str(dict(ipv4_data)))
+
+
+    def test_fix_tcp_streams_flow_eviction(self):
+        blocks = self.read_blocks(os.path.join(self.data_dir, 'mysql_sample_start.yaml'))
+        packets = [x for x in blocks if 'tcp_data' in x]
+        # the server response grows by 5 bytes, later server packets are moved by it
+        packets[3]['ipv4_data']['total_length'] += 5
+        client, server = packets[4], packets[6]
+
+        def send(processor, packet, flags):
+            packet = copy.deepcopy(packet)
+            packet['tcp_data']['flags'] = flags
+            processor.process(packet)
+            return packet['tcp_data']['seq_num']
+
+        processor = wiregr.yaml_processor.FixTcpStreams()
+        for info in copy.deepcopy(blocks):
+            processor.process(info)
+        self.assertEqual(processor.flows.stats(),
+                         {'active': 1, 'closed': 0, 'evicted': 0, 'expired': 0, 'reused': 0})
+
+        # a duplicate reset of a closed flow is still moved like the first one
+        reset = send(processor, server, 0x014)
+        self.assertEqual(reset, server['tcp_data']['seq_num'] + 5)
+        self.assertEqual(processor.flows.stats(),
+                         {'active': 0, 'closed': 1, 'evicted': 0, 'expired': 0, 'reused': 0})
+        self.assertEqual(send(processor, server, 0x014), reset)
+
+        # a new connection with the same ports opens the flow again
+        send(processor, packets[0], 0x002)
+        self.assertEqual(processor.flows.stats(),
+                         {'active': 1, 'closed': 0, 'evicted': 0, 'expired': 0, 'reused': 0})
+
+        # both sides close, the flow is closed by the acknowledgement of the second FIN and a FIN
+        # resent after it keeps its moved seq_num
+        processor = wiregr.yaml_processor.FixTcpStreams()
+        for info in copy.deepcopy(blocks):
+            processor.process(info)
+        send(processor, client, 0x011)
+        fin = send(processor, server, 0x011)
+        send(processor, client, 0x010)
+        self.assertEqual(processor.flows.stats()['closed'], 1)
+        self.assertEqual(send(processor, server, 0x011), fin)
+        self.assertEqual(fin, server['tcp_data']['seq_num'] + 5)
+
+        # only the last closed flows are remembered
+        processor.flows.CLOSED_FLOWS = 0
+        send(processor, packets[0], 0x002)
+        send(processor, server, 0x014)
+        self.assertEqual(processor.flows.stats(),
+                         {'active': 0, 'closed': 0, 'evicted': 0, 'expired': 1, 'reused': 0})
+        send(processor, packets[0], 0x002)
+        self.assertEqual(processor.flows.reused, 1)
+
+
+    def test_fix_tcp_streams_flow_idle_timeout(self):
+        blocks = self.read_blocks(os.path.join(self.data_dir, 'mysql_sample_start.yaml'))
+        packets = [x for x in blocks if 'tcp_data' in x]
+        processor = wiregr.yaml_processor.FixTcpStreams(idle_timeout=datetime.timedelta(seconds=10))
+        processor.process(copy.deepcopy(packets[0]))
+
+        late = copy.deepcopy(packets[1])
+        late['datetime'] += datetime.timedelta(seconds=11)
+        processor.process(late)
+        self.assertEqual(late['tcp_data']['seq_num'], packets[1]['tcp_data']['seq_num'])
+        self.assertEqual(processor.flows.stats(),
+                         {'active': 1, 'closed': 0, 'evicted': 1, 'expired': 0, 'reused': 1})
+
+        # streams are kept however long they are idle by default
+        processor = wiregr.yaml_processor.FixTcpStreams()
+        processor.process(copy.deepcopy(packets[0]))
+        late = copy.deepcopy(packets[1])
+        late['datetime'] += datetime.timedelta(hours=2)
+        processor.process(late)
+        self.assertEqual(processor.flows.stats(),
+                         {'active': 1, 'closed': 0, 'evicted': 0, 'expired': 0, 'reused': 0})
+
+
+    def test_fix_tcp_streams_max_flows_reports_evictions(self):
+        # streams are only forgotten over --tcp-max-flows, which is reported as the output may change
+        capture_file = os.path.join(self.test_dir, 'tcp.pcapng')
+        with open(capture_file, 'wb') as stream:
+            synthetic_capture.CaptureGenerator({'tcp': 1}, seed=1).write(stream, 300)
+        output_file = os.path.join(self.test_dir, 'fixed.pcapng')
+
+        for flags, reported in (([], False), (['--tcp-max-flows', '1'], True)):
+            argv = ['wiregr', 'process', capture_file, output_file, '--fix-tcp-streams'] + flags
+            with mock.patch.object(sys, 'argv', argv), mock.patch.object(sys, 'stderr', io.StringIO()) as stderr:
+                wiregr.main()
+            self.assertEqual('Evicted tcp streams' in stderr.getvalue(), reported)
+
+
 if __name__ == '__main__':
     unittest.main()
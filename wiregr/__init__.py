@@ -6,22 +6,44 @@
 # with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import argparse
+import datetime
+import os
 import dateutil.parser
 
+
+def packet_range(value):
+    first, separator, last = value.partition(':')
+    first = int(first) if first else 0
+    if not separator:
+        return first, first + 1
+    return first, int(last) if last else None
+
+
 def main():
     parser = argparse.ArgumentParser(description="Synchronize org-mode files with cloud.")
 
+    parser.add_argument('--yaml-backend', choices=['auto', 'c', 'python'], default='auto',
+                        help='yaml parser/emitter implementation, c requires pyyaml built with libyaml')
+
     subparsers = parser.add_subparsers(dest='command', title='commands')
 
     pcap2yaml = subparsers.add_parser('pcap2yaml', help='convert pcap to yaml.')
     pcap2yaml.add_argument('input_file', nargs='?', help='input file')
     pcap2yaml.add_argument('output_file', nargs='?', help='output file')
+    pcap2yaml.add_argument('--mmap', action='store_true', help='memory-map input file instead of reading it')
+    pcap2yaml.add_argument('--payload-format', choices=['list', 'hex', 'hexdump'], default='list',
+                           help='unknown_payload encoding, hex and hexdump are compact !hex block scalars')
+    pcap2yaml.add_argument('--jobs', type=int, default=1,
+                           help='convert with a pool of JOBS processes, 0 uses all cpus, output is the same')
+    pcap2yaml.add_argument('--filter', help='keep only packets matching expression, e.g. "udp and dst port 5004 and ip.src == 10.0.0.1"')
+    pcap2yaml.add_argument('--output-format', choices=['yaml', 'binary'],
+                           help='binary blocks are faster for intermediate files, by default binary for .wgb output')
 
     yaml2pcap = subparsers.add_parser('yaml2pcap', help='convert yaml to pcap.')
     yaml2pcap.add_argument('input_file', nargs='?', help='input file')
     yaml2pcap.add_argument('output_file', nargs='?', help='output file')
 
-    yaml_process = subparsers.add_parser('process', help='process yaml file.')
+    yaml_process = subparsers.add_parser('process', help='process yaml or pcapng file.')
     yaml_process.add_argument('input_file', nargs='?', help='input file')
     yaml_process.add_argument('output_file', nargs='?', help='output file')
     yaml_process.add_argument('--move-timeline', help='move all traffic to specified start datetime',
@@ -29,13 +51,57 @@ def main():
     yaml_process.add_argument('--clean-mac', action='store_true', help='clean mac addresses')
     yaml_process.add_argument('--fix-lengths', action='store_true', help='fix header lengths')
     yaml_process.add_argument('--fix-checksums', action='store_true', help='fix header checksums')
+    yaml_process.add_argument('--incremental-checksums', action='store_true',
+                              help='fix header checksums by applying only the fields changed by other processors, '
+                                   'input checksums must be valid')
     yaml_process.add_argument('--fix-tcp-streams', action='store_true', help='fix tcp seq/ack numbers')
+    yaml_process.add_argument('--tcp-idle-timeout', type=float, default=0,
+                              help='forget tcp streams idle for more seconds of capture time, 0 (default) keeps them')
+    yaml_process.add_argument('--tcp-max-flows', type=int, default=0,
+                              help='forget the least recently seen tcp streams over this count, 0 (default) keeps them')
+    yaml_process.add_argument('--payload-format', choices=['list', 'hex', 'hexdump'],
+                              help='re-encode unknown_payload, by default it is kept as it is')
+    yaml_process.add_argument('--mmap', action='store_true', help='memory-map pcapng input file instead of reading it')
+    yaml_process.add_argument('--jobs', type=int, default=1,
+                              help='process with JOBS processes, packets are sharded by their flow, 0 uses all cpus')
+    yaml_process.add_argument('--filter', help='keep only packets matching expression, e.g. "udp and dst port 5004 and ip.src == 10.0.0.1"')
+    yaml_process.add_argument('--output-format', choices=['yaml', 'binary'],
+                              help='format of non-pcapng output, by default binary for .wgb output or binary input')
+
+    slice_parser = subparsers.add_parser('slice', help='cut packets by time or number from yaml or pcapng file.')
+    slice_parser.add_argument('input_file', help='input file')
+    slice_parser.add_argument('output_file', nargs='?', help='output file')
+    slice_parser.add_argument('--from', dest='time_from', help='keep packets captured at or after datetime',
+                              type=lambda x: dateutil.parser.parse(x))
+    slice_parser.add_argument('--to', dest='time_to', help='keep packets captured before datetime',
+                              type=lambda x: dateutil.parser.parse(x))
+    slice_parser.add_argument('--packets', type=packet_range,
+                              help='keep packets A:B (zero-based, B excluded, both sides optional)')
+    slice_parser.add_argument('--filter', help='keep only packets matching expression, e.g. "udp and dst port 5004 and ip.src == 10.0.0.1"')
 
     args = parser.parse_args()
 
+    import wiregr.common as common
+    try:
+        common.set_yaml_backend(args.yaml_backend)
+    except ValueError as ex:
+        parser.error(str(ex))
+
+    if getattr(args, 'jobs', 1) < 0:
+        parser.error('--jobs must not be negative')
+
+    packet_filter = None
+    if getattr(args, 'filter', None) is not None:
+        import wiregr.filters as filters
+        try:
+            packet_filter = filters.PacketFilter(args.filter)
+        except ValueError as ex:
+            parser.error(str(ex))
+
     if args.command == 'pcap2yaml':
         import wiregr.pcap_reader as module
-        with module.PcapReader(args.input_file, args.output_file) as reader:
+        with module.PcapReader(args.input_file, args.output_file, args.mmap, args.payload_format,
+                                packet_filter, args.jobs or os.cpu_count() or 1, args.output_format) as reader:
             reader.process()
     elif args.command == 'yaml2pcap':
         import wiregr.pcap_writer as module
@@ -44,18 +110,29 @@ def main():
     elif args.command == 'process':
         import wiregr.yaml_processor as module
         processors = []
+        changes = module.FieldChanges() if args.incremental_checksums else None
         if args.clean_mac:
             processors.append(module.CleanMac())
         if args.move_timeline:
             processors.append(module.MoveTimeline(args.move_timeline))
         if args.fix_lengths:
-            processors.append(module.FixLengths())
+            processors.append(module.FixLengths(changes))
         if args.fix_tcp_streams:
-            processors.append(module.FixTcpStreams())
-        if args.fix_checksums:
-            processors.append(module.FixChecksums())
-        with module.YamlProcessor(args.input_file, args.output_file, processors) as processor:
+            processors.append(module.FixTcpStreams(
+                changes,
+                datetime.timedelta(seconds=args.tcp_idle_timeout) if args.tcp_idle_timeout > 0 else None,
+                args.tcp_max_flows if args.tcp_max_flows > 0 else None))
+        if args.fix_checksums or args.incremental_checksums:
+            processors.append(module.FixChecksums(changes))
+        with module.YamlProcessor(args.input_file, args.output_file, processors,
+                                  args.payload_format, args.mmap, packet_filter,
+                                  args.jobs or os.cpu_count() or 1, args.output_format) as processor:
             processor.process()
+    elif args.command == 'slice':
+        import wiregr.slicer as module
+        with module.Slicer(args.input_file, args.output_file,
+                           args.time_from, args.time_to, args.packets, packet_filter) as slicer:
+            slicer.process()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This Source Code Form is subject to the terms of the
+# Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+# with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import datetime
+import struct
+from collections import OrderedDict
+
+from wiregr.common import *
+import wiregr.packets # registers the header records
+
+# Binary form of the block dicts for the intermediate files of a pipeline. The file starts with
+# BINARY_BLOCKS_MAGIC, then every block is a little-endian uint32 length followed by the block
+# mapping as a tagged value. Every value type produced by the yaml reader has a tag of its own,
+# so blocks come back with the same types and are written to yaml exactly like the originals.
+#
+#   N T F         None, True, False
+#   c y           int, HexInt as uint8
+#   w W           int, HexInt as uint16
+#   v V           int, HexInt as uint32
+#   i x           int, HexInt as int64
+#   I X           int, HexInt out of int64 range as uint16 size and signed bytes
+#   f             float64
+#   k s           str as uint8 size and utf-8, longer as uint32 size and utf-8
+#   b d h H       bytes, DecimalBytes, HexPayload, HexDumpPayload as uint32 size and bytes
+#   l u           list, UnflowList as uint32 count and values
+#   o m           OrderedDict, dict as uint32 count and key, value pairs
+#   R             HeaderRecord with all of its fields as header name, the field values in order,
+#                 uint32 count and key, value pairs of the extra keys
+#   r             other HeaderRecord as header name, uint32 count and key, value pairs
+#   t             datetime as int64 microseconds since EPOCH
+#   z             aware datetime as int64 microseconds of its wall time since EPOCH and int64
+#                 microseconds of its utc offset
+#   p             Timestamp as int64 ticks, uint8 base and uint8 power
+#   P             Timestamp with ticks out of int64 range as uint16 size and signed bytes,
+#                 uint8 base and uint8 power
+#   D             date as int32 ordinal
+
+INT64 = struct.Struct('<q')
+UINT32 = struct.Struct('<L')
+UINT16 = struct.Struct('<H')
+UINT8 = struct.Struct('<B')
+INT32 = struct.Struct('<l')
+FLOAT64 = struct.Struct('<d')
+TSRESOL = struct.Struct('<BB')
+
+INT64_MIN = -1 << 63
+INT64_MAX = (1 << 63) - 1
+
+# (upper bound, struct, int tag, HexInt tag) of the non-negative int sizes
+UNSIGNED_INTS = [
+    (1 << 8, UINT8, b'c', b'y'),
+    (1 << 16, UINT16, b'w', b'W'),
+    (1 << 32, UINT32, b'v', b'V'),
+]
+
+SEQUENCE_TAGS = {list: b'l', UnflowList: b'u'}
+MAPPING_TAGS = {OrderedDict: b'o', dict: b'm'}
+BYTES_TAGS = {bytes: b'b', bytearray: b'b', memoryview: b'b', DecimalBytes: b'd',
+              HexPayload: b'h', HexDumpPayload: b'H'}
+
+
+class BinaryBlockWriter:
+
+    def __init__(self, stream, payload_format=None):
+        self.stream = stream
+        self.payload_format = payload_format
+        self.__buffer = bytearray()
+        self.__encoders = {
+            type(None): self.__encode_none,
+            bool: self.__encode_bool,
+            int: self.__encode_int,
+            HexInt: self.__encode_int,
+            float: self.__encode_float,
+            str: self.__encode_str,
+            datetime.datetime: self.__encode_datetime,
+            datetime.date: self.__encode_date,
+            Timestamp: self.__encode_timestamp,
+        }
+        for value_type in SEQUENCE_TAGS:
+            self.__encoders[value_type] = self.__encode_sequence
+        for value_type in MAPPING_TAGS:
+            self.__encoders[value_type] = self.__encode_mapping
+        for value_type in BYTES_TAGS:
+            self.__encoders[value_type] = self.__encode_bytes
+
+        self.stream.write(BINARY_BLOCKS_MAGIC)
+
+    def write(self, info):
+        if not isinstance(info, dict):
+            info = info.materialize()
+
+        if self.payload_format is not None and 'unknown_payload' in info:
+            info['unknown_payload'] = encode_payload(info['unknown_payload'], self.payload_format)
+
+        buffer = self.__buffer
+        buffer[:] = b'\0\0\0\0'
+        self.__encode(info)
+        UINT32.pack_into(buffer, 0, len(buffer) - 4)
+        self.stream.write(buffer)
+
+    def close(self):
+        pass
+
+    def __encode(self, value):
+        encoder = self.__encoders.get(type(value))
+        if encoder is None and isinstance(value, HeaderRecord):
+            encoder = self.__encoders[type(value)] = self.__encode_record
+        if encoder is None:
+            raise TypeError('cannot write {} to binary blocks'.format(type(value).__name__))
+        encoder(value)
+
+    def __encode_none(self, value):
+        self.__buffer += b'N'
+
+    def __encode_bool(self, value):
+        self.__buffer += b'T' if value else b'F'
+
+    def __encode_int(self, value):
+        hex_int = type(value) is HexInt
+        if value >= 0:
+            for limit, size_struct, tag, hex_tag in UNSIGNED_INTS:
+                if value < limit:
+                    self.__buffer += hex_tag if hex_int else tag
+                    self.__buffer += size_struct.pack(value)
+                    return
+
+        if INT64_MIN <= value <= INT64_MAX:
+            self.__buffer += b'x' if hex_int else b'i'
+            self.__buffer += INT64.pack(value)
+        else:
+            data = int(value).to_bytes((value.bit_length() + 8) // 8, 'little', signed=True)
+            self.__buffer += b'X' if hex_int else b'I'
+            self.__buffer += UINT16.pack(len(data))
+            self.__buffer += data
+
+    def __encode_float(self, value):
+        self.__buffer += b'f'
+        self.__buffer += FLOAT64.pack(value)
+
+    def __encode_str(self, value):
+        data = value.encode('utf-8')
+        if len(data) < 256:
+            self.__buffer += b'k'
+            self.__buffer.append(len(data))
+        else:
+            self.__buffer += b's'
+            self.__buffer += UINT32.pack(len(data))
+        self.__buffer += data
+
+    def __encode_bytes(self, value):
+        self.__buffer += BYTES_TAGS[type(value)]
+        self.__buffer += UINT32.pack(len(value))
+        self.__buffer += value
+
+    def __encode_sequence(self, value):
+        self.__buffer += SEQUENCE_TAGS[type(value)]
+        self.__buffer += UINT32.pack(len(value))
+        for item in value:
+            self.__encode(item)
+
+    def __encode_mapping(self, value):
+        self.__buffer += MAPPING_TAGS[type(value)]
+        self.__buffer += UINT32.pack(len(value))
+        for key, item in value.items():
+            self.__encode(key)
+            self.__encode(item)
+
+    def __encode_record(self, value):
+        items = value.items()
+        fields = value.fields
+        if len(items) >= len(fields) and all(x[0] == y for x, y in zip(items, fields)):
+            # the usual record with every field set, stored without the field names
+            self.__buffer += b'R'
+            self.__encode_str(value.name)
+            for _, item in items[:len(fields)]:
+                self.__encode(item)
+            items = items[len(fields):]
+        else:
+            self.__buffer += b'r'
+            self.__encode_str(value.name)
+
+        self.__buffer += UINT32.pack(len(items))
+        for key, item in items:
+            self.__encode_str(key)
+            self.__encode(item)
+
+    def __encode_datetime(self, value):
+        offset = value.utcoffset()
+        if offset is None:
+            self.__buffer += b't'
+            self.__buffer += INT64.pack(timedelta_to_microseconds(value - EPOCH))
+        else:
+            self.__buffer += b'z'
+            self.__buffer += INT64.pack(timedelta_to_microseconds(value.replace(tzinfo=None) - EPOCH))
+            self.__buffer += INT64.pack(timedelta_to_microseconds(offset))
+
+    def __encode_date(self, value):
+        self.__buffer += b'D'
+        self.__buffer += INT32.pack(value.toordinal())
+
+    def __encode_timestamp(self, value):
+        if INT64_MIN <= value.ticks <= INT64_MAX:
+            self.__buffer += b'p'
+            self.__buffer += INT64.pack(value.ticks)
+        else:
+            data = value.ticks.to_bytes((value.ticks.bit_length() + 8) // 8, 'little', signed=True)
+            self.__buffer += b'P'
+            self.__buffer += UINT16.pack(len(data))
+            self.__buffer += data
+        self.__buffer += TSRESOL.pack(*value.tsresol)
+
+
+class BinaryBlockReader:
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.__decoders = {
+            ord('N'): lambda data, offset: (None, offset),
+            ord('T'): lambda data, offset: (True, offset),
+            ord('F'): lambda data, offset: (False, offset),
+            ord('c'): self.__int_decoder(UINT8, int),
+            ord('y'): self.__int_decoder(UINT8, HexInt),
+            ord('w'): self.__int_decoder(UINT16, int),
+            ord('W'): self.__int_decoder(UINT16, HexInt),
+            ord('v'): self.__int_decoder(UINT32, int),
+            ord('V'): self.__int_decoder(UINT32, HexInt),
+            ord('i'): self.__decode_int64,
+            ord('x'): self.__decode_hex_int64,
+            ord('I'): self.__decode_int,
+            ord('X'): self.__decode_hex_int,
+            ord('f'): self.__decode_float,
+            ord('k'): self.__decode_short_str,
+            ord('s'): self.__decode_str,
+            ord('l'): self.__decode_list,
+            ord('u'): self.__decode_unflow_list,
+            ord('o'): self.__decode_ordered_dict,
+            ord('m'): self.__decode_dict,
+            ord('R'): self.__decode_full_record,
+            ord('r'): self.__decode_record,
+            ord('t'): self.__decode_datetime,
+            ord('z'): self.__decode_aware_datetime,
+            ord('p'): self.__decode_timestamp,
+            ord('P'): self.__decode_big_timestamp,
+            ord('D'): self.__decode_date,
+        }
+        for value_type, tag in BYTES_TAGS.items():
+            if value_type not in (bytearray, memoryview):
+                self.__decoders[tag[0]] = self.__bytes_decoder(value_type)
+
+        magic = self.stream.read(len(BINARY_BLOCKS_MAGIC))
+        if len(magic) > 0 and magic != BINARY_BLOCKS_MAGIC:
+            raise ValueError('not a wiregr binary blocks stream')
+
+    def read(self):
+        while True:
+            info = self.read_block()
+            if info is None:
+                break
+
+            yield info
+
+    def read_block(self):
+        header = self.stream.read(UINT32.size)
+        if len(header) == 0:
+            return None
+
+        length = UINT32.unpack(header)[0] if len(header) == UINT32.size else None
+        data = self.stream.read(length) if length is not None else b''
+        if length is None or len(data) < length:
+            raise EOFError('truncated binary block')
+
+        return self.__decode(data, 0)[0]
+
+    def __decode(self, data, offset):
+        return self.__decoders[data[offset]](data, offset + 1)
+
+    @staticmethod
+    def __int_decoder(size_struct, value_type):
+        def decode(data, offset):
+            return value_type(size_struct.unpack_from(data, offset)[0]), offset + size_struct.size
+        return decode
+
+    @staticmethod
+    def __decode_int64(data, offset):
+        return INT64.unpack_from(data, offset)[0], offset + INT64.size
+
+    @staticmethod
+    def __decode_hex_int64(data, offset):
+        return HexInt(INT64.unpack_from(data, offset)[0]), offset + INT64.size
+
+    @staticmethod
+    def __decode_int(data, offset):
+        size = UINT16.unpack_from(data, offset)[0]
+        offset += UINT16.size
+        return int.from_bytes(data[offset:offset + size], 'little', signed=True), offset + size
+
+    @staticmethod
+    def __decode_hex_int(data, offset):
+        value, offset = BinaryBlockReader.__decode_int(data, offset)
+        return HexInt(value), offset
+
+    @staticmethod
+    def __decode_float(data, offset):
+        return FLOAT64.unpack_from(data, offset)[0], offset + FLOAT64.size
+
+    @staticmethod
+    def __decode_short_str(data, offset):
+        size = data[offset]
+        offset += 1
+        return str(data[offset:offset + size], 'utf-8'), offset + size
+
+    @staticmethod
+    def __decode_str(data, offset):
+        size = UINT32.unpack_from(data, offset)[0]
+        offset += UINT32.size
+        return str(data[offset:offset + size], 'utf-8'), offset + size
+
+    @staticmethod
+    def __bytes_decoder(value_type):
+        def decode(data, offset):
+            size = UINT32.unpack_from(data, offset)[0]
+            offset += UINT32.size
+            return value_type(data[offset:offset + size]), offset + size
+        return decode
+
+    def __decode_items(self, data, offset, value):
+        count = UINT32.unpack_from(data, offset)[0]
+        offset += UINT32.size
+        for _ in range(count):
+            item, offset = self.__decode(data, offset)
+            value.append(item)
+        return value, offset
+
+    def __decode_list(self, data, offset):
+        return self.__decode_items(data, offset, [])
+
+    def __decode_unflow_list(self, data, offset):
+        return self.__decode_items(data, offset, UnflowList())
+
+    def __decode_pairs(self, data, offset, value):
+        count = UINT32.unpack_from(data, offset)[0]
+        offset += UINT32.size
+        for _ in range(count):
+            key, offset = self.__decode(data, offset)
+            value[key], offset = self.__decode(data, offset)
+        return value, offset
+
+    def __decode_ordered_dict(self, data, offset):
+        return self.__decode_pairs(data, offset, OrderedDict())
+
+    def __decode_dict(self, data, offset):
+        return self.__decode_pairs(data, offset, {})
+
+    def __decode_full_record(self, data, offset):
+        name, offset = self.__decode(data, offset)
+        record = HEADER_RECORDS[name]()
+        for field in record.fields:
+            value, offset = self.__decode(data, offset)
+            setattr(record, field, value)
+        return self.__decode_record_items(data, offset, record)
+
+    def __decode_record(self, data, offset):
+        name, offset = self.__decode(data, offset)
+        return self.__decode_record_items(data, offset, HEADER_RECORDS[name]())
+
+    def __decode_record_items(self, data, offset, record):
+        count = UINT32.unpack_from(data, offset)[0]
+        offset += UINT32.size
+        for _ in range(count):
+            key, offset = self.__decode(data, offset)
+            record[key], offset = self.__decode(data, offset)
+        return record, offset
+
+    @staticmethod
+    def __decode_datetime(data, offset):
+        value = INT64.unpack_from(data, offset)[0]
+        return EPOCH + datetime.timedelta(microseconds=value), offset + INT64.size
+
+    @staticmethod
+    def __decode_aware_datetime(data, offset):
+        value, utc_offset = INT64.unpack_from(data, offset)[0], INT64.unpack_from(data, offset + INT64.size)[0]
+        tzinfo = datetime.timezone(datetime.timedelta(microseconds=utc_offset))
+        return (EPOCH + datetime.timedelta(microseconds=value)).replace(tzinfo=tzinfo), offset + 2 * INT64.size
+
+    @staticmethod
+    def __decode_timestamp(data, offset):
+        ticks = INT64.unpack_from(data, offset)[0]
+        offset += INT64.size
+        return Timestamp(ticks, TSRESOL.unpack_from(data, offset)), offset + TSRESOL.size
+
+    @staticmethod
+    def __decode_big_timestamp(data, offset):
+        ticks, offset = BinaryBlockReader.__decode_int(data, offset)
+        return Timestamp(ticks, TSRESOL.unpack_from(data, offset)), offset + TSRESOL.size
+
+    @staticmethod
+    def __decode_date(data, offset):
+        return datetime.date.fromordinal(INT32.unpack_from(data, offset)[0]), offset + INT32.size
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This Source Code Form is subject to the terms of the
+# Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+# with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import bisect
+import datetime
+import mmap
+import os
+import re
+import struct
+import sys
+from array import array
+
+from wiregr.common import *
+from wiregr.blocks import *
+
+INDEX_EXT = '.idx'
+INDEX_MAGIC = b'WGIX'
+INDEX_VERSION = 1
+
+# magic, version, little endian flag, source size, source mtime, blocks, timed blocks, context blocks, end offset
+INDEX_HEADER = struct.Struct('<4sBB2xQqQQQQ')
+
+NO_INTERFACE = -1
+NO_TIMESTAMP = -1 << 63
+
+SCAN_STRUCTS = {
+    '>': (struct.Struct('>L'), struct.Struct('>LLL'), struct.Struct('>HH')),
+    '<': (struct.Struct('<L'), struct.Struct('<LLL'), struct.Struct('<HH')),
+}
+
+YAML_FIELD = re.compile(rb'(block_type|interface_id|datetime): *([^\r\n]*)')
+
+
+class BlockIndex:
+
+    def __init__(self):
+        self.offsets = array('Q')
+        self.block_types = array('L')
+        self.interfaces = array('l')
+        # block numbers and timestamps (ns since epoch) of the blocks that carry a timestamp
+        self.timed_blocks = array('Q')
+        self.timed_values = array('q')
+        # block numbers of section and interface description blocks
+        self.context_blocks = array('Q')
+        self.end_offset = 0
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def append(self, offset, block_type, interface, timestamp):
+        number = len(self.offsets)
+        self.offsets.append(offset)
+        self.block_types.append(block_type)
+        self.interfaces.append(interface)
+        if timestamp != NO_TIMESTAMP:
+            self.timed_blocks.append(number)
+            self.timed_values.append(timestamp)
+        if block_type == BLOCK_TYPE_SHB or block_type == BLOCK_TYPE_IDB:
+            self.context_blocks.append(number)
+
+    def context(self, number):
+        result = []
+        position = bisect.bisect_left(self.context_blocks, number)
+        while position > 0:
+            position -= 1
+            result.append(self.context_blocks[position])
+            if self.block_types[self.context_blocks[position]] == BLOCK_TYPE_SHB:
+                break
+        result.reverse()
+        return result
+
+    def find_time(self, value):
+        # number of the first timestamped block not earlier than value, blocks are expected in capture order
+        position = bisect.bisect_left(self.timed_values, datetime_to_ns(value))
+        if position == len(self.timed_blocks):
+            return len(self)
+        return self.timed_blocks[position]
+
+    def save(self, stream, source_stat):
+        stream.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, sys.byteorder == 'little',
+                                       source_stat.st_size, source_stat.st_mtime_ns,
+                                       len(self.offsets), len(self.timed_blocks), len(self.context_blocks),
+                                       self.end_offset))
+        for values in self.__arrays():
+            values.tofile(stream)
+
+    def load(self, stream, source_stat):
+        header = stream.read(INDEX_HEADER.size)
+        if len(header) != INDEX_HEADER.size:
+            return False
+
+        magic, version, little, size, mtime, blocks, timed, context, end_offset = INDEX_HEADER.unpack(header)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION or little != (sys.byteorder == 'little'):
+            return False
+        if size != source_stat.st_size or mtime != source_stat.st_mtime_ns:
+            return False
+
+        try:
+            for values, count in zip(self.__arrays(), (blocks, blocks, blocks, timed, timed, context)):
+                values.fromfile(stream, count)
+        except EOFError:
+            return False
+
+        self.end_offset = end_offset
+        return True
+
+    def __arrays(self):
+        return (self.offsets, self.block_types, self.interfaces,
+                self.timed_blocks, self.timed_values, self.context_blocks)
+
+
+def datetime_to_ns(value):
+    # capture times are utc, aware datetimes are moved to it
+    if isinstance(value, datetime.datetime) and value.utcoffset() is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return datetime_to_ticks(value, (10, 9))
+
+
+def ticks_to_ns(ticks, base, power):
+    if base == 2:
+        return (ticks * 10 ** 9) >> power
+    if power <= 9:
+        return ticks * 10 ** (9 - power)
+    return ticks // 10 ** (power - 9)
+
+
+def scan_pcapng(buffer):
+    # yields (offset, block_type, block_total_length, interface_id, timestamp in ns) without decoding the blocks
+    offset = 0
+    size = len(buffer)
+    uint32, triple, option = SCAN_STRUCTS['>']
+    resolutions = []
+
+    while offset + 12 <= size:
+        block_type = uint32.unpack_from(buffer, offset)[0]
+        if block_type == BLOCK_TYPE_SHB:
+            uint32, triple, option = SCAN_STRUCTS['>' if SHB_MAGIC_STRUCT.unpack_from(buffer, offset + 8)[0] == MAGIC else '<']
+            resolutions = []
+        length = uint32.unpack_from(buffer, offset + 4)[0]
+
+        interface = NO_INTERFACE
+        timestamp = NO_TIMESTAMP
+        if block_type == BLOCK_TYPE_IDB:
+            resolutions.append(_scan_tsresol(buffer, offset + 16, offset + length - 4, option))
+        elif block_type == BLOCK_TYPE_EPB or block_type == BLOCK_TYPE_ISB:
+            interface, high, low = triple.unpack_from(buffer, offset + 8)
+            # interface statistic timestamps are read with microsecond resolution
+            base, power = resolutions[interface] if block_type == BLOCK_TYPE_EPB else (10, 6)
+            timestamp = ticks_to_ns(high << 32 | low, base, power)
+
+        yield offset, block_type, length, interface, timestamp
+        offset += length
+
+
+def _scan_tsresol(buffer, offset, end_offset, option):
+    while offset + 4 <= end_offset:
+        code, length = option.unpack_from(buffer, offset)
+        if code == OPT_END:
+            break
+        if code == 9: # if_tsresol
+            value = buffer[offset + 4]
+            return (2 if value & 0x80 else 10), value & 0x7F
+        offset += 4 + align_value(length, 4)
+    return 10, 6
+
+
+def scan_yaml(stream):
+    # yields (offset, block_type, block_length, interface_id, timestamp in ns) of the blank line separated blocks
+    offset = 0
+    start = None
+
+    for line in stream:
+        if line.strip(b'\r\n'):
+            if start is None:
+                start = offset
+                block_type = 0
+                interface = NO_INTERFACE
+                timestamp = NO_TIMESTAMP
+
+            match = YAML_FIELD.match(line)
+            if match is not None:
+                key, value = match.groups()
+                if key == b'block_type':
+                    block_type = int(value, 0)
+                elif key == b'interface_id':
+                    interface = int(value)
+                else:
+                    timestamp = datetime_to_ns(parse_timestamp(value.decode('ascii')))
+        elif start is not None:
+            yield start, block_type, offset - start, interface, timestamp
+            start = None
+
+        offset += len(line)
+
+    if start is not None:
+        yield start, block_type, offset - start, interface, timestamp
+
+
+def build_block_index(file_name):
+    index = BlockIndex()
+
+    with open(file_name, 'rb') as stream:
+        if is_pcapng_file(file_name):
+            with mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                for offset, block_type, length, interface, timestamp in scan_pcapng(buffer):
+                    index.append(offset, block_type, interface, timestamp)
+                    index.end_offset = offset + length
+        else:
+            for offset, block_type, length, interface, timestamp in scan_yaml(stream):
+                index.append(offset, block_type, interface, timestamp)
+            index.end_offset = stream.tell()
+
+    return index
+
+
+def load_block_index(file_name):
+    # reuses the sidecar file next to the input while the input keeps its size and mtime
+    index_file = file_name + INDEX_EXT
+    source_stat = os.stat(file_name)
+
+    try:
+        with open(index_file, 'rb') as stream:
+            index = BlockIndex()
+            if index.load(stream, source_stat):
+                return index
+    except OSError:
+        pass
+
+    index = build_block_index(file_name)
+    try:
+        with open(index_file, 'wb') as stream:
+            index.save(stream, source_stat)
+    except OSError:
+        pass # read-only location, the index is still usable in memory
+
+    return index
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This Source Code Form is subject to the terms of the
+# Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+# with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import struct
+
+from wiregr.schema import Header, Field, OptionTable
+
+BLOCK_TYPE_SHB = 0x0A0D0D0A
+BLOCK_TYPE_IDB = 0x00000001
+BLOCK_TYPE_ISB = 0x00000005
+BLOCK_TYPE_EPB = 0x00000006
+
+# the magic is always read big-endian, so its value tells the section byte order
+SHB_MAGIC_STRUCT = struct.Struct('>L')
+
+SECTION_HEADER = Header('section_header', [
+    Field('major_version', 'H'),
+    Field('minor_version', 'H'),
+    Field('section_length', 'Q', 'hex'),
+])
+
+INTERFACE_DESCRIPTION = Header('interface_description', [
+    Field('link_type', 'H'),
+    Field(None, 'H'), # RESERVED
+    Field('snapshot_length', 'L'),
+])
+
+ENHANCED_PACKET = Header('enhanced_packet', [
+    Field('interface_id', 'L'),
+    Field('datetime', None, 'timestamp'),
+    Field('captured_length', 'L'),
+    Field('packet_length', 'L'),
+])
+
+INTERFACE_STATISTIC = Header('interface_statistic', [
+    Field('interface_id', 'L'),
+    Field('datetime', None, 'timestamp'),
+])
+
+# option kinds are the names of option codecs implemented by the block reader and writer
+SECTION_HEADER_OPTIONS = OptionTable([
+    (1, 'opt_comment', 'utf8'),
+    (2, 'shb_hardware', 'utf8'),
+    (3, 'shb_os', 'utf8'),
+    (4, 'shb_userappl', 'utf8'),
+])
+
+INTERFACE_DESCRIPTION_OPTIONS = OptionTable([
+    (1, 'opt_comment', 'utf8'),
+    (2, 'if_name', 'utf8'),
+    (3, 'if_description', 'utf8'),
+    (9, 'if_tsresol', 'tsresol'),
+    (11, 'if_filter', 'utf8'),
+    (12, 'if_os', 'utf8'),
+])
+
+ENHANCED_PACKET_OPTIONS = OptionTable([
+    (1, 'opt_comment', 'utf8'),
+    (2, 'ebp_flags', 'hex32'),
+    (3, 'ebp_hash', 'bytes'),
+    (4, 'epb_dropcount', 'hex64'),
+])
+
+INTERFACE_STATISTIC_OPTIONS = OptionTable([
+    (1, 'opt_comment', 'utf8'),
+    (2, 'isb_starttime', 'timestamp'),
+    (3, 'isb_endtime', 'timestamp'),
+    (4, 'isb_ifrecv', 'uint64'),
+    (5, 'isb_ifdrop', 'uint64'),
+])
+
+UNKNOWN_OPTIONS = OptionTable([
+    (1, 'opt_comment', 'utf8'),
+])
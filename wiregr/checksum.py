@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This Source Code Form is subject to the terms of the
+# Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+# with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# The one's complement sum of 16-bit words is congruent to the whole data read as
+# a big-endian integer modulo 0xFFFF (because 0x10000 == 1 mod 0xFFFF), so the
+# carry folding loop collapses into one bigint conversion and one modulo. The only
+# ambiguity is 0 vs 0xFFFF, folding never produces 0 unless every word is zero.
+
+CHECKSUM_MODULO = 0xFFFF
+
+# below this many segments the numpy setup costs more than it saves
+NUMPY_MIN_BATCH = 64
+
+
+def fold_checksum(value):
+    result = value % CHECKSUM_MODULO
+    if result == 0 and value:
+        result = CHECKSUM_MODULO
+    return ~result & 0xFFFF
+
+
+def calc_internet_checksum(data):
+    value = int.from_bytes(data, 'big')
+    if len(data) & 1:
+        value <<= 8
+    return fold_checksum(value)
+
+
+def word_contribution(value, end):
+    # a field ending at an odd byte offset fills the high byte of its last word
+    return value << 8 if end & 1 else value
+
+
+def adjust_checksum(checksum, removed, added):
+    # RFC 1624 eqn. 3, HC' = ~(~HC + ~m + m'), with the sums of all removed and added words;
+    # the extra modulo keeps the total non-zero, so an all-ones sum is never folded to zero
+    total = (~checksum & 0xFFFF) + added + (-removed) % CHECKSUM_MODULO + CHECKSUM_MODULO
+    return fold_checksum(total)
+
+
+def calc_internet_checksums(data, bounds, use_numpy=None):
+    # bounds are (start, end) pairs into data, starts must be even when numpy is used
+    if use_numpy is None:
+        use_numpy = numpy is not None and len(bounds) >= NUMPY_MIN_BATCH
+    if use_numpy:
+        return _calc_numpy_checksums(data, bounds)
+
+    with memoryview(data) as view:
+        return [calc_internet_checksum(view[start:end]) for start, end in bounds]
+
+
+def _calc_numpy_checksums(data, bounds):
+    size = max(end for _, end in bounds)
+    words = numpy.zeros(size // 2 + 1, dtype=numpy.uint64)
+    words[:size // 2] = numpy.frombuffer(data, dtype='>u2', count=size // 2)
+    if size & 1:
+        words[size // 2] = data[size - 1] << 8
+
+    sums = numpy.zeros(len(words) + 1, dtype=numpy.uint64)
+    numpy.cumsum(words, out=sums[1:])
+    starts = numpy.array([x[0] // 2 for x in bounds], dtype=numpy.intp)
+    ends = numpy.array([(x[1] + 1) // 2 for x in bounds], dtype=numpy.intp)
+
+    result = []
+    for (_, end), total in zip(bounds, (sums[ends] - sums[starts]).tolist()):
+        if end & 1 and end < size:
+            # the last word of an odd segment also holds the first byte after it
+            total -= data[end]
+        result.append(fold_checksum(total))
+    return result
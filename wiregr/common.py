@@ -5,6 +5,11 @@
 # Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
 # with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import datetime
+import fractions
+import io
+import mmap
+import re
 import yaml
 import os
 import shutil
@@ -12,19 +17,309 @@ import struct
 import sys
 from collections import OrderedDict
 
+from wiregr.compression import open_input, open_output, open_stdin, peek_input, split_compression_ext
+
 ABSOLUTE = 0
 RELATIVE = 1
 FROM_END = 2
 
 MAGIC = 0x1A2B3C4D
+SHB_MAGIC = b'\x0a\x0d\x0d\x0a'
+BINARY_BLOCKS_MAGIC = b'\x89WGB\r\n\x1a\n'
+BINARY_BLOCKS_EXT = '.wgb'
+
+BUFFER_SIZE = 1 << 20
 
 OPT_END = 0
 OPT_COMMENT = 1
 
 class HexInt(int): pass
 class UnflowList(list): pass
+class DecimalBytes(bytes): pass
+
+
+# record classes of the compiled headers by header name
+HEADER_RECORDS = {}
+
+def restore_header_record(name, items):
+    # records are registered when their headers are compiled, an unpickling process may not have done it yet
+    import wiregr.blocks
+    import wiregr.packets
+    record = HEADER_RECORDS[name]()
+    for key, value in items:
+        record[key] = value
+    return record
+
+
+class HeaderRecord:
+
+    # Decoded header with its fields in __slots__, which takes a fraction of the memory of an OrderedDict.
+    # It is used as a mapping by the processors and the yaml writer, keys besides the header fields
+    # (tcp options) are kept in an extra dict made on first use.
+
+    __slots__ = ('_extra',)
+    name = None
+    fields = ()
+    field_set = frozenset()
+
+    def __getitem__(self, key):
+        try:
+            if key in self.field_set:
+                return getattr(self, key)
+            return self._extra[key]
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self.field_set:
+            setattr(self, key, value)
+            return
+
+        try:
+            extra = self._extra
+        except AttributeError:
+            extra = self._extra = OrderedDict()
+        extra[key] = value
+
+    def __delitem__(self, key):
+        try:
+            if key in self.field_set:
+                delattr(self, key)
+            else:
+                del self._extra[key]
+        except AttributeError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        if key in self.field_set:
+            return hasattr(self, key)
+        return key in getattr(self, '_extra', ())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if isinstance(other, (HeaderRecord, dict)):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, dict(self.items()))
+
+    def __reduce__(self):
+        return restore_header_record, (self.name, self.items())
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        keys = [x for x in self.fields if hasattr(self, x)]
+        keys.extend(getattr(self, '_extra', ()))
+        return keys
+
+    def values(self):
+        return [self[x] for x in self.keys()]
+
+    def items(self):
+        items = []
+        for name in self.fields:
+            try:
+                items.append((name, getattr(self, name)))
+            except AttributeError:
+                pass
+        items.extend(getattr(self, '_extra', {}).items())
+        return items
+
+    def to_dict(self):
+        return OrderedDict(self.items())
+
+
+class HexPayload(bytes):
+
+    line_size = 32
+
+    def to_text(self):
+        lines = []
+        for offset in range(0, len(self), self.line_size):
+            lines.append(self.format_line(offset, self[offset:offset + self.line_size]))
+        lines.append('')
+        return '\n'.join(lines)
 
-class CustomDumper(yaml.Dumper):
+    @staticmethod
+    def format_line(offset, chunk):
+        return chunk.hex()
+
+    @staticmethod
+    def from_text(text):
+        lines = text.splitlines()
+        payload = bytes.fromhex(''.join(x.rpartition(':')[2] for x in lines))
+        if any(':' in x for x in lines):
+            return HexDumpPayload(payload)
+        return HexPayload(payload)
+
+
+class HexDumpPayload(HexPayload):
+
+    line_size = 16
+
+    @staticmethod
+    def format_line(offset, chunk):
+        return '{:04x}: {}'.format(offset, chunk.hex(' '))
+
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+MICROSECONDS = (10, 6)
+
+
+def convert_ticks(ticks, tsresol, target):
+    # exact integer conversion between resolutions given as (base, power), rounded down
+    if tsresol == target:
+        return ticks
+    return ticks * target[0] ** target[1] // tsresol[0] ** tsresol[1]
+
+
+def timedelta_to_microseconds(value):
+    return (value.days * 86400 + value.seconds) * 1000000 + value.microseconds
+
+
+class Timestamp:
+
+    # capture time kept as the raw ticks of the interface resolution (base ** -power seconds), so that
+    # timestamps pass between pcapng and yaml unchanged and a datetime is only built when asked for
+
+    __slots__ = ('ticks', 'tsresol')
+
+    def __init__(self, ticks, tsresol=MICROSECONDS):
+        self.ticks = ticks
+        self.tsresol = tsresol
+
+    @staticmethod
+    def from_datetime(value, tsresol=MICROSECONDS):
+        return Timestamp(convert_ticks(timedelta_to_microseconds(value - EPOCH), MICROSECONDS, tsresol), tsresol)
+
+    @staticmethod
+    def from_value(value, tsresol=MICROSECONDS):
+        if isinstance(value, Timestamp):
+            return value
+        return Timestamp.from_datetime(value, tsresol)
+
+    def to_ticks(self, tsresol):
+        return convert_ticks(self.ticks, self.tsresol, tsresol)
+
+    def to_datetime(self):
+        return EPOCH + datetime.timedelta(microseconds=self.to_ticks(MICROSECONDS))
+
+    def isoformat(self, sep='T'):
+        base, power = self.tsresol
+        if base != 10 or power <= 6:
+            return self.to_datetime().isoformat(sep)
+        seconds, fraction = divmod(self.ticks, 10 ** power)
+        value = EPOCH + datetime.timedelta(seconds=seconds)
+        return '{}.{:0{}d}'.format(value.isoformat(sep), fraction, power)
+
+    def __str__(self):
+        return self.isoformat(' ')
+
+    def __repr__(self):
+        return 'Timestamp({}, {})'.format(self.ticks, self.tsresol)
+
+    def __add__(self, other):
+        if isinstance(other, datetime.timedelta):
+            return Timestamp(self.ticks + convert_ticks(timedelta_to_microseconds(other), MICROSECONDS, self.tsresol),
+                             self.tsresol)
+        return NotImplemented
+
+    def __sub__(self, other):
+        if isinstance(other, datetime.timedelta):
+            return self + -other
+        if isinstance(other, (Timestamp, datetime.datetime)):
+            other = Timestamp.from_value(other)
+            return datetime.timedelta(microseconds=self.to_ticks(MICROSECONDS) - other.to_ticks(MICROSECONDS))
+        return NotImplemented
+
+    def __key(self, other):
+        # both sides scaled to the common resolution, which keeps the comparison exact
+        other = Timestamp.from_value(other)
+        return (self.ticks * other.tsresol[0] ** other.tsresol[1],
+                other.ticks * self.tsresol[0] ** self.tsresol[1])
+
+    def __eq__(self, other):
+        if not isinstance(other, (Timestamp, datetime.datetime)):
+            return NotImplemented
+        if isinstance(other, datetime.datetime) and other.utcoffset() is not None:
+            return False # never equal, like naive and aware datetimes
+        left, right = self.__key(other)
+        return left == right
+
+    def __hash__(self):
+        # the hash of the equal datetime when there is one, as they compare equal
+        microseconds = Timestamp(self.to_ticks(MICROSECONDS))
+        if microseconds == self:
+            try:
+                return hash(microseconds.to_datetime())
+            except OverflowError:
+                pass
+        return hash(fractions.Fraction(self.ticks, self.tsresol[0] ** self.tsresol[1]))
+
+    def __lt__(self, other):
+        if not isinstance(other, (Timestamp, datetime.datetime)):
+            return NotImplemented
+        left, right = self.__key(other)
+        return left < right
+
+    def __le__(self, other):
+        if not isinstance(other, (Timestamp, datetime.datetime)):
+            return NotImplemented
+        left, right = self.__key(other)
+        return left <= right
+
+    def __gt__(self, other):
+        if not isinstance(other, (Timestamp, datetime.datetime)):
+            return NotImplemented
+        left, right = self.__key(other)
+        return left > right
+
+    def __ge__(self, other):
+        if not isinstance(other, (Timestamp, datetime.datetime)):
+            return NotImplemented
+        left, right = self.__key(other)
+        return left >= right
+
+
+# fraction with more than microsecond digits ending the timestamp, zoned ones are left to datetime
+LONG_FRACTION = re.compile(r'\.([0-9]{7,9})\Z')
+
+def parse_timestamp(text):
+    # yaml timestamps with more than microsecond digits keep them all as a Timestamp in base 10
+    match = LONG_FRACTION.search(text)
+    if match is None:
+        return datetime.datetime.fromisoformat(text)
+    fraction = match.group(1)
+    seconds = timedelta_to_microseconds(datetime.datetime.fromisoformat(text[:match.start()]) - EPOCH) // 1000000
+    return Timestamp(seconds * 10 ** len(fraction) + int(fraction), (10, len(fraction)))
+
+
+def datetime_to_ticks(value, tsresol):
+    if isinstance(value, Timestamp):
+        return value.to_ticks(tsresol)
+    return convert_ticks(timedelta_to_microseconds(value - EPOCH), MICROSECONDS, tsresol)
+
+
+PAYLOAD_FORMATS = {
+    'hex': HexPayload,
+    'hexdump': HexDumpPayload,
+}
+
+class CustomDumperMixin:
 
     @staticmethod
     def save_hex_int(dumper, data):
@@ -38,6 +333,22 @@ class CustomDumper(yaml.Dumper):
     def save_flow_bytes(dumper, data):
         return dumper.represent_sequence('tag:yaml.org,2002:seq', (HexInt(x) for x in data), flow_style=True)
 
+    @staticmethod
+    def save_hex_payload(dumper, data):
+        return dumper.represent_scalar('!hex', data.to_text(), style='|')
+
+    @staticmethod
+    def save_timestamp(dumper, data):
+        return dumper.represent_scalar('tag:yaml.org,2002:timestamp', data.isoformat(' '))
+
+    @staticmethod
+    def save_decimal_bytes(dumper, data):
+        return dumper.represent_sequence('tag:yaml.org,2002:seq', list(data), flow_style=True)
+
+    @staticmethod
+    def save_header_record(dumper, data):
+        return dumper.represent_dict(data.items())
+
     @staticmethod
     def save_unflow_list(dumper, data):
         return dumper.represent_list(data)
@@ -46,23 +357,31 @@ class CustomDumper(yaml.Dumper):
     def save_ordered_dict(dumper, data):
         return dumper.represent_dict(data.items())
 
+    @classmethod
+    def register(cls, dumper):
+        dumper.add_representer(HexInt, cls.save_hex_int)
+        dumper.add_representer(list, cls.save_flow_list)
+        dumper.add_representer(bytes, cls.save_flow_bytes)
+        dumper.add_representer(memoryview, cls.save_flow_bytes)
+        dumper.add_representer(DecimalBytes, cls.save_decimal_bytes)
+        dumper.add_multi_representer(HeaderRecord, cls.save_header_record)
+        dumper.add_representer(HexPayload, cls.save_hex_payload)
+        dumper.add_representer(HexDumpPayload, cls.save_hex_payload)
+        dumper.add_representer(Timestamp, cls.save_timestamp)
+        dumper.add_representer(UnflowList, cls.save_unflow_list)
+        dumper.add_representer(OrderedDict, cls.save_ordered_dict)
+
     def __init__(self, *args, **kargs):
         kargs['default_flow_style'] = False
         super().__init__(*args, **kargs)
 
-        self.yaml_representers = self.yaml_representers.copy()
-        self.yaml_representers[HexInt] = CustomDumper.save_hex_int
-        self.yaml_representers[list] = CustomDumper.save_flow_list
-        self.yaml_representers[bytes] = CustomDumper.save_flow_bytes
-        self.yaml_representers[UnflowList] = CustomDumper.save_unflow_list
-        self.yaml_representers[OrderedDict] = CustomDumper.save_ordered_dict
-
 
-class CustomLoader(yaml.Loader):
+class CustomLoaderMixin:
 
     @staticmethod
     def detect_unflow_list(loader, node):
-        if node.flow_style == None:
+        # the pure-python parser marks indentless sequences with None, libyaml with False
+        if not node.flow_style:
             return UnflowList(*loader.construct_yaml_seq(node))
         return loader.construct_yaml_seq(node)
 
@@ -76,29 +395,378 @@ class CustomLoader(yaml.Loader):
             return HexInt(loader.construct_yaml_int(node))
         return loader.construct_yaml_int(node)
 
-    def __init__(self, *args, **kargs):
-        super().__init__(*args, **kargs)
+    @staticmethod
+    def detect_timestamp(loader, node):
+        if LONG_FRACTION.search(loader.construct_scalar(node)):
+            return parse_timestamp(loader.construct_scalar(node))
+        return loader.construct_yaml_timestamp(node)
 
-        self.yaml_constructors = self.yaml_constructors.copy()
-        self.yaml_constructors['tag:yaml.org,2002:int'] = CustomLoader.detect_hex_int
-        self.yaml_constructors['tag:yaml.org,2002:seq'] = CustomLoader.detect_unflow_list
-        self.yaml_constructors['tag:yaml.org,2002:map'] = CustomLoader.detect_ordered_dict
+    @staticmethod
+    def detect_hex_payload(loader, node):
+        return HexPayload.from_text(loader.construct_scalar(node))
+
+    @classmethod
+    def register(cls, loader):
+        loader.add_constructor('!hex', cls.detect_hex_payload)
+        loader.add_constructor('tag:yaml.org,2002:int', cls.detect_hex_int)
+        loader.add_constructor('tag:yaml.org,2002:timestamp', cls.detect_timestamp)
+        loader.add_constructor('tag:yaml.org,2002:seq', cls.detect_unflow_list)
+        loader.add_constructor('tag:yaml.org,2002:map', cls.detect_ordered_dict)
+
+
+class CustomDumper(CustomDumperMixin, yaml.Dumper): pass
+class CustomLoader(CustomLoaderMixin, yaml.Loader): pass
+
+
+class StreamDumper(CustomDumper):
+
+    def expect_document_start(self, first=False):
+        # every document is emitted as the first one, so no '---' separators appear
+        super().expect_document_start(first=True)
+
+
+YAML_BACKENDS = {
+    'python': (CustomLoader, CustomDumper),
+}
+
+if yaml.__with_libyaml__:
+    class CustomCDumper(CustomDumperMixin, yaml.CDumper): pass
+    class CustomCLoader(CustomLoaderMixin, yaml.CLoader): pass
+
+    YAML_BACKENDS['c'] = (CustomCLoader, CustomCDumper)
+
+for loader, dumper in YAML_BACKENDS.values():
+    CustomLoaderMixin.register(loader)
+    CustomDumperMixin.register(dumper)
+
+DEFAULT_YAML_BACKEND = 'c' if 'c' in YAML_BACKENDS else 'python'
+yaml_backend = DEFAULT_YAML_BACKEND
+
+def set_yaml_backend(name):
+    global yaml_backend
+
+    if name == 'auto':
+        name = DEFAULT_YAML_BACKEND
+    if name not in YAML_BACKENDS:
+        raise ValueError('yaml backend {} is not available'.format(name))
+    yaml_backend = name
+
+
+class FastYamlEmitter:
+
+    BLOCK_TYPES = {0x0A0D0D0A, 0x00000001, 0x00000005, 0x00000006}
+
+    OPTIONS = {
+        'opt_comment', 'shb_hardware', 'shb_os', 'shb_userappl',
+        'if_name', 'if_description', 'if_tsresol', 'if_filter', 'if_os',
+        'ebp_flags', 'ebp_hash', 'epb_dropcount',
+        'isb_starttime', 'isb_endtime', 'isb_ifrecv', 'isb_ifdrop',
+    }
+
+    # strings which are surely emitted as plain scalars: no spaces or indicators
+    # and not resolvable to bool or null
+    PLAIN_STR = re.compile(r'[A-Za-z_][A-Za-z0-9_]*\Z')
+    RESERVED_STR = {
+        'yes', 'Yes', 'YES', 'no', 'No', 'NO',
+        'true', 'True', 'TRUE', 'false', 'False', 'FALSE',
+        'on', 'On', 'ON', 'off', 'Off', 'OFF',
+        'null', 'Null', 'NULL',
+    }
+
+    HEX_BYTES = [hex(x) for x in range(256)]
+
+    class Unsupported(Exception): pass
+
+    def __init__(self, width=80):
+        self.width = width
+
+    def emit(self, info):
+        if type(info) is not OrderedDict or info.get('block_type') not in self.BLOCK_TYPES:
+            return None
+
+        options = info.get('options')
+        if options is not None and not (isinstance(options, dict) and self.OPTIONS.issuperset(options)):
+            return None
+
+        lines = []
+        try:
+            self.__mapping(lines, info, 0, '')
+        except FastYamlEmitter.Unsupported:
+            return None
+
+        lines.append('')
+        return '\n'.join(lines)
+
+    def __mapping(self, lines, mapping, indent, prefix):
+        if type(mapping) is OrderedDict or isinstance(mapping, HeaderRecord):
+            items = mapping.items()
+        else:
+            items = sorted(mapping.items())
+        if len(items) == 0:
+            raise FastYamlEmitter.Unsupported()
+
+        for key, value in items:
+            if type(key) is not str or self.PLAIN_STR.match(key) is None or key in self.RESERVED_STR:
+                raise FastYamlEmitter.Unsupported()
+
+            if prefix is None:
+                prefix = ' ' * indent
+            self.__value(lines, prefix + key + ':', value, indent)
+            prefix = None
+
+    def __value(self, lines, head, value, indent):
+        value_type = type(value)
+        if value_type is OrderedDict or value_type is dict or isinstance(value, HeaderRecord):
+            lines.append(head)
+            self.__mapping(lines, value, indent + 2, None)
+        elif value_type is UnflowList:
+            if len(value) == 0:
+                raise FastYamlEmitter.Unsupported()
+            lines.append(head)
+            for item in value:
+                self.__sequence_item(lines, item, indent)
+        elif value_type is list or value_type is bytes or value_type is memoryview or value_type is DecimalBytes:
+            self.__flow_sequence(lines, head + ' [', value, indent + 2)
+        elif (value_type is HexPayload or value_type is HexDumpPayload) and len(value) > 0:
+            lines.append(head + ' !hex |')
+            prefix = ' ' * (indent + 2)
+            lines.extend(prefix + x for x in value.to_text().splitlines())
+        else:
+            lines.append(head + ' ' + self.__scalar(value))
+
+    def __sequence_item(self, lines, item, indent):
+        prefix = ' ' * indent + '- '
+        item_type = type(item)
+        if item_type is OrderedDict or item_type is dict:
+            self.__mapping(lines, item, indent + 2, prefix)
+        elif item_type is list or item_type is bytes or item_type is memoryview or item_type is DecimalBytes:
+            self.__flow_sequence(lines, prefix + '[', item, indent + 2)
+        else:
+            lines.append(prefix + self.__scalar(item))
+
+    def __flow_sequence(self, lines, line, items, indent):
+        if len(items) == 0:
+            raise FastYamlEmitter.Unsupported()
+
+        if type(items) is list:
+            items = [self.__scalar(x) for x in items]
+        elif type(items) is DecimalBytes:
+            items = [str(x) for x in items]
+        else:
+            items = [self.HEX_BYTES[x] for x in items]
+
+        # mirrors yaml.Emitter: a line is broken after a comma once it exceeds the width
+        parts = [line]
+        column = len(line)
+        whitespace = True
+        for item in items:
+            if not whitespace:
+                parts.append(',')
+                column += 1
+            if column > self.width:
+                lines.append(''.join(parts))
+                parts.clear()
+                parts.append(' ' * indent)
+                column = indent
+                whitespace = True
+            if not whitespace:
+                parts.append(' ')
+                column += 1
+            parts.append(item)
+            column += len(item)
+            whitespace = False
+        parts.append(']')
+        lines.append(''.join(parts))
+
+    def __scalar(self, value):
+        value_type = type(value)
+        if value_type is HexInt:
+            return hex(value)
+        elif value_type is int:
+            return str(value)
+        elif value_type is datetime.datetime or value_type is Timestamp:
+            return value.isoformat(' ')
+        elif value_type is str and self.PLAIN_STR.match(value) is not None and value not in self.RESERVED_STR:
+            return value
+        raise FastYamlEmitter.Unsupported()
+
+
+class FastYamlParser:
+
+    KEY = re.compile(r'([A-Za-z_][A-Za-z0-9_]*):(?: +(.*?))? *\Z')
+    HEX_INT = re.compile(r'0x[0-9a-fA-F]+\Z')
+    DEC_INT = re.compile(r'-?(?:0|[1-9][0-9]*)\Z')
+    TIMESTAMP = re.compile(r'([0-9]{4})-([0-9]{2})-([0-9]{2}) ([0-9]{2}):([0-9]{2}):([0-9]{2})(?:\.([0-9]{1,9}))?\Z')
+
+    class Unsupported(Exception): pass
+
+    def parse(self, lines):
+        self.__lines = lines
+        self.__pos = 0
+
+        try:
+            info = self.__mapping(0, None)
+            if self.__pos != len(lines):
+                raise FastYamlParser.Unsupported()
+        except FastYamlParser.Unsupported:
+            return None
+        finally:
+            self.__lines = None
+
+        return info
+
+    def __next_line(self):
+        line = self.__lines[self.__pos]
+        text = line.lstrip(' ')
+        return len(line) - len(text), text.rstrip(' ')
+
+    def __mapping(self, indent, first):
+        info = OrderedDict()
+
+        while True:
+            if first is not None:
+                text, first = first, None
+            elif self.__pos < len(self.__lines):
+                line_indent, text = self.__next_line()
+                if line_indent < indent:
+                    break
+                if line_indent > indent:
+                    raise FastYamlParser.Unsupported()
+                self.__pos += 1
+            else:
+                break
+
+            match = self.KEY.match(text)
+            if match is None:
+                raise FastYamlParser.Unsupported()
+
+            key, value = match.groups()
+            if value:
+                info[key] = self.__inline(value, indent)
+            else:
+                info[key] = self.__nested(indent)
+
+        return info
+
+    def __nested(self, indent):
+        if self.__pos == len(self.__lines):
+            raise FastYamlParser.Unsupported()
+
+        line_indent, text = self.__next_line()
+        if line_indent == indent and text.startswith('- '):
+            return self.__sequence(indent)
+        elif line_indent > indent:
+            return self.__mapping(line_indent, None)
+
+        raise FastYamlParser.Unsupported()
+
+    def __sequence(self, indent):
+        items = UnflowList()
+
+        while self.__pos < len(self.__lines):
+            line_indent, text = self.__next_line()
+            if line_indent != indent or not text.startswith('- '):
+                if line_indent > indent:
+                    raise FastYamlParser.Unsupported()
+                break
+            self.__pos += 1
+
+            item = text[1:].lstrip(' ')
+            if self.KEY.match(item):
+                items.append(self.__mapping(indent + len(text) - len(item), item))
+            else:
+                items.append(self.__inline(item, indent))
+
+        return items
+
+    def __inline(self, text, indent):
+        if text.startswith('['):
+            return self.__flow_sequence(text, indent)
+        elif text == '!hex |':
+            return self.__hex_payload(indent)
+        return self.__scalar(text)
+
+    def __hex_payload(self, indent):
+        lines = []
+        while self.__pos < len(self.__lines):
+            line_indent, text = self.__next_line()
+            if line_indent <= indent:
+                break
+            self.__pos += 1
+            lines.append(text)
+
+        try:
+            return HexPayload.from_text('\n'.join(lines))
+        except ValueError:
+            raise FastYamlParser.Unsupported()
+
+    def __flow_sequence(self, text, indent):
+        parts = [text]
+        while not text.endswith(']'):
+            if self.__pos == len(self.__lines):
+                raise FastYamlParser.Unsupported()
+            line_indent, text = self.__next_line()
+            if line_indent <= indent:
+                raise FastYamlParser.Unsupported()
+            self.__pos += 1
+            parts.append(text)
+
+        inner = ' '.join(parts)[1:-1]
+        if '[' in inner or ']' in inner:
+            raise FastYamlParser.Unsupported()
+        if len(inner.strip()) == 0:
+            return []
+        return [self.__scalar(x.strip()) for x in inner.split(',')]
+
+    def __scalar(self, text):
+        if self.HEX_INT.match(text):
+            return HexInt(int(text, 16))
+        if self.DEC_INT.match(text):
+            return int(text)
+
+        match = self.TIMESTAMP.match(text)
+        if match is not None:
+            values = [int(x) for x in match.groups()[:6]]
+            fraction = match.group(7)
+            try:
+                if fraction is not None and len(fraction) > 6:
+                    return parse_timestamp(text)
+                return datetime.datetime(*values, int(fraction.ljust(6, '0')) if fraction else 0)
+            except ValueError:
+                raise FastYamlParser.Unsupported()
+
+        if FastYamlEmitter.PLAIN_STR.match(text) and text not in FastYamlEmitter.RESERVED_STR:
+            return text
+
+        raise FastYamlParser.Unsupported()
 
 
 class InterfaceParam:
 
-    tsresol = 10 ** -6
+    tsresol = MICROSECONDS
     link_type = 1
 
 class BaseWorker:
 
-    def __init__(self, input_file, is_binary_input, output_file, target_ext, is_binary_output):
+    def __init__(self, input_file, is_binary_input, output_file, target_ext, is_binary_output,
+                 payload_format=None, use_mmap=False, lazy=False, output_format=None):
+        # the yaml side can be replaced by binary blocks, the input is told by its magic
+        self._is_binary_blocks_input = not is_binary_input and is_binary_blocks_file(input_file)
+        self._is_binary_blocks_output = not is_binary_output and is_binary_blocks_output(
+            output_file, output_format, self._is_binary_blocks_input)
+        if self._is_binary_blocks_output:
+            target_ext = BINARY_BLOCKS_EXT
+        is_binary_input = is_binary_input or self._is_binary_blocks_input
+        is_binary_output = is_binary_output or self._is_binary_blocks_output
+
         if input_file is not None and output_file is None:
-            input_file_pair = os.path.splitext(input_file)
-            output_file = input_file_pair[0] + target_ext
+            # the derived output is compressed like the input
+            input_base, compression_ext = split_compression_ext(input_file)
+            input_file_pair = os.path.splitext(input_base)
+            output_file = input_file_pair[0] + target_ext + compression_ext
 
             if input_file == output_file:
-                bkup_file = input_file_pair[0] + '_bkup' + input_file_pair[1]
+                bkup_file = input_file_pair[0] + '_bkup' + input_file_pair[1] + compression_ext
                 shutil.copyfile(input_file, bkup_file)
                 input_file = bkup_file
 
@@ -108,24 +776,47 @@ class BaseWorker:
             output_file = '-'
 
         if input_file != '-':
-            self._input_file = open(input_file, 'r' + ('b' if is_binary_input else ''))
+            self._input_file = open_input(input_file, is_binary_input, BUFFER_SIZE)
         else:
-            self._input_file = sys.stdin
+            self._input_file = binary_stdin()
+            if not is_binary_input:
+                self._input_file = sys.stdin if self._input_file is sys.stdin.buffer \
+                    else io.TextIOWrapper(self._input_file)
 
         if output_file != '-':
-            self._output_file = open(output_file, 'w' + ('b' if is_binary_output else ''))
+            self._output_file = open_output(output_file, is_binary_output, BUFFER_SIZE)
         else:
-            self._output_file = sys.stdout
-
-        if is_binary_input:
-            self._reader = StructReader(self._input_file)
+            self._output_file = sys.stdout.buffer if is_binary_output else sys.stdout
+
+        self._mmap = None
+        if is_binary_input and use_mmap and not self._is_binary_blocks_input \
+                and self._input_file is not sys.stdin.buffer:
+            try:
+                self._mmap = mmap.mmap(self._input_file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                pass # empty or compressed file, read as a stream
+
+        if self._is_binary_blocks_input:
+            from wiregr.binary_blocks import BinaryBlockReader
+            self._reader = BinaryBlockReader(self._input_file)
+        elif is_binary_input:
+            from wiregr.pcap_reader import PcapBlockReader
+            if self._mmap is not None:
+                self.__struct_reader = BufferReader(self._mmap)
+            else:
+                self.__struct_reader = BlockStreamReader(self._input_file)
+            self._reader = PcapBlockReader(self.__struct_reader, lazy)
         else:
             self._reader = YamlReader(self._input_file)
 
-        if is_binary_output:
-            self._writer = StructWriter(self._output_file)
+        if self._is_binary_blocks_output:
+            from wiregr.binary_blocks import BinaryBlockWriter
+            self._writer = BinaryBlockWriter(self._output_file, payload_format)
+        elif is_binary_output:
+            from wiregr.pcap_writer import PcapBlockWriter
+            self._writer = PcapBlockWriter(self._output_file)
         else:
-            self._writer = YamlWriter(self._output_file)
+            self._writer = YamlWriter(self._output_file, payload_format)
 
 
     def __enter__(self):
@@ -133,13 +824,29 @@ class BaseWorker:
 
 
     def __exit__(self, type, value, traceback):
-        if self._input_file != sys.stdin:
+        self._writer.close()
+        if self._mmap is not None:
+            self.__struct_reader.buffer.release()
+            try:
+                self._mmap.close()
+            except BufferError:
+                pass # some payload views are still alive, gc will unmap it
+        if self._input_file not in (sys.stdin, sys.stdin.buffer):
             self._input_file.close()
-        if self._output_file != sys.stdout:
+        if self._output_file not in (sys.stdout, sys.stdout.buffer):
             self._output_file.close()
+        else:
+            self._output_file.flush()
+
+
+class PcapCodec:
+
+    def __init__(self):
+        self._configure_endianess(MAGIC)
 
     def _configure_endianess(self, magic):
         prefix = '>' if magic == MAGIC else '<'
+        self.byte_order = prefix
         self.fmt_uint8 = prefix + 'B'
         self.fmt_uint16 = prefix + 'H'
         self.fmt_uint32 = prefix + 'L'
@@ -150,6 +857,8 @@ class YamlReader:
 
     def __init__(self, stream):
         self.stream = stream
+        self.loader = YAML_BACKENDS[yaml_backend][0]
+        self.__fast_parser = FastYamlParser()
 
     def read(self):
         lines = []
@@ -164,9 +873,35 @@ class YamlReader:
 
         yield from self.__parse_block(lines)
 
+    def read_block(self):
+        lines = []
+        for line in iter(self.stream.readline, ''):
+            line = line.strip('\n\r')
+            if len(line) > 0:
+                lines.append(line)
+            elif len(lines) > 0:
+                break
+
+        return next(self.__parse_block(lines), None)
+
+    def seek(self, offset):
+        # offsets are in bytes, as found by the block scan, while a text stream seeks to opaque cookies,
+        # so the text stream drops its decoded read-ahead at the start and its binary buffer is moved
+        buffer = getattr(self.stream, 'buffer', None)
+        if buffer is None or not self.stream.seekable():
+            raise io.UnsupportedOperation('yaml input has to be a seekable file to jump to a block')
+        self.stream.seek(0)
+        buffer.seek(offset)
+
+    def seek_block(self, index, number):
+        # yaml blocks do not depend on each other, so jumping to the block offset is enough
+        self.seek(index.offsets[number] if number < len(index) else index.end_offset)
+
     def __parse_block(self, lines):
         if len(lines) > 0:
-            info = yaml.load('\n'.join(lines), Loader=CustomLoader)
+            info = self.__fast_parser.parse(lines)
+            if info is None:
+                info = yaml.load('\n'.join(lines), Loader=self.loader)
             yield info
 
         lines.clear()
@@ -174,11 +909,39 @@ class YamlReader:
 
 class YamlWriter:
 
-    def __init__(self, stream):
+    def __init__(self, stream, payload_format=None):
         self.stream = stream
+        self.payload_format = payload_format
+        self.dumper = YAML_BACKENDS[yaml_backend][1]
+        self.__fast_emitter = FastYamlEmitter()
+        self.__stream_dumper = None
+
+        # libyaml always separates documents with '---', so only the pure-python
+        # emitter can be kept alive between blocks
+        if self.dumper is CustomDumper:
+            self.__stream_dumper = StreamDumper(self.stream)
+            self.__stream_dumper.open()
 
     def write(self, info):
-        print(yaml.dump(info, Dumper=CustomDumper), file=self.stream)
+        if not isinstance(info, dict):
+            info = info.materialize()
+
+        if self.payload_format is not None and 'unknown_payload' in info:
+            info['unknown_payload'] = encode_payload(info['unknown_payload'], self.payload_format)
+
+        text = self.__fast_emitter.emit(info)
+        if text is not None:
+            self.stream.write(text + '\n')
+        elif self.__stream_dumper is not None:
+            self.__stream_dumper.represent(info)
+            self.stream.write('\n')
+        else:
+            self.stream.write(yaml.dump(info, Dumper=self.dumper) + '\n')
+
+    def close(self):
+        if self.__stream_dumper is not None:
+            self.__stream_dumper.close()
+            self.__stream_dumper = None
 
 
 class StructReader:
@@ -190,9 +953,107 @@ class StructReader:
         block = self.stream.read(struct.calcsize(fmt))
         return struct.unpack(fmt, block)[0]
 
+    def read_struct(self, fmt):
+        return fmt.unpack(self.stream.read(fmt.size))
+
     def read_bytes(self, size):
         return self.stream.read(size)
 
+    def tell(self):
+        return self.stream.tell()
+
+    def seek(self, offset, whence=ABSOLUTE):
+        self.stream.seek(offset, whence)
+
+
+class BufferReader:
+
+    def __init__(self, buffer, offset=0):
+        self.buffer = memoryview(buffer)
+        self.offset = offset
+
+    def read_fmt(self, fmt):
+        value = struct.unpack_from(fmt, self.buffer, self.offset)[0]
+        self.offset += struct.calcsize(fmt)
+        return value
+
+    def read_struct(self, fmt):
+        value = fmt.unpack_from(self.buffer, self.offset)
+        self.offset += fmt.size
+        return value
+
+    def read_bytes(self, size):
+        value = self.buffer[self.offset:self.offset + size]
+        self.offset += len(value)
+        return value
+
+    def tell(self):
+        return self.offset
+
+    def seek(self, offset, whence=ABSOLUTE):
+        if whence == RELATIVE:
+            offset += self.offset
+        elif whence == FROM_END:
+            offset += len(self.buffer)
+        self.offset = offset
+
+
+class BlockStreamReader(BufferReader):
+
+    # Reads pcapng blocks one at a time by their block_total_length and parses them from memory, so
+    # nothing is seeked in the stream itself and pipes work. Offsets stay absolute stream offsets.
+
+    BLOCK_START = struct.Struct('>LLL')
+
+    def __init__(self, stream):
+        super().__init__(b'')
+        self.stream = stream
+        self.position = 0
+        self.byte_order = '>'
+
+    def read_bytes(self, size):
+        # every block starts with reading its type, so only this read can run past the buffered block
+        self.__fill()
+        return super().read_bytes(size)
+
+    def tell(self):
+        return self.position + self.offset
+
+    def seek(self, offset, whence=ABSOLUTE):
+        if whence == FROM_END:
+            raise io.UnsupportedOperation('seek from the end of a block stream')
+        super().seek(offset - self.position if whence == ABSOLUTE else offset, whence)
+        if not 0 <= self.offset <= len(self.buffer):
+            # outside of the buffered block, only seekable streams can get there
+            self.stream.seek(self.position + self.offset)
+            self.position += self.offset
+            self.buffer = memoryview(b'')
+            self.offset = 0
+
+    def __fill(self):
+        if self.offset < len(self.buffer):
+            return
+
+        self.position += len(self.buffer)
+        self.buffer = memoryview(b'')
+        self.offset = 0
+
+        start = self.stream.read(self.BLOCK_START.size)
+        if len(start) == 0:
+            return
+        if len(start) < self.BLOCK_START.size:
+            raise EOFError('truncated block at offset {}'.format(self.position))
+
+        block_type, _, magic = self.BLOCK_START.unpack(start)
+        if block_type == 0x0A0D0D0A:
+            self.byte_order = '>' if magic == MAGIC else '<'
+        length = struct.unpack_from(self.byte_order + 'L', start, 4)[0]
+
+        block = start + self.stream.read(length - len(start))
+        if len(block) < length:
+            raise EOFError('truncated block at offset {}'.format(self.position))
+        self.buffer = memoryview(block)
+
 
 class StructWriter:
 
@@ -202,43 +1063,136 @@ class StructWriter:
     def pack_fmt(self, fmt, value):
         self.stream.write(struct.pack(fmt, value))
 
+    def pack_struct(self, fmt, *values):
+        self.stream.write(fmt.pack(*values))
+
     def pack_bytes(self, value):
         if not isinstance(value, bytes):
             value = bytes(value)
         self.stream.write(value)
 
+    def close(self):
+        pass
+
     def pack_payload(self, value):
-        payload = []
-        for x in value:
-            if isinstance(x, int):
-                payload.append(x)
-            elif isinstance(x, str):
-                payload.extend(x.encode('utf-8'))
-        payload = bytes(payload)
+        self.stream.write(payload_bytes(value))
 
-        self.stream.write(payload)
+class BufferWriter(StructWriter):
 
-def align_value(value, multiplier):
-    if value % multiplier == 0:
+    def __init__(self, size=2048):
+        self.buffer = bytearray(size)
+        self.offset = 0
+
+    def reset(self):
+        self.offset = 0
+
+    def tell(self):
+        return self.offset
+
+    def getbuffer(self):
+        return memoryview(self.buffer)[:self.offset]
+
+    def pack_fmt(self, fmt, value):
+        self.pack_bytes(struct.pack(fmt, value))
+
+    def pack_struct(self, fmt, *values):
+        self.__reserve(fmt.size)
+        fmt.pack_into(self.buffer, self.offset, *values)
+        self.offset += fmt.size
+
+    def pack_bytes(self, value):
+        if not isinstance(value, (bytes, bytearray, memoryview)):
+            value = bytes(value)
+        self.__reserve(len(value))
+        self.buffer[self.offset:self.offset + len(value)] = value
+        self.offset += len(value)
+
+    def pack_payload(self, value):
+        self.pack_bytes(payload_bytes(value))
+
+    def __reserve(self, size):
+        if self.offset + size > len(self.buffer):
+            self.buffer.extend(bytes(max(self.offset + size, 2 * len(self.buffer)) - len(self.buffer)))
+
+
+def is_pcapng_output(output_file, is_binary_input):
+    if output_file is not None and output_file != '-':
+        return os.path.splitext(split_compression_ext(output_file)[0])[1] == '.pcapng'
+    return is_binary_input
+
+
+def is_pcapng_file(file_name):
+    return file_starts_with(file_name, SHB_MAGIC)
+
+
+def is_binary_blocks_file(file_name):
+    return file_starts_with(file_name, BINARY_BLOCKS_MAGIC)
+
+
+def is_binary_blocks_output(output_file, output_format, is_binary_blocks_input):
+    if output_format is not None:
+        return output_format == 'binary'
+    if output_file is not None and output_file != '-':
+        return os.path.splitext(split_compression_ext(output_file)[0])[1] == BINARY_BLOCKS_EXT
+    return is_binary_blocks_input
+
+
+# sys.stdin.buffer and the stream of its decompressed data
+_stdin = None
+
+def binary_stdin():
+    # compressed stdin is opened once, so the format detection and the reader share the stream
+    global _stdin
+    if _stdin is None or _stdin[0] is not sys.stdin.buffer or _stdin[1].closed:
+        _stdin = (sys.stdin.buffer, open_stdin(sys.stdin.buffer, BUFFER_SIZE))
+    return _stdin[1]
+
+
+def file_starts_with(file_name, magic):
+    if file_name is None or file_name == '-':
+        # peeking leaves the bytes buffered for whichever of the binary or text stdin reads them
+        return binary_stdin().peek(len(magic))[:len(magic)] == magic
+    return peek_input(file_name, len(magic)) == magic
+
+
+def payload_bytes(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
         return value
-    return value // multiplier * multiplier + multiplier
 
+    payload = []
+    for x in value:
+        if isinstance(x, int):
+            payload.append(x)
+        elif isinstance(x, str):
+            payload.extend(x.encode('utf-8'))
+    return bytes(payload)
 
-def calc_carry_add_checksum(stream):
-    result = 0
-    stream.seek(0, ABSOLUTE)
 
-    while True:
-        block = stream.read(2)
+def payload_length(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return len(value)
 
-        if len(block) == 2:
-            result = result + (block[0] << 8) + block[1]
-        elif len(block) == 1:
-            result = result + (block[0] << 8)
-        else:
-            break
+    length = 0
+    for x in value:
+        if isinstance(x, int):
+            length += 1
+        elif isinstance(x, str):
+            length += len(x.encode('utf-8'))
+    return length
+
+
+def encode_payload(value, payload_format):
+    if payload_format == 'list':
+        return bytes(value) if isinstance(value, HexPayload) else value
+
+    payload_type = PAYLOAD_FORMATS[payload_format]
+    if type(value) is payload_type:
+        return value
+    return payload_type(payload_bytes(value))
 
-        result = (result & 0xffff) + (result >> 16)
 
-    return ~result & 0xFFFF
+def align_value(value, multiplier):
+    if value % multiplier == 0:
+        return value
+    return value // multiplier * multiplier + multiplier
 
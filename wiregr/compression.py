@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This Source Code Form is subject to the terms of the
+# Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+# with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import bz2
+import gzip
+import io
+import lzma
+import os
+import queue
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# data goes between the codec thread and the parser or writer in chunks of this size
+CHUNK_SIZE = 1 << 20
+# chunks waiting between the threads, bounds the memory used
+QUEUE_SIZE = 4
+
+
+def open_gzip(file_name, mode):
+    # level of the gzip tool, the default 9 is several times slower for a few percent
+    return gzip.open(file_name, mode, compresslevel=6)
+
+
+def open_zstd(file_name, mode):
+    if zstandard is None:
+        raise ValueError('{} needs the zstandard module'.format(file_name))
+    return zstandard.open(file_name, mode)
+
+
+# (extensions, magic, opener of the binary codec stream)
+CODECS = [
+    (('.gz',), b'\x1f\x8b', open_gzip),
+    (('.bz2',), b'BZh', bz2.open),
+    (('.xz',), b'\xfd7zXZ\x00', lzma.open),
+    (('.zst',), b'\x28\xb5\x2f\xfd', open_zstd),
+]
+
+
+def split_compression_ext(file_name):
+    base, ext = os.path.splitext(file_name)
+    if any(ext in x[0] for x in CODECS):
+        return base, ext
+    return file_name, ''
+
+
+def input_codec(file_name):
+    with open(file_name, 'rb') as stream:
+        head = stream.read(8)
+    return next((x for x in CODECS if head.startswith(x[1])), None)
+
+
+def output_codec(file_name):
+    ext = split_compression_ext(file_name)[1]
+    return next((x for x in CODECS if ext in x[0]), None)
+
+
+def peek_input(file_name, size):
+    # the first bytes of the data inside of a compressed file
+    codec = input_codec(file_name)
+    with (open(file_name, 'rb') if codec is None else codec[2](file_name, 'rb')) as stream:
+        return stream.read(size)
+
+
+def open_stdin(stream, buffer_size):
+    # stdin is told only by its magic, peeking keeps the bytes buffered for the codec
+    head = stream.peek(8)
+    codec = next((x for x in CODECS if head.startswith(x[1])), None)
+    if codec is None:
+        return stream
+    return io.BufferedReader(ThreadedDecompressor(codec[2](stream, 'rb')), buffer_size)
+
+
+def open_input(file_name, binary, buffer_size):
+    codec = input_codec(file_name)
+    if codec is None:
+        return open(file_name, 'rb' if binary else 'r', buffer_size)
+
+    stream = io.BufferedReader(ThreadedDecompressor(codec[2](file_name, 'rb')), buffer_size)
+    return stream if binary else io.TextIOWrapper(stream)
+
+
+def open_output(file_name, binary, buffer_size):
+    codec = output_codec(file_name)
+    if codec is None:
+        return open(file_name, 'wb' if binary else 'w', buffer_size)
+
+    stream = io.BufferedWriter(ThreadedCompressor(codec[2](file_name, 'wb')), buffer_size)
+    return stream if binary else io.TextIOWrapper(stream)
+
+
+class ThreadedDecompressor(io.RawIOBase):
+
+    # Reads the codec stream in a background thread. The codecs release the GIL while they work,
+    # so decompression of the next chunks overlaps with parsing of the current one.
+
+    def __init__(self, stream):
+        self.__stream = stream
+        self.__chunks = queue.Queue(QUEUE_SIZE)
+        self.__chunk = memoryview(b'')
+        self.__done = False
+        self.__stop = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while len(self.__chunk) == 0:
+            if self.__done:
+                return 0
+
+            chunk = self.__chunks.get()
+            if chunk is None or isinstance(chunk, BaseException):
+                self.__done = True
+                if chunk is not None:
+                    raise chunk
+                return 0
+            self.__chunk = memoryview(chunk)
+
+        size = min(len(buffer), len(self.__chunk))
+        buffer[:size] = self.__chunk[:size]
+        self.__chunk = self.__chunk[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.__stop.set()
+            self.__thread.join()
+            self.__stream.close()
+        super().close()
+
+    def __run(self):
+        try:
+            while True:
+                chunk = self.__stream.read(CHUNK_SIZE)
+                if not self.__put(chunk or None) or not chunk:
+                    break
+        except BaseException as ex:
+            self.__put(ex)
+
+    def __put(self, item):
+        # gives up once the reader is closed, it does not take the chunks any more
+        while not self.__stop.is_set():
+            try:
+                self.__chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+
+class ThreadedCompressor(io.RawIOBase):
+
+    # Compresses and writes the chunks in a background thread, overlapping with the emitting
+    # of the next blocks. Errors of the thread are raised by the following write or close.
+
+    def __init__(self, stream):
+        self.__stream = stream
+        self.__chunks = queue.Queue(QUEUE_SIZE)
+        self.__error = None
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.__put(bytes(data))
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+
+        try:
+            self.__put(None)
+            self.__thread.join()
+            if self.__error is not None:
+                raise self.__error
+        finally:
+            self.__stream.close()
+            super().close()
+
+    def __run(self):
+        try:
+            while True:
+                chunk = self.__chunks.get()
+                if chunk is None:
+                    break
+                self.__stream.write(chunk)
+        except BaseException as ex:
+            self.__error = ex
+
+    def __put(self, item):
+        while True:
+            if self.__error is not None:
+                raise self.__error
+            try:
+                self.__chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
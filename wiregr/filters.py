@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This Source Code Form is subject to the terms of the
+# Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+# with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import re
+
+from wiregr.blocks import BLOCK_TYPE_EPB
+from wiregr.packets import *
+
+# Packet filter expressions, a small mix of the tcpdump and wireshark syntax:
+#
+#   udp and dst port 5004 and ip.src == 10.0.0.1
+#   tcp and (src port 554 or tcp.flags & 0x02 != 0)
+#   not host 192.168.1.2 || frame.len > 1000
+#
+# The expression is compiled once into two python functions, one peeking at fixed offsets of the
+# captured bytes, so packets of a lazy reader are skipped before any layer is decoded, and one
+# looking at decoded blocks read from yaml. A comparison on a field the packet does not have is false.
+
+ETHERNET_OFFSET = 0
+IPV4_OFFSET = ETHERNET_OFFSET + ETHERNET_HEADER.size
+TRANSPORT_OFFSET = IPV4_OFFSET + IPV4_HEADER.size # the decoder reads ipv4 headers without options
+
+# layer -> (enclosing layer, field selecting it in the enclosing layer, its value, end of the fixed header)
+LAYERS = {
+    'ethernet_data': (None, None, LINKTYPE_ETHERNET, IPV4_OFFSET),
+    'ipv4_data': ('ethernet_data', 'eth.type', TYPE_IPV4, TRANSPORT_OFFSET),
+    'tcp_data': ('ipv4_data', 'ip.proto', PROTOCOL_TCP, TRANSPORT_OFFSET + TCP_HEADER.size),
+    'udp_data': ('ipv4_data', 'ip.proto', PROTOCOL_UDP, TRANSPORT_OFFSET + UDP_HEADER.size),
+}
+
+LAYER_NAMES = {
+    'eth': 'ethernet_data',
+    'ip': 'ipv4_data',
+    'tcp': 'tcp_data',
+    'udp': 'udp_data',
+}
+
+# field -> (layer, key, header codec, offset of the header, value bits of bit fields)
+FIELDS = {
+    'frame.len': (None, 'captured_length', None, None, None),
+    'eth.type': ('ethernet_data', 'type', ETHERNET_HEADER, ETHERNET_OFFSET, None),
+    'ip.src': ('ipv4_data', 'source', IPV4_HEADER, IPV4_OFFSET, None),
+    'ip.dst': ('ipv4_data', 'destination', IPV4_HEADER, IPV4_OFFSET, None),
+    'ip.proto': ('ipv4_data', 'protocol', IPV4_HEADER, IPV4_OFFSET, None),
+    'ip.ttl': ('ipv4_data', 'ttl', IPV4_HEADER, IPV4_OFFSET, None),
+    'ip.len': ('ipv4_data', 'total_length', IPV4_HEADER, IPV4_OFFSET, None),
+    'ip.id': ('ipv4_data', 'identification', IPV4_HEADER, IPV4_OFFSET, None),
+    'tcp.srcport': ('tcp_data', 'source_port', TCP_HEADER, TRANSPORT_OFFSET, None),
+    'tcp.dstport': ('tcp_data', 'destination_port', TCP_HEADER, TRANSPORT_OFFSET, None),
+    'tcp.seq': ('tcp_data', 'seq_num', TCP_HEADER, TRANSPORT_OFFSET, None),
+    'tcp.ack': ('tcp_data', 'ack_num', TCP_HEADER, TRANSPORT_OFFSET, None),
+    'tcp.flags': ('tcp_data', 'flags', TCP_HEADER, TRANSPORT_OFFSET, 9),
+    'tcp.window': ('tcp_data', 'window_size', TCP_HEADER, TRANSPORT_OFFSET, None),
+    'udp.srcport': ('udp_data', 'source_port', UDP_HEADER, TRANSPORT_OFFSET, None),
+    'udp.dstport': ('udp_data', 'destination_port', UDP_HEADER, TRANSPORT_OFFSET, None),
+    'udp.length': ('udp_data', 'length', UDP_HEADER, TRANSPORT_OFFSET, None),
+}
+
+# fields kept as lists of bytes in decoded blocks
+ADDRESS_FIELDS = ('ip.src', 'ip.dst')
+
+# fields matching when any of their members does
+ALIASES = {
+    'ip.addr': ('ip.src', 'ip.dst'),
+    'tcp.port': ('tcp.srcport', 'tcp.dstport'),
+    'udp.port': ('udp.srcport', 'udp.dstport'),
+}
+
+# tcpdump style primitives, [src|dst] host and [src|dst] port
+PRIMITIVE_FIELDS = {
+    ('host', None): ('ip.src', 'ip.dst'),
+    ('host', 'src'): ('ip.src',),
+    ('host', 'dst'): ('ip.dst',),
+    ('port', None): ('tcp.srcport', 'tcp.dstport', 'udp.srcport', 'udp.dstport'),
+    ('port', 'src'): ('tcp.srcport', 'udp.srcport'),
+    ('port', 'dst'): ('tcp.dstport', 'udp.dstport'),
+}
+
+OPERATORS = ('==', '!=', '<=', '>=', '<', '>')
+
+TOKEN_RE = re.compile(r'''\s*(?:
+    (?P<address>\d+\.\d+\.\d+\.\d+) |
+    (?P<number>0[xX][0-9a-fA-F]+|\d+) |
+    (?P<name>[A-Za-z_][A-Za-z0-9_.]*) |
+    (?P<operator>==|!=|<=|>=|&&|\|\||[()<>!&])
+)''', re.VERBOSE)
+
+
+def tokenize(expression):
+    tokens = []
+    position = 0
+    expression = expression.rstrip()
+    while position < len(expression):
+        match = TOKEN_RE.match(expression, position)
+        if match is None:
+            raise ValueError('invalid filter at {!r}'.format(expression[position:].strip()))
+        position = match.end()
+        kind = match.lastgroup
+        text = match.group(kind)
+        if kind == 'address':
+            parts = [int(x) for x in text.split('.')]
+            if any(x > 255 for x in parts):
+                raise ValueError('invalid address {!r}'.format(text))
+            tokens.append(('value', int.from_bytes(bytes(parts), 'big')))
+        elif kind == 'number':
+            tokens.append(('value', int(text, 0)))
+        elif kind == 'name':
+            tokens.append(('name', text))
+        else:
+            tokens.append(('operator', text))
+    return tokens
+
+
+class FilterParser:
+
+    # recursive descent over the token list, the tree is made of tuples:
+    #   ('or', a, b), ('and', a, b), ('not', a), ('layer', key), ('compare', field, mask, operator, value)
+
+    def __init__(self, expression):
+        self.__tokens = tokenize(expression)
+        self.__position = 0
+
+    def parse(self):
+        if not self.__tokens:
+            raise ValueError('empty filter')
+        tree = self.__parse_or()
+        if self.__peek() is not None:
+            raise ValueError('unexpected {!r} in filter'.format(self.__peek()[1]))
+        return tree
+
+    def __peek(self):
+        if self.__position < len(self.__tokens):
+            return self.__tokens[self.__position]
+        return None
+
+    def __next(self):
+        token = self.__peek()
+        if token is None:
+            raise ValueError('unexpected end of filter')
+        self.__position += 1
+        return token
+
+    def __accept(self, *texts):
+        token = self.__peek()
+        if token is not None and token[0] != 'value' and token[1] in texts:
+            self.__position += 1
+            return True
+        return False
+
+    def __expect_value(self):
+        kind, value = self.__next()
+        if kind != 'value':
+            raise ValueError('expected a number or an address instead of {!r}'.format(value))
+        return value
+
+    def __parse_or(self):
+        tree = self.__parse_and()
+        while self.__accept('or', '||'):
+            tree = ('or', tree, self.__parse_and())
+        return tree
+
+    def __parse_and(self):
+        tree = self.__parse_not()
+        while self.__accept('and', '&&'):
+            tree = ('and', tree, self.__parse_not())
+        return tree
+
+    def __parse_not(self):
+        if self.__accept('not', '!'):
+            return ('not', self.__parse_not())
+        return self.__parse_primary()
+
+    def __parse_primary(self):
+        if self.__accept('('):
+            tree = self.__parse_or()
+            if not self.__accept(')'):
+                raise ValueError('missing closing parenthesis in filter')
+            return tree
+
+        kind, name = self.__next()
+        if kind != 'name':
+            raise ValueError('unexpected {!r} in filter'.format(name))
+
+        if name in ('src', 'dst', 'host', 'port'):
+            return self.__parse_primitive(name)
+        elif name in LAYER_NAMES:
+            tree = ('layer', LAYER_NAMES[name])
+            if name in ('tcp', 'udp') and self.__peek() in (('name', 'src'), ('name', 'dst'), ('name', 'port')):
+                # tcp port 80 is tcp and port 80, the generic port fields check the layer anyway
+                tree = ('and', tree, self.__parse_primitive(self.__next()[1], name))
+            return tree
+        elif name in FIELDS or name in ALIASES:
+            return self.__parse_compare(name)
+        raise ValueError('unknown filter field {!r}'.format(name))
+
+    def __parse_primitive(self, name, protocol=None):
+        direction = None
+        if name in ('src', 'dst'):
+            direction = name
+            kind, name = self.__next()
+            if name not in ('host', 'port'):
+                raise ValueError('expected host or port after {}'.format(direction))
+        if name == 'host' and protocol is not None:
+            raise ValueError('{} host is not supported, use {} and host'.format(protocol, protocol))
+
+        value = self.__expect_value()
+        fields = PRIMITIVE_FIELDS[(name, direction)]
+        if protocol is not None:
+            fields = [x for x in fields if x.startswith(protocol + '.')]
+        return self.__any(('compare', x, None, '==', value) for x in fields)
+
+    def __parse_compare(self, name):
+        mask = None
+        if self.__accept('&'):
+            mask = self.__expect_value()
+
+        kind, operator = self.__next()
+        if kind != 'operator' or operator not in OPERATORS:
+            raise ValueError('expected a comparison after {!r}'.format(name))
+        value = self.__expect_value()
+
+        if name not in ALIASES:
+            return ('compare', name, mask, operator, value)
+        elif operator == '!=':
+            # ip.addr != x means neither of the addresses is x, like in wireshark
+            return ('not', self.__any(('compare', x, mask, '==', value) for x in ALIASES[name]))
+        return self.__any(('compare', x, mask, operator, value) for x in ALIASES[name])
+
+    @staticmethod
+    def __any(trees):
+        trees = list(trees)
+        tree = trees[0]
+        for other in trees[1:]:
+            tree = ('or', tree, other)
+        return tree
+
+
+class PacketFilter:
+
+    def __init__(self, expression):
+        self.expression = expression
+        tree = FilterParser(expression).parse()
+
+        source = '\n'.join([
+            'def match_data(data, link_type):',
+            '    return ' + self.__data_source(tree),
+            '',
+            'def match_info(info):',
+            '    return ' + self.__info_source(tree),
+        ])
+
+        namespace = {}
+        exec(compile(source, '<filter>', 'exec'), namespace)
+        self.match_data = namespace['match_data']
+        self.match_info = namespace['match_info']
+
+    def match(self, info):
+        # only packets are filtered, the blocks they depend on always pass
+        if info['block_type'] != BLOCK_TYPE_EPB:
+            return True
+        if isinstance(info, PacketView):
+            return self.match_data(info.data, info.link_type)
+        return self.match_info(info)
+
+    @classmethod
+    def __data_source(cls, tree):
+        if tree[0] in ('or', 'and'):
+            return '({} {} {})'.format(cls.__data_source(tree[1]), tree[0], cls.__data_source(tree[2]))
+        elif tree[0] == 'not':
+            return '(not {})'.format(cls.__data_source(tree[1]))
+        elif tree[0] == 'layer':
+            return '({})'.format(cls.__data_guard(tree[1]))
+
+        _, name, mask, operator, value = tree
+        field = cls.__data_field(name)
+        if mask is not None:
+            field = '({} & {})'.format(field, mask)
+        return '({} and {} {} {})'.format(cls.__data_guard(FIELDS[name][0]), field, operator, value)
+
+    @classmethod
+    def __data_guard(cls, layer):
+        if layer is None:
+            return 'True'
+        parent, field, value, end = LAYERS[layer]
+        if parent is None:
+            return 'link_type == {} and len(data) >= {}'.format(value, end)
+        return '{} and {} == {} and len(data) >= {}'.format(cls.__data_guard(parent), cls.__data_field(field), value, end)
+
+    @staticmethod
+    def __data_field(name):
+        _, key, codec, base, bits = FIELDS[name]
+        if codec is None:
+            return 'len(data)'
+        offset, size, shift = codec.layout[key]
+        offset += base
+        if size == 1:
+            value = 'data[{}]'.format(offset)
+        elif size == 2:
+            value = '(data[{}] << 8 | data[{}])'.format(offset, offset + 1)
+        else:
+            value = "int.from_bytes(data[{}:{}], 'big')".format(offset, offset + size)
+        if bits is not None:
+            value = '({} >> {} & {})'.format(value, shift, (1 << bits) - 1)
+        return value
+
+    @classmethod
+    def __info_source(cls, tree):
+        if tree[0] in ('or', 'and'):
+            return '({} {} {})'.format(cls.__info_source(tree[1]), tree[0], cls.__info_source(tree[2]))
+        elif tree[0] == 'not':
+            return '(not {})'.format(cls.__info_source(tree[1]))
+        elif tree[0] == 'layer':
+            return "('{}' in info)".format(tree[1])
+
+        _, name, mask, operator, value = tree
+        layer, key, _, _, _ = FIELDS[name]
+        if layer is None:
+            field = "info['{}']".format(key)
+        else:
+            field = "info['{}']['{}']".format(layer, key)
+        if name in ADDRESS_FIELDS:
+            field = "int.from_bytes(bytes({}), 'big')".format(field)
+        if mask is not None:
+            field = '({} & {})'.format(field, mask)
+        if layer is None:
+            return '({} {} {})'.format(field, operator, value)
+        return "('{}' in info and {} {} {})".format(layer, field, operator, value)
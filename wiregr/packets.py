@@ -5,10 +5,12 @@
 # Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
 # with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import struct
 import yaml
 from collections import OrderedDict
 
 from wiregr.common import *
+from wiregr.schema import Header, Field, BitFields
 
 LINKTYPE_ETHERNET = 1
 
@@ -18,162 +20,344 @@ PROTOCOL_TCP = 6
 PROTOCOL_UDP = 17
 
 
+ETHERNET_HEADER = Header('ethernet', [
+    Field('destination', '6s', 'bytes'),
+    Field('source', '6s', 'bytes'),
+    Field('type', 'H'),
+]).compile()
+
+IPV4_HEADER = Header('ipv4', [
+    BitFields('B', [('version', 4, 'int'), ('header_length', 4, 'int')]),
+    Field('dsf', 'B', 'hex'),
+    Field('total_length', 'H'),
+    Field('identification', 'H', 'hex'),
+    BitFields('H', [('flags', 3, 'hex'), ('flagment_offset', 13, 'int')]),
+    Field('ttl', 'B'),
+    Field('protocol', 'B'),
+    Field('header_checksum', 'H', 'hex'),
+    Field('source', '4s', 'list'),
+    Field('destination', '4s', 'list'),
+]).compile()
+
+UDP_HEADER = Header('udp', [
+    Field('source_port', 'H'),
+    Field('destination_port', 'H'),
+    Field('length', 'H'),
+    Field('checksum', 'H', 'hex'),
+]).compile()
+
+TCP_HEADER = Header('tcp', [
+    Field('source_port', 'H'),
+    Field('destination_port', 'H'),
+    Field('seq_num', 'L'),
+    Field('ack_num', 'L'),
+    BitFields('H', [('header_length', 4, 'int'), (None, 3, 'int'), ('flags', 9, 'int')]),
+    Field('window_size', 'H'),
+    Field('checksum', 'H', 'hex'),
+    Field('urgent_pointer', 'H'),
+]).compile()
+
+# single byte options
+TCP_OPTION_FLAGS = {
+    0: 'end',
+    1: 'nop',
+}
+
+# (code, name, total option size, value struct), value struct None for options without a value
+TCP_OPTIONS = [
+    (2, 'max_segment_size', 4, struct.Struct('>H')),
+    (3, 'window_scale', 3, struct.Struct('>B')),
+    (4, 'sack_permitted', 2, None),
+    (8, 'timestamps', 10, struct.Struct('>LL')),
+]
+TCP_OPTIONS_BY_CODE = {x[0]: x for x in TCP_OPTIONS}
+TCP_OPTIONS_BY_NAME = {x[1]: x for x in TCP_OPTIONS}
+TCP_OPTION_FLAGS_BY_NAME = {v: k for k, v in TCP_OPTION_FLAGS.items()}
+
+
 def ethernet_header_read(reader):
-    info = OrderedDict()
-    info['destination'] = reader.read_bytes(6)
-    info['source'] = reader.read_bytes(6)
-    info['type'] = reader.read_fmt('>H')
-    return info
+    return ETHERNET_HEADER.read(reader)
 
 
 def ethernet_header_pack(writer, info):
-    writer.pack_bytes(info['destination'])
-    writer.pack_bytes(info['source'])
-    writer.pack_fmt('>H', info['type'])
+    ETHERNET_HEADER.pack(writer, info)
+
+
+def ethernet_header_length(info):
+    return ETHERNET_HEADER.size
 
 
 def ipv4_header_read(reader):
-    info = OrderedDict()
-    temp = reader.read_fmt('B')
-    info['version'] = temp >> 4
-    info['header_length'] = temp & 0x0F
-    info['dsf'] = HexInt(reader.read_fmt('>B'))
-    info['total_length'] = reader.read_fmt('>H')
-    info['identification'] = HexInt(reader.read_fmt('>H'))
-    temp = reader.read_fmt('>H')
-    info['flags'] = HexInt(temp >> 13)
-    info['flagment_offset'] = temp & 0x1FFF
-    info['ttl'] = reader.read_fmt('>B')
-    info['protocol'] = reader.read_fmt('>B')
-    info['header_checksum'] = HexInt(reader.read_fmt('>H'))
-    info['source'] = [x for x in reader.read_bytes(4)]
-    info['destination'] = [x for x in reader.read_bytes(4)]
-    return info
+    return IPV4_HEADER.read(reader)
 
 
 def ipv4_header_pack(writer, info):
-    temp = info['version'] << 4
-    temp = temp | info['header_length']
-    writer.pack_fmt('B', temp)
-    writer.pack_fmt('>B', info['dsf'])
-    writer.pack_fmt('>H', info['total_length'])
-    writer.pack_fmt('>H', info['identification'])
-    temp = info['flags'] << 13
-    temp = temp | info['flagment_offset']
-    writer.pack_fmt('>H', temp)
-    writer.pack_fmt('>B', info['ttl'])
-    writer.pack_fmt('>B', info['protocol'])
-    writer.pack_fmt('>H', info['header_checksum'])
-    writer.pack_bytes(info['source'])
-    writer.pack_bytes(info['destination'])
+    IPV4_HEADER.pack(writer, info)
+
 
+def ipv4_header_length(info):
+    return IPV4_HEADER.size
 
 
 def udp_header_read(reader):
-    info = OrderedDict()
-    info['source_port'] = reader.read_fmt('>H')
-    info['destination_port'] = reader.read_fmt('>H')
-    info['length'] = reader.read_fmt('>H')
-    info['checksum'] = HexInt(reader.read_fmt('>H'))
-    return info
+    return UDP_HEADER.read(reader)
 
 
 def udp_header_pack(writer, info):
-    writer.pack_fmt('>H', info['source_port'])
-    writer.pack_fmt('>H', info['destination_port'])
-    writer.pack_fmt('>H', info['length'])
-    writer.pack_fmt('>H', info['checksum'])
+    UDP_HEADER.pack(writer, info)
+
 
+def udp_header_length(info):
+    return UDP_HEADER.size
 
 
 def tcp_header_read(reader):
-    info = OrderedDict()
-    info['source_port'] = reader.read_fmt('>H')
-    info['destination_port'] = reader.read_fmt('>H')
-    info['seq_num'] = reader.read_fmt('>L')
-    info['ack_num'] = reader.read_fmt('>L')
-    temp = reader.read_fmt('>H')
-    info['header_length'] = temp >> 12
-    info['flags'] = temp & 0x1FF
-    info['window_size'] = reader.read_fmt('>H')
-    info['checksum'] = HexInt(reader.read_fmt('>H'))
-    info['urgent_pointer'] = reader.read_fmt('>H')
+    info = TCP_HEADER.read(reader)
 
     if info['header_length'] > 5:
         info['options'] = UnflowList()
-        options_end = reader.stream.tell() + 4 * (info['header_length'] - 5)
-        while reader.stream.tell() < options_end:
+        options_end = reader.tell() + 4 * (info['header_length'] - 5)
+        while reader.tell() < options_end:
             option_code = reader.read_fmt('>B')
-            if option_code == 0:
-                info['options'].append('end')
-                break
-            elif option_code == 1:
-                info['options'].append('nop')
+            if option_code in TCP_OPTION_FLAGS:
+                info['options'].append(TCP_OPTION_FLAGS[option_code])
+                if option_code == 0:
+                    break
                 continue
 
             option_size = reader.read_fmt('>B')
-            if option_code == 2:
-                info['options'].append({ 'max_segment_size': reader.read_fmt('>H') })
-                assert option_size == 4
-            elif option_code == 3:
-                info['options'].append({ 'window_scale': reader.read_fmt('>B') })
-                assert option_size == 3
-            elif option_code == 4:
-                info['options'].append('sack_permitted')
-                assert option_size == 2
-            elif option_code == 8:
-                info['options'].append({ 'timestamps': [reader.read_fmt('>L'), reader.read_fmt('>L')] })
-                assert option_size == 10
+            if option_code in TCP_OPTIONS_BY_CODE:
+                _, name, size, value_struct = TCP_OPTIONS_BY_CODE[option_code]
+                assert option_size == size
+                if value_struct is None:
+                    info['options'].append(name)
+                    continue
+
+                value = reader.read_struct(value_struct)
+                info['options'].append({ name: value[0] if len(value) == 1 else list(value) })
             else:
-                reader.stream.seek(-2, RELATIVE)
-                tcp_options.append(reader.read_bytes(option_size))
+                reader.seek(-2, RELATIVE)
+                info['options'].append(reader.read_bytes(option_size))
 
     return info
 
 
 def tcp_header_pack(writer, info):
-    writer.pack_fmt('>H', info['source_port'])
-    writer.pack_fmt('>H', info['destination_port'])
-    writer.pack_fmt('>L', info['seq_num'])
-    writer.pack_fmt('>L', info['ack_num'])
-    temp = info['header_length'] << 12
-    temp = temp | info['flags']
-    writer.pack_fmt('>H', temp)
-    writer.pack_fmt('>H', info['window_size'])
-    writer.pack_fmt('>H', info['checksum'])
-    writer.pack_fmt('>H', info['urgent_pointer'])
+    TCP_HEADER.pack(writer, info)
 
     if 'options' not in info:
         return
 
     for option in info['options']:
-        if option == 'end':
-            writer.pack_fmt('>B', 0)
-            break
-        elif option == 'nop':
-            writer.pack_fmt('>B', 1)
+        if isinstance(option, str):
+            if option in TCP_OPTION_FLAGS_BY_NAME:
+                writer.pack_fmt('>B', TCP_OPTION_FLAGS_BY_NAME[option])
+                if option == 'end':
+                    break
+            elif option in TCP_OPTIONS_BY_NAME:
+                code, _, size, _ = TCP_OPTIONS_BY_NAME[option]
+                writer.pack_fmt('>B', code)
+                writer.pack_fmt('>B', size)
             continue
-        elif option == 'sack_permitted':
-            writer.pack_fmt('>B', 4)
-            writer.pack_fmt('>B', 2)
-            continue
-        elif isinstance(option, list):
+        elif isinstance(option, (list, bytes, memoryview)):
             writer.pack_bytes(option)
             continue
 
         option_key = next(iter(option))
         option_value = option[option_key]
-        if option_key == 'max_segment_size':
-            writer.pack_fmt('>B', 2)
-            writer.pack_fmt('>B', 4)
-            writer.pack_fmt('>H', option_value)
-        elif option_key == 'window_scale':
-            writer.pack_fmt('>B', 3)
-            writer.pack_fmt('>B', 3)
-            writer.pack_fmt('>B', option_value)
-        elif option_key == 'timestamps':
-            writer.pack_fmt('>B', 8)
-            writer.pack_fmt('>B', 10)
-            writer.pack_fmt('>L', option_value[0])
-            writer.pack_fmt('>L', option_value[1])
+        if option_key in TCP_OPTIONS_BY_NAME:
+            code, _, size, value_struct = TCP_OPTIONS_BY_NAME[option_key]
+            writer.pack_fmt('>B', code)
+            writer.pack_fmt('>B', size)
+            if isinstance(option_value, list):
+                writer.pack_struct(value_struct, *option_value)
+            else:
+                writer.pack_struct(value_struct, option_value)
+
+
+def tcp_options_length(options):
+    length = 0
+    for option in options:
+        if isinstance(option, str):
+            if option in TCP_OPTION_FLAGS_BY_NAME:
+                length += 1
+                if option == 'end':
+                    break
+            elif option in TCP_OPTIONS_BY_NAME:
+                length += TCP_OPTIONS_BY_NAME[option][2]
+        elif isinstance(option, (list, bytes, memoryview)):
+            length += len(option)
+        elif next(iter(option)) in TCP_OPTIONS_BY_NAME:
+            length += TCP_OPTIONS_BY_NAME[next(iter(option))][2]
+    return length
+
+
+def tcp_header_length(info):
+    if 'options' not in info:
+        return TCP_HEADER.size
+    return TCP_HEADER.size + tcp_options_length(info['options'])
+
+
+LAYER_PACKERS = {
+    'ethernet_data': ethernet_header_pack,
+    'ipv4_data': ipv4_header_pack,
+    'tcp_data': tcp_header_pack,
+    'udp_data': udp_header_pack,
+}
+
+PROTOCOL_LAYERS = {
+    PROTOCOL_TCP: 'tcp_data',
+    PROTOCOL_UDP: 'udp_data',
+}
+
+
+class PacketView:
+
+    # Mapping-like enhanced packet block that keeps the captured bytes and decodes the block header and
+    # the packet layers only on first access. Layers are decoded in order, so the decoded ones always
+    # form a prefix of ethernet -> ipv4 -> tcp/udp -> unknown_payload and the rest can be copied raw.
+
+    HEADER_KEYS = ('interface_id', 'datetime', 'captured_length', 'packet_length')
+    LAYER_KEYS = ('ethernet_data', 'ipv4_data', 'tcp_data', 'udp_data', 'unknown_payload')
+
+    def __init__(self, block_type, codec, values, tsresol, data, link_type, options=None):
+        self.__block_type = block_type
+        self.__codec = codec
+        self.__values = values
+        self.__tsresol = tsresol
+        self.__header = None
+        self.__data = data
+        self.__link_type = link_type
+        self.__reader = None
+        self.__layers = OrderedDict()
+        self.__next = 'ethernet_data' if link_type == LINKTYPE_ETHERNET else 'unknown_payload'
+        self.__options = options
+        self.__extra = OrderedDict()
+
+    def __getitem__(self, key):
+        if key == 'block_type':
+            return self.__block_type
+        elif key in self.HEADER_KEYS:
+            return self.__decoded_header()[key]
+        elif key in self.LAYER_KEYS:
+            if self.__decode_until(key):
+                return self.__layers[key]
+        elif key == 'options':
+            if self.__options is not None:
+                return self.__options
+        elif key in self.__extra:
+            return self.__extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key == 'block_type':
+            self.__block_type = value
+        elif key in self.HEADER_KEYS:
+            self.__decoded_header()[key] = value
+        elif key in self.LAYER_KEYS:
+            self.__decode_until(key)
+            self.__layers[key] = value
+        elif key == 'options':
+            self.__options = value
+        else:
+            self.__extra[key] = value
+
+    def __contains__(self, key):
+        if key == 'block_type' or key in self.HEADER_KEYS:
+            return True
+        elif key in self.LAYER_KEYS:
+            return self.__decode_until(key)
+        elif key == 'options':
+            return self.__options is not None
+        return key in self.__extra
+
+    def __iter__(self):
+        return iter(self.materialize())
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def keys(self):
+        return self.materialize().keys()
+
+    def items(self):
+        return self.materialize().items()
+
+    @property
+    def data(self):
+        return self.__data
+
+    @property
+    def link_type(self):
+        return self.__link_type
+
+    def materialize(self):
+        info = OrderedDict()
+        info['block_type'] = self.__block_type
+        info.update(self.__decoded_header())
+        while self.__decode_next():
+            pass
+        info.update(self.__layers)
+        if self.__options is not None:
+            info['options'] = self.__options
+        info.update(self.__extra)
+        return info
+
+    def encoded_header(self):
+        if self.__header is None:
+            return self.__values
+        return self.__codec.encode(self.__header, self.__tsresol)
+
+    def decoded_layers(self):
+        return self.__layers.items()
+
+    def raw_tail(self):
+        # captured bytes after the decoded layers, None once everything is decoded
+        if self.__next is None:
+            return None
+        if self.__reader is None:
+            return self.__data
+        return self.__reader.buffer[self.__reader.tell():]
+
+    def __decoded_header(self):
+        if self.__header is None:
+            self.__header = OrderedDict()
+            self.__codec.decode_into(self.__values, self.__header, self.__tsresol)
+        return self.__header
+
+    def __decode_until(self, key):
+        while key not in self.__layers and self.__decode_next():
+            pass
+        return key in self.__layers
+
+    def __decode_next(self):
+        key = self.__next
+        if key is None:
+            return False
+
+        if self.__reader is None:
+            self.__reader = BufferReader(self.__data)
+        reader = self.__reader
+
+        if key == 'ethernet_data':
+            value = ethernet_header_read(reader)
+            self.__next = 'ipv4_data' if value['type'] == TYPE_IPV4 else 'unknown_payload'
+        elif key == 'ipv4_data':
+            value = ipv4_header_read(reader)
+            self.__next = PROTOCOL_LAYERS.get(value['protocol'], 'unknown_payload')
+        elif key == 'tcp_data':
+            value = tcp_header_read(reader)
+            self.__next = 'unknown_payload'
+        elif key == 'udp_data':
+            value = udp_header_read(reader)
+            self.__next = 'unknown_payload'
+        else:
+            self.__next = None
+            length = len(self.__data) - reader.tell()
+            # a payload after known headers is kept only when it is not empty
+            if length <= 0 and len(self.__layers) > 0:
+                return True
+            value = reader.read_bytes(length)
 
+        self.__layers[key] = value
+        return True
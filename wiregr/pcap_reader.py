@@ -5,131 +5,164 @@
 # Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
 # with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import collections
 import datetime
+import io
+import mmap
+import multiprocessing
 import yaml
 import struct
 import sys
 from collections import OrderedDict
 
+import wiregr.common
 from wiregr.common import *
+from wiregr.blocks import *
 from wiregr.packets import *
 
-class PcapReader(BaseWorker):
+# blocks are handed to the pool in chunks of about this many bytes
+JOBS_CHUNK_SIZE = 1 << 20
 
-    def __init__(self, input_file, output_file):
-        super().__init__(input_file, True, output_file, '.yaml', False)
-        self._configure_endianess(MAGIC)
-        self.__interfaces = []
+class PcapBlockReader(PcapCodec):
 
-    def process(self):
+    def __init__(self, reader, lazy=False):
+        super().__init__()
+        self._reader = reader
+        self.__lazy = lazy
+        self.__interfaces = []
+        self.__option_parsers = {
+            'utf8': self.__unpack_utf8,
+            'tsresol': self.__unpack_tsresol,
+            'bytes': self._reader.read_bytes,
+            'hex32': lambda x: HexInt(self.__unpack(self.fmt_uint32)),
+            'hex64': lambda x: HexInt(self.__unpack(self.fmt_uint64)),
+            'uint64': lambda x: self.__unpack(self.fmt_uint64),
+            'timestamp': lambda x: self.__unpack_timestamp(MICROSECONDS),
+        }
+
+    def read(self):
         while True:
-            temp = self._input_file.read(4)
-            if len(temp) == 0:
+            info = self.read_block()
+            if info is None:
                 break
 
-            start_offset = self._input_file.tell()
-            block_length_pre = self.__unpack(self.fmt_uint32)
-            end_offset = start_offset + block_length_pre - 8
-
-            info = OrderedDict()
-            info['block_type'] = HexInt(struct.unpack(self.fmt_uint32, temp)[0])
-            if info['block_type'] == 0x0A0D0D0A:
-                block_length_pre = self.__parse_section_header(info, start_offset, block_length_pre)
-            elif info['block_type'] == 0x00000001:
-                self.__parse_interface_description_block(info, end_offset)
-            elif info['block_type'] == 0x00000005:
-                self.__parse_interface_statistic_block(info, end_offset)
-            elif info['block_type'] == 0x00000006:
-                self.__parse_enhanced_packet_block(info, end_offset)
-            else:
-                self.__parse_unknown_payload(info, end_offset)
-                print('Unknown block_type', hex(info['block_type']), file=sys.stderr)
+            yield info
 
-            block_length_post = self.__unpack(self.fmt_uint32)
-            assert block_length_pre == block_length_post
+    def read_block(self):
+        temp = self._reader.read_bytes(4)
+        if len(temp) == 0:
+            return None
 
-            self._writer.write(info)
+        return self.__read_block(temp)
+
+    def seek(self, offset):
+        self._reader.seek(offset, ABSOLUTE)
+
+    def seek_block(self, index, number):
+        # replay the section and interface blocks the target block depends on, then jump to it
+        for context_number in index.context(number):
+            self.seek(index.offsets[context_number])
+            self.read_block()
+        self.seek(index.offsets[number] if number < len(index) else index.end_offset)
+
+    def __read_block(self, temp):
+        start_offset = self._reader.tell()
+        block_length_pre = self.__unpack(self.fmt_uint32)
+        end_offset = start_offset + block_length_pre - 8
+
+        info = OrderedDict()
+        info['block_type'] = HexInt(struct.unpack(self.fmt_uint32, temp)[0])
+        if info['block_type'] == BLOCK_TYPE_SHB:
+            block_length_pre = self.__parse_section_header(info, start_offset, block_length_pre)
+        elif info['block_type'] == BLOCK_TYPE_IDB:
+            self.__parse_interface_description_block(info, end_offset)
+        elif info['block_type'] == BLOCK_TYPE_ISB:
+            self.__parse_interface_statistic_block(info, end_offset)
+        elif info['block_type'] == BLOCK_TYPE_EPB:
+            info = self.__parse_enhanced_packet_block(info, end_offset)
+        else:
+            self.__parse_unknown_payload(info, end_offset)
+            print('Unknown block_type', hex(info['block_type']), file=sys.stderr)
+
+        block_length_post = self.__unpack(self.fmt_uint32)
+        assert block_length_pre == block_length_post
+
+        return info
 
     def __parse_section_header(self, info, start_offset, block_length_pre):
         old_fmt_uint32 = self.fmt_uint32
 
-        info['magic'] = HexInt(self.__unpack(self.fmt_uint32))
+        info['magic'] = HexInt(self._reader.read_struct(SHB_MAGIC_STRUCT)[0])
         self._configure_endianess(info['magic'])
+        self.__interfaces = [] # interface ids are numbered per section
         block_length_pre = struct.unpack(self.fmt_uint32, struct.pack(old_fmt_uint32, block_length_pre))[0]
         end_offset = start_offset + block_length_pre - 8
 
-        info['major_version'] = self.__unpack(self.fmt_uint16)
-        info['minor_version'] = self.__unpack(self.fmt_uint16)
-        info['section_length'] = HexInt(self.__unpack(self.fmt_uint64))
+        SECTION_HEADER.compile(self.byte_order).read_into(self._reader, info)
 
-        if self._input_file.tell() < end_offset:
-            info['options'] = self.__parse_options({
-                2: ('shb_hardware', self.__unpack_utf8),
-                3: ('shb_os', self.__unpack_utf8),
-                4: ('shb_userappl', self.__unpack_utf8)
-            })
+        if self._reader.tell() < end_offset:
+            info['options'] = self.__parse_options(SECTION_HEADER_OPTIONS)
 
         return block_length_pre
 
 
     def __parse_interface_description_block(self, info, end_offset):
-        info['link_type'] = self.__unpack(self.fmt_uint16)
-        self.__unpack(self.fmt_uint16) # RESERVED
-        info['snapshot_length'] = self.__unpack(self.fmt_uint32)
-
-        if self._input_file.tell() < end_offset:
-            info['options'] = self.__parse_options({
-                2: ('if_name', self.__unpack_utf8),
-                3: ('if_description', self.__unpack_utf8),
-                9: ('if_tsresol', self.__unpack_tsresol),
-                11: ('if_filter', self.__unpack_utf8),
-                12: ('if_os', self.__unpack_utf8),
-            })
+        INTERFACE_DESCRIPTION.compile(self.byte_order).read_into(self._reader, info)
+
+        if self._reader.tell() < end_offset:
+            info['options'] = self.__parse_options(INTERFACE_DESCRIPTION_OPTIONS)
 
         interface_param = InterfaceParam()
         interface_param.link_type = info['link_type']
         if 'options' in info and 'if_tsresol' in info['options']:
-            interface_param.tsresol = info['options']['if_tsresol']['base'] ** (-info['options']['if_tsresol']['power'])
+            interface_param.tsresol = (info['options']['if_tsresol']['base'], info['options']['if_tsresol']['power'])
         self.__interfaces.append(interface_param)
 
 
     def __parse_enhanced_packet_block(self, info, end_offset):
-        info['interface_id'] = self.__unpack(self.fmt_uint32)
-        interface_param = self.__interfaces[info['interface_id']]
-        info['datetime'] = self.__unpack_timestamp(interface_param.tsresol)
-        info['captured_length'] = self.__unpack(self.fmt_uint32)
-        info['packet_length'] = self.__unpack(self.fmt_uint32)
-
-        end_payload_offset = self._input_file.tell() + info['captured_length']
+        codec = ENHANCED_PACKET.compile(self.byte_order)
+        values = self._reader.read_struct(codec.struct)
+        interface_param = self.__interfaces[values[0]]
+        if self.__lazy:
+            return self.__parse_packet_view(info, end_offset, codec, values, interface_param)
+        codec.decode_into(values, info, interface_param.tsresol)
+
+        end_payload_offset = self._reader.tell() + info['captured_length']
         if interface_param.link_type == LINKTYPE_ETHERNET:
             self.__parse_aligned(
                 lambda: self.__parse_ethernet_data(info, end_payload_offset),
                 4)
         else:
             info['unknown_payload'] = self.__parse_aligned(
-                lambda: self._input_file.read(info['captured_length']),
+                lambda: self._reader.read_bytes(info['captured_length']),
                 4)
             print('Unknown link_type', interface_param.link_type, file=sys.stderr)
 
-        if self._input_file.tell() < end_offset:
-            info['options'] = self.__parse_options({
-                2: ('ebp_flags', lambda x: HexInt(self.__unpack(self.fmt_uint32))),
-                3: ('ebp_hash', lambda x: self._input_file.read(x)),
-                4: ('epb_dropcount', lambda x: HexInt(self.__unpack(self.fmt_uint64))),
-            })
+        if self._reader.tell() < end_offset:
+            info['options'] = self.__parse_options(ENHANCED_PACKET_OPTIONS)
+
+        return info
+
+
+    def __parse_packet_view(self, info, end_offset, codec, values, interface_param):
+        captured_length = values[3] # after interface_id and two timestamp words
+        data = self.__parse_aligned(lambda: self._reader.read_bytes(captured_length), 4)
+        if interface_param.link_type != LINKTYPE_ETHERNET:
+            print('Unknown link_type', interface_param.link_type, file=sys.stderr)
+
+        options = None
+        if self._reader.tell() < end_offset:
+            options = self.__parse_options(ENHANCED_PACKET_OPTIONS)
+
+        return PacketView(info['block_type'], codec, values, interface_param.tsresol,
+                          data, interface_param.link_type, options)
 
 
     def __parse_interface_statistic_block(self, info, end_offset):
-        info['interface_id'] = self.__unpack(self.fmt_uint32)
-        info['datetime'] = self.__unpack_timestamp(10 ** -6)
+        INTERFACE_STATISTIC.compile(self.byte_order).read_into(self._reader, info, MICROSECONDS)
 
-        if self._input_file.tell() < end_offset:
-            info['options'] = self.__parse_options({
-                2: ('isb_starttime', lambda x: self.__unpack_timestamp(10 ** -6)),
-                3: ('isb_endtime', lambda x: self.__unpack_timestamp(10 ** -6)),
-                4: ('isb_ifrecv', lambda x: self.__unpack(self.fmt_uint64)),
-                5: ('isb_ifdrop', lambda x: self.__unpack(self.fmt_uint64)),
-            })
+        if self._reader.tell() < end_offset:
+            info['options'] = self.__parse_options(INTERFACE_STATISTIC_OPTIONS)
 
 
     def __parse_ethernet_data(self, info, end_offset):
@@ -163,12 +196,12 @@ class PcapReader(BaseWorker):
 
 
     def __parse_unknown_payload(self, info, end_offset):
-        length = end_offset - self._input_file.tell()
+        length = end_offset - self._reader.tell()
         if length > 0:
-            info['unknown_payload'] = self._input_file.read(length)
+            info['unknown_payload'] = self._reader.read_bytes(length)
 
 
-    def __parse_options(self, parsers):
+    def __parse_options(self, table):
         options = OrderedDict()
 
         while True:
@@ -177,35 +210,31 @@ class PcapReader(BaseWorker):
 
             if option_code == OPT_END:
                 break
-            elif option_code == OPT_COMMENT:
-                options['opt_comment'] = self.__parse_aligned(
-                    lambda: self.__unpack_utf8(option_length), 4)
-            elif option_code in parsers:
-                parser = parsers[option_code]
-                options[parser[0]] = self.__parse_aligned(
-                    lambda: parser[1](option_length), 4)
+            elif option_code in table.by_code:
+                name, kind = table.by_code[option_code]
+                options[name] = self.__parse_aligned(
+                    lambda: self.__option_parsers[kind](option_length), 4)
             else:
-                self._input_file.seek(align_value(option_length, 4), RELATIVE)
+                self._reader.seek(align_value(option_length, 4), RELATIVE)
                 print('Unknown option_code', option_code, file=sys.stderr)
 
         return options
 
 
     def __parse_aligned(self, callback, align):
-        start_offset = self._input_file.tell()
+        start_offset = self._reader.tell()
         temp = callback()
-        end_offset = start_offset + align_value(self._input_file.tell() - start_offset, align)
-        self._input_file.seek(end_offset, ABSOLUTE)
+        end_offset = start_offset + align_value(self._reader.tell() - start_offset, align)
+        self._reader.seek(end_offset, ABSOLUTE)
         return temp
 
 
     def __unpack(self, fmt):
-        block = self._input_file.read(struct.calcsize(fmt))
-        return struct.unpack(fmt, block)[0]
+        return self._reader.read_fmt(fmt)
 
 
     def __unpack_utf8(self, length):
-        return self._input_file.read(length).decode('utf-8')
+        return str(self._reader.read_bytes(length), 'utf-8')
 
 
     def __unpack_tsresol(self, length):
@@ -218,5 +247,102 @@ class PcapReader(BaseWorker):
 
     def __unpack_timestamp(self, tsresol):
         ticks = self.__unpack(self.fmt_uint32) << 32 | self.__unpack(self.fmt_uint32)
-        return datetime.datetime(1970, 1, 1) + datetime.timedelta(0, ticks * tsresol)
+        return Timestamp(ticks, tsresol)
+
+
+
+def _init_job(yaml_backend):
+    set_yaml_backend(yaml_backend)
+
+
+def _convert_chunk(context, context_blocks, chunk, payload_format, filter_expression):
+    # context holds the section and interface blocks the chunk depends on, they are read but not written
+    from wiregr.filters import PacketFilter
+    packet_filter = PacketFilter(filter_expression) if filter_expression is not None else None
+
+    stream = io.StringIO()
+    reader = PcapBlockReader(BufferReader(context + chunk), lazy=packet_filter is not None)
+    writer = YamlWriter(stream, payload_format)
+    for _ in range(context_blocks):
+        reader.read_block()
+
+    for info in reader.read():
+        if packet_filter is not None and not packet_filter.match(info):
+            continue
+        writer.write(info)
+    writer.close()
+
+    return stream.getvalue()
+
+
+class PcapReader(BaseWorker):
+
+    def __init__(self, input_file, output_file, use_mmap=False, payload_format=None, packet_filter=None, jobs=1,
+                 output_format=None):
+        # a filter peeks at the captured bytes, so packets are read lazily and skipped undecoded
+        super().__init__(input_file, True, output_file, '.yaml', False, payload_format, use_mmap,
+                         lazy=packet_filter is not None, output_format=output_format)
+        self.__payload_format = payload_format
+        self.__packet_filter = packet_filter
+        self.__jobs = jobs
+
+    def process(self):
+        # the pool converts to yaml text, binary blocks are cheap enough to be written serially
+        if self.__jobs > 1 and not self._is_binary_blocks_output and self.__process_parallel():
+            return
+
+        for info in self._reader.read():
+            if self.__packet_filter is not None and not self.__packet_filter.match(info):
+                continue
+            self._writer.write(info)
 
+    def __process_parallel(self):
+        # the input is split into chunks at block boundaries by a header only scan, every chunk is
+        # converted by the pool together with the section and interface blocks it depends on, and
+        # the converted chunks are written in order as they come
+        from wiregr.block_index import scan_pcapng
+
+        try:
+            buffer = mmap.mmap(self._input_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError, io.UnsupportedOperation):
+            return False # not a regular file, converted serially
+
+        filter_expression = self.__packet_filter.expression if self.__packet_filter is not None else None
+        with buffer, multiprocessing.Pool(self.__jobs, _init_job, (wiregr.common.yaml_backend,)) as pool:
+            pending = collections.deque()
+            for context, start, end in self.__chunks(scan_pcapng(buffer)):
+                context_data = b''.join(buffer[offset:offset + length] for offset, length in context)
+                pending.append(pool.apply_async(_convert_chunk, (
+                    context_data, len(context), buffer[start:end], self.__payload_format, filter_expression)))
+
+                # a few chunks per job in flight keep the pool busy without reading ahead the whole input
+                if len(pending) > 2 * self.__jobs:
+                    self._output_file.write(pending.popleft().get())
+
+            while pending:
+                self._output_file.write(pending.popleft().get())
+
+        return True
+
+    def __chunks(self, blocks):
+        # yields (context blocks, start offset, end offset), a chunk ends at the first block boundary
+        # after JOBS_CHUNK_SIZE bytes
+        section = []
+        start = None
+        for offset, block_type, length, _, _ in blocks:
+            if start is None:
+                start = offset
+                context = list(section)
+
+            if block_type == BLOCK_TYPE_SHB:
+                section = [(offset, length)]
+            elif block_type == BLOCK_TYPE_IDB:
+                section.append((offset, length))
+
+            end = offset + length
+            if end - start >= JOBS_CHUNK_SIZE:
+                yield context, start, end
+                start = None
+
+        if start is not None:
+            yield context, start, end
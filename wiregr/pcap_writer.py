@@ -12,87 +12,87 @@ import sys
 from collections import OrderedDict
 
 from wiregr.common import *
+from wiregr.blocks import *
 from wiregr.packets import *
 
-class PcapWriter(BaseWorker):
-
-    def __init__(self, input_file, output_file):
-        super().__init__(input_file, False, output_file, '.pcapng', True)
-        self._configure_endianess(MAGIC)
-        self.__interfaces = []
+class PcapBlockWriter(PcapCodec):
 
+    # every block is assembled in a reused buffer, where its lengths are filled in once known,
+    # and goes to the stream with a single write, so the stream is never seeked and may be a pipe
 
-    def process(self):
-        for info in self._reader.read():
-            if info['block_type'] == 0x0A0D0D0A:
-                self._configure_endianess(info['magic'])
-
-            self.__pack(self.fmt_uint32, info['block_type'])
-            start_offset = self._output_file.tell()
-            self.__pack(self.fmt_uint32, 0)
+    def __init__(self, stream):
+        super().__init__()
+        self.stream = stream
+        self._writer = BufferWriter(1 << 16)
+        self.__interfaces = []
+        self.__option_packers = {
+            'utf8': self.__pack_utf8,
+            'tsresol': self.__pack_tsresol,
+            'bytes': self._writer.pack_bytes,
+            'hex32': lambda x: self.__pack(self.fmt_uint32, x),
+            'hex64': lambda x: self.__pack(self.fmt_uint64, x),
+            'uint64': lambda x: self.__pack(self.fmt_uint64, x),
+            'timestamp': lambda x: self.__pack_timestamp(MICROSECONDS, x),
+        }
+
+    def close(self):
+        pass
+
+    def write(self, info):
+        if info['block_type'] == BLOCK_TYPE_SHB:
+            self._configure_endianess(info['magic'])
+
+        self._writer.reset()
+        self.__pack(self.fmt_uint32, info['block_type'])
+        self.__pack(self.fmt_uint32, 0)
 
-            payload_offset = self._output_file.tell()
-            if info['block_type'] == 0x0A0D0D0A:
-                self.__pack_section_header(info)
-            elif info['block_type'] == 0x00000001:
-                self.__pack_interface_description_block(info)
-            elif info['block_type'] == 0x00000005:
-                self.__pack_interface_statistic_block(info)
-            elif info['block_type'] == 0x00000006:
-                self.__pack_enhanced_packet_block(info)
-            else:
-                self.__pack_unknown_payload(info)
-            block_total_length = self._output_file.tell() - payload_offset + 12
+        if info['block_type'] == BLOCK_TYPE_SHB:
+            self.__pack_section_header(info)
+        elif info['block_type'] == BLOCK_TYPE_IDB:
+            self.__pack_interface_description_block(info)
+        elif info['block_type'] == BLOCK_TYPE_ISB:
+            self.__pack_interface_statistic_block(info)
+        elif info['block_type'] == BLOCK_TYPE_EPB:
+            self.__pack_enhanced_packet_block(info)
+        else:
+            self.__pack_unknown_payload(info)
+        block_total_length = self._writer.tell() + 4
 
-            end_offset = self._output_file.tell()
-            self._output_file.seek(start_offset, ABSOLUTE)
-            self.__pack(self.fmt_uint32, block_total_length)
-            self._output_file.seek(end_offset, ABSOLUTE)
-            self.__pack(self.fmt_uint32, block_total_length)
+        struct.pack_into(self.fmt_uint32, self._writer.buffer, 4, block_total_length)
+        self.__pack(self.fmt_uint32, block_total_length)
+        self.stream.write(self._writer.getbuffer())
 
 
     def __pack_section_header(self, info):
+        self.__interfaces = []
         self.__pack(self.fmt_uint32, MAGIC)
-        self.__pack(self.fmt_uint16, info['major_version'])
-        self.__pack(self.fmt_uint16, info['minor_version'])
-        self.__pack(self.fmt_uint64, info['section_length'])
+        SECTION_HEADER.compile(self.byte_order).pack(self._writer, info)
 
         if 'options' in info:
-            self.__pack_options(info['options'], {
-                'shb_hardware': (2, self.__pack_utf8),
-                'shb_os': (3, self.__pack_utf8),
-                'shb_userappl': (4, self.__pack_utf8)
-            })
+            self.__pack_options(info['options'], SECTION_HEADER_OPTIONS)
 
 
     def __pack_interface_description_block(self, info):
         interface_param = InterfaceParam()
         interface_param.link_type = info['link_type']
         if 'options' in info and 'if_tsresol' in info['options']:
-            interface_param.tsresol = info['options']['if_tsresol']['base'] ** (-info['options']['if_tsresol']['power'])
+            interface_param.tsresol = (info['options']['if_tsresol']['base'], info['options']['if_tsresol']['power'])
         self.__interfaces.append(interface_param)
 
-        self.__pack(self.fmt_uint16, info['link_type'])
-        self.__pack(self.fmt_uint16, 0) # RESERVED
-        self.__pack(self.fmt_uint32, info['snapshot_length'])
+        INTERFACE_DESCRIPTION.compile(self.byte_order).pack(self._writer, info)
 
         if 'options' in info:
-            self.__pack_options(info['options'], {
-                'if_name': (2, self.__pack_utf8),
-                'if_description': (3, self.__pack_utf8),
-                'if_tsresol': (9, self.__pack_tsresol),
-                'if_filter': (11, self.__pack_utf8),
-                'if_os': (12, self.__pack_utf8)
-            })
+            self.__pack_options(info['options'], INTERFACE_DESCRIPTION_OPTIONS)
 
 
     def __pack_enhanced_packet_block(self, info):
+        if isinstance(info, PacketView):
+            self.__pack_packet_view(info)
+            return
+
         interface_param = self.__interfaces[info['interface_id']]
 
-        self.__pack(self.fmt_uint32, info['interface_id'])
-        self.__pack_timestamp(interface_param.tsresol, info['datetime'])
-        self.__pack(self.fmt_uint32, info['captured_length'])
-        self.__pack(self.fmt_uint32, info['packet_length'])
+        ENHANCED_PACKET.compile(self.byte_order).pack(self._writer, info, interface_param.tsresol)
 
         if 'ethernet_data' in info:
             self.__pack_aligned(lambda: self.__pack_ethernet_data(info), 4)
@@ -100,24 +100,35 @@ class PcapWriter(BaseWorker):
             self.__pack_unknown_payload(info)
 
         if 'options' in info:
-            self.__pack_options(info['options'], {
-                'ebp_flags': (2, lambda x: self.__pack(self.fmt_uint32, x)),
-                'ebp_hash': (3, lambda x: self._output_file.write(bytes(x))),
-                'epb_dropcount': (4, lambda x: self.__pack(self.fmt_uint64, x)),
-            })
+            self.__pack_options(info['options'], ENHANCED_PACKET_OPTIONS)
+
+
+    def __pack_packet_view(self, info):
+        # only decoded layers are packed again, the rest of the captured bytes is copied as it is
+        self._writer.pack_struct(ENHANCED_PACKET.compile(self.byte_order).struct, *info.encoded_header())
+        self.__pack_aligned(lambda: self.__pack_view_layers(info), 4)
+
+        if 'options' in info:
+            self.__pack_options(info['options'], ENHANCED_PACKET_OPTIONS)
+
+
+    def __pack_view_layers(self, info):
+        for name, value in info.decoded_layers():
+            if name == 'unknown_payload':
+                self._writer.pack_payload(value)
+            else:
+                LAYER_PACKERS[name](self._writer, value)
+
+        tail = info.raw_tail()
+        if tail is not None:
+            self._writer.pack_bytes(tail)
 
 
     def __pack_interface_statistic_block(self, info):
-        self.__pack(self.fmt_uint32, info['interface_id'])
-        self.__pack_timestamp(10 ** -6, info['datetime'])
+        INTERFACE_STATISTIC.compile(self.byte_order).pack(self._writer, info, MICROSECONDS)
 
         if 'options' in info:
-            self.__pack_options(info['options'], {
-                'isb_starttime': (2, lambda x: self.__pack_timestamp(10 ** -6, x)),
-                'isb_endtime': (3, lambda x: self.__pack_timestamp(10 ** -6, x)),
-                'isb_ifrecv': (4, lambda x: self.__pack(self.fmt_uint64, x)),
-                'isb_ifdrop': (5, lambda x: self.__pack(self.fmt_uint64, x)),
-            })
+            self.__pack_options(info['options'], INTERFACE_STATISTIC_OPTIONS)
 
 
     def __pack_ethernet_data(self, info):
@@ -154,54 +165,42 @@ class PcapWriter(BaseWorker):
             self.__pack_unknown_payload(info)
 
 
-    def __pack_options(self, options, packers):
+    def __pack_options(self, options, table):
         for k, v in options.items():
-            start_offset = self._output_file.tell()
-            self.__pack(self.fmt_uint32, 0)
-
-            payload_offset = self._output_file.tell()
-            if k == 'opt_comment':
-                code = 1
-                self.__pack_utf8(v)
-            elif k in packers:
-                packer = packers[k]
-                code = packer[0]
-                packer[1](v)
-            else:
-                self._output_file.seek(-4, RELATIVE)
+            if k not in table.by_name:
                 print('Unknown option', k, file=sys.stderr)
                 continue
-            size = self._output_file.tell() - payload_offset
 
-            self.__align(size, 4)
+            code, kind = table.by_name[k]
+            start_offset = self._writer.tell()
+            self.__pack(self.fmt_uint32, 0)
+            self.__option_packers[kind](v)
+            size = self._writer.tell() - start_offset - 4
 
-            end_offset = self._output_file.tell()
-            self._output_file.seek(start_offset, ABSOLUTE)
-            self.__pack(self.fmt_uint16, code)
-            self.__pack(self.fmt_uint16, size)
-            self._output_file.seek(end_offset, ABSOLUTE)
+            self.__align(size, 4)
+            struct.pack_into(self.byte_order + 'HH', self._writer.buffer, start_offset, code, size)
 
         self.__pack(self.fmt_uint32, 0)
 
 
     def __pack_aligned(self, callback, align):
-        start_offset = self._output_file.tell()
+        start_offset = self._writer.tell()
         callback()
-        self.__align(self._output_file.tell() - start_offset, align)
+        self.__align(self._writer.tell() - start_offset, align)
 
 
     def __align(self, size, align):
         size = align_value(size, align) - size
         if size > 0:
-            self._output_file.write(bytes([0] * size))
+            self._writer.pack_bytes(bytes(size))
 
 
     def __pack(self, fmt, value):
-        self._output_file.write(struct.pack(fmt, value))
+        self._writer.pack_fmt(fmt, value)
 
 
     def __pack_utf8(self, value):
-        self._output_file.write(value.encode('utf-8'))
+        self._writer.pack_bytes(value.encode('utf-8'))
 
 
     def __pack_tsresol(self, value):
@@ -211,7 +210,7 @@ class PcapWriter(BaseWorker):
 
 
     def __pack_timestamp(self, tsresol, value):
-        ticks = int((value - datetime.datetime(1970, 1, 1)).total_seconds() / tsresol)
+        ticks = datetime_to_ticks(value, tsresol)
         self.__pack(self.fmt_uint32, (ticks >> 32) & 0xFFFFFFFF)
         self.__pack(self.fmt_uint32, ticks & 0xFFFFFFFF)
 
@@ -219,3 +218,12 @@ class PcapWriter(BaseWorker):
     def __pack_unknown_payload(self, info):
         self.__pack_aligned(lambda: self._writer.pack_payload(info['unknown_payload']), 4)
 
+
+class PcapWriter(BaseWorker):
+
+    def __init__(self, input_file, output_file):
+        super().__init__(input_file, False, output_file, '.pcapng', True)
+
+    def process(self):
+        for info in self._reader.read():
+            self._writer.write(info)
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This Source Code Form is subject to the terms of the
+# Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+# with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import struct
+
+from wiregr.common import HexInt, DecimalBytes, HeaderRecord, HEADER_RECORDS, Timestamp, datetime_to_ticks
+
+# field kinds:
+#   int       - plain integer
+#   hex       - integer shown as hex in yaml
+#   bytes     - fixed size byte string ('Ns' format), packed from any bytes-like or list of ints
+#   list      - fixed size byte string shown as a list of decimal ints (ip addresses), kept as DecimalBytes
+#   timestamp - two 32-bit words of ticks kept as a Timestamp with the interface tsresol
+
+
+class Field:
+
+    def __init__(self, name, fmt, kind='int'):
+        self.name = name
+        self.fmt = fmt
+        self.kind = kind
+
+
+class BitFields:
+
+    def __init__(self, fmt, parts):
+        # parts are (name, bits, kind) from the most significant bit, name None marks reserved bits
+        self.fmt = fmt
+        self.parts = parts
+
+
+class Header:
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+        self.names = [y[0] for x in fields for y in (x.parts if isinstance(x, BitFields) else [(x.name,)])
+                      if y[0] is not None]
+        self.record = type(''.join(x.title() for x in name.split('_')) + 'Record', (HeaderRecord,), {
+            '__slots__': tuple(self.names),
+            'name': name,
+            'fields': tuple(self.names),
+            'field_set': frozenset(self.names),
+        })
+        HEADER_RECORDS[name] = self.record
+        self.__codecs = {}
+
+    def compile(self, byte_order='>'):
+        if byte_order not in self.__codecs:
+            self.__codecs[byte_order] = HeaderCodec(self, byte_order)
+        return self.__codecs[byte_order]
+
+
+class HeaderCodec:
+
+    WRAP = {
+        'int': '{}',
+        'hex': 'HexInt({})',
+        'bytes': '{}',
+        'list': 'DecimalBytes({})',
+    }
+
+    def __init__(self, header, byte_order):
+        fmt = byte_order
+        decode = []
+        encode = []
+        layout = {}
+        index = 0
+
+        for field in header.fields:
+            offset = struct.calcsize(fmt)
+            if isinstance(field, BitFields):
+                shift = struct.calcsize(field.fmt) * 8
+                merged = []
+                for name, bits, kind in field.parts:
+                    shift -= bits
+                    if name is None:
+                        continue
+                    layout[name] = (offset, struct.calcsize(field.fmt), shift)
+                    decode.append((name, self.WRAP[kind].format('v[{}] >> {} & {}'.format(index, shift, (1 << bits) - 1))))
+                    merged.append("info['{}'] << {}".format(name, shift) if shift else "info['{}']".format(name))
+                encode.append(' | '.join(merged) or '0')
+                fmt += field.fmt
+                index += 1
+            elif field.name is None:
+                encode.append('0')
+                fmt += field.fmt
+                index += 1
+            elif field.kind == 'timestamp':
+                decode.append((field.name, 'Timestamp(v[{}] << 32 | v[{}], tsresol)'.format(index, index + 1)))
+                encode.append("ticks_{0} >> 32 & 0xFFFFFFFF, ticks_{0} & 0xFFFFFFFF".format(index))
+                fmt += 'LL'
+                index += 2
+            else:
+                layout[field.name] = (offset, struct.calcsize(byte_order + field.fmt), 0)
+                decode.append((field.name, self.WRAP[field.kind].format('v[{}]'.format(index))))
+                if field.kind in ('bytes', 'list'):
+                    encode.append("bytes(info['{}'])".format(field.name))
+                else:
+                    encode.append("info['{}']".format(field.name))
+                fmt += field.fmt
+                index += 1
+
+        prologue = ["    ticks_{} = datetime_to_ticks(info['{}'], tsresol)".format(i, x.name)
+                    for i, x in self.__timestamp_fields(header)]
+
+        source = '\n'.join([
+            'def decode_into(v, info, tsresol=None):',
+            *("    info['{}'] = {}".format(name, value) for name, value in decode),
+            '',
+            'def read_into(reader, info, tsresol=None):',
+            '    decode_into(reader.read_struct(S), info, tsresol)',
+            '',
+            'def read(reader, tsresol=None):',
+            '    v = reader.read_struct(S)',
+            '    record = Record()',
+            *('    record.{} = {}'.format(name, value) for name, value in decode),
+            '    return record',
+            '',
+            'def encode(info, tsresol=None):',
+            *prologue,
+            '    return ({},)'.format(', '.join(encode)),
+            '',
+            'def pack(writer, info, tsresol=None):',
+            *prologue,
+            '    writer.pack_struct(S, {})'.format(', '.join(encode)),
+        ])
+
+        self.header = header
+        self.struct = struct.Struct(fmt)
+        self.size = self.struct.size
+        # name -> (byte offset, size of the containing field, bit shift inside it), timestamps are not listed
+        self.layout = layout
+
+        namespace = {
+            'S': self.struct,
+            'HexInt': HexInt,
+            'DecimalBytes': DecimalBytes,
+            'Record': header.record,
+            'Timestamp': Timestamp,
+            'datetime_to_ticks': datetime_to_ticks,
+        }
+        exec(compile(source, '<{} codec>'.format(header.name), 'exec'), namespace)
+
+        self.decode_into = namespace['decode_into']
+        self.read_into = namespace['read_into']
+        self.read = namespace['read']
+        self.encode = namespace['encode']
+        self.pack = namespace['pack']
+
+    @staticmethod
+    def __timestamp_fields(header):
+        index = 0
+        for field in header.fields:
+            if isinstance(field, Field) and field.kind == 'timestamp':
+                yield index, field
+                index += 2
+            else:
+                index += 1
+
+
+class OptionTable:
+
+    def __init__(self, options):
+        # options are (code, name, kind), kind names a codec method of the block reader/writer
+        self.by_code = {code: (name, kind) for code, name, kind in options}
+        self.by_name = {name: (code, kind) for code, name, kind in options}
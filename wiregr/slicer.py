@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This Source Code Form is subject to the terms of the
+# Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
+# with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import io
+import mmap
+
+from wiregr.common import *
+from wiregr.compression import input_codec
+from wiregr.blocks import *
+from wiregr.block_index import scan_pcapng, scan_yaml, datetime_to_ns
+
+
+class Slicer(BaseWorker):
+
+    def __init__(self, input_file, output_file, time_from=None, time_to=None, packets=None, packet_filter=None):
+        # checked before the output is opened, so no empty output is left behind
+        if is_binary_blocks_file(input_file) or is_binary_blocks_output(output_file, None, False):
+            raise ValueError('slice copies pcapng and yaml blocks, binary blocks have to be converted first')
+        if input_file not in (None, '-') and input_codec(input_file) is not None:
+            raise ValueError('slice needs random access, the input file cannot be compressed')
+        self.__is_binary_input = is_pcapng_file(input_file)
+        self.__is_binary_output = is_pcapng_output(output_file, self.__is_binary_input)
+
+        super().__init__(input_file, self.__is_binary_input,
+                         output_file, '.pcapng' if self.__is_binary_output else '.yaml', self.__is_binary_output,
+                         use_mmap=self.__is_binary_input, lazy=True)
+
+        self.__time_from = datetime_to_ns(time_from) if time_from is not None else None
+        self.__time_to = datetime_to_ns(time_to) if time_to is not None else None
+        self.__first_packet, self.__last_packet = packets if packets is not None else (0, None)
+        self.__packet_filter = packet_filter
+        # blocks go through the reader only to be filtered or converted
+        self.__decode = packet_filter is not None or self.__is_binary_input != self.__is_binary_output
+
+    def process(self):
+        # blocks are selected by their type, length and timestamp, and copied as they are when the output
+        # has the same format as the input, packets are decoded only when they are checked by a filter
+        if self._mmap is not None:
+            # pcapng input is already mapped for the reader
+            self.__slice(self._mmap)
+            return
+
+        try:
+            buffer = mmap.mmap(self._input_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except io.UnsupportedOperation:
+            raise ValueError('slice needs random access, the input cannot be a compressed stream')
+        except ValueError:
+            return # empty file, nothing to slice
+
+        with buffer:
+            self.__slice(buffer)
+
+    def __slice(self, buffer):
+        if self.__is_binary_input:
+            blocks = scan_pcapng(buffer)
+        else:
+            blocks = scan_yaml(iter(buffer.readline, b''))
+
+        for offset, length, info in self.__select(blocks):
+            if self.__is_binary_input != self.__is_binary_output:
+                self._writer.write(info)
+            elif self.__is_binary_output:
+                self._output_file.write(buffer[offset:offset + length])
+            else:
+                text = buffer[offset:offset + length].decode('utf-8')
+                self._output_file.write(text + '\n' if text.endswith('\n') else text + '\n\n')
+
+    def __read(self, offset):
+        if not self.__decode:
+            return None
+        self._reader.seek(offset)
+        return self._reader.read_block()
+
+    def __select(self, blocks):
+        # section and interface blocks are held back until the first packet of their section is taken,
+        # interface ids are numbered per section, so all interfaces of the section are kept. They are
+        # read as they come, so the reader knows the interfaces of the packets it decodes later.
+        # Packet numbers count all packets of the input, filtered out ones included.
+        first_context = None
+        context = []
+        taken = False
+        packet = -1
+
+        for offset, block_type, length, interface, timestamp in blocks:
+            if block_type == BLOCK_TYPE_SHB:
+                context = [(offset, length, self.__read(offset))]
+                taken = False
+                if first_context is None:
+                    first_context = context
+                continue
+
+            if block_type == BLOCK_TYPE_IDB:
+                if taken:
+                    yield offset, length, self.__read(offset)
+                else:
+                    context.append((offset, length, self.__read(offset)))
+                continue
+
+            if block_type != BLOCK_TYPE_EPB:
+                continue
+
+            packet += 1
+            if self.__last_packet is not None and packet >= self.__last_packet:
+                break
+            if packet < self.__first_packet:
+                continue
+            if self.__time_from is not None and timestamp < self.__time_from:
+                continue
+            if self.__time_to is not None and timestamp >= self.__time_to:
+                continue
+
+            info = self.__read(offset)
+            if self.__packet_filter is not None and not self.__packet_filter.match(info):
+                continue
+
+            if not taken:
+                yield from context
+                taken = True
+                first_context = None
+            yield offset, length, info
+
+        if first_context is not None:
+            # nothing matched, keep the output a valid capture
+            yield from first_context
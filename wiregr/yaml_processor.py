@@ -5,28 +5,387 @@
 # Mozilla Public License, v. 2.0. If a copy of the MPL was not distributed
 # with this file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import collections
 import datetime
+import io
+import itertools
+import mmap
+import multiprocessing
+import os
+import queue
+import re
 import yaml
 import struct
 import sys
-import io
 from collections import OrderedDict
 
+from . import common
 from .common import *
+from .blocks import *
+from .checksum import *
 from .packets import *
 
+# canonical yaml of an ipv4 packet as it is emitted, other layouts are parsed to find their flow
+YAML_FLOW = re.compile(rb'^ipv4_data:\n(?:  .*\n)*?  protocol: (\d+)\n(?:  .*\n)*?'
+                       rb'  source: \[(.*)\]\n  destination: \[(.*)\]\n'
+                       rb'(?:(?:tcp|udp)_data:\n  source_port: (\d+)\n  destination_port: (\d+)\n)?', re.M)
+
+ETHERNET_TYPE_OFFSET = ETHERNET_HEADER.layout['type'][0]
+IPV4_OFFSET = ETHERNET_HEADER.size
+TRANSPORT_OFFSET = IPV4_OFFSET + IPV4_HEADER.size # the decoder reads ipv4 headers without options
+TRANSPORT_SIZES = {
+    PROTOCOL_TCP: TCP_HEADER.size,
+    PROTOCOL_UDP: UDP_HEADER.size,
+}
+
+
+def flow_key(protocol, source, source_port, destination, destination_port):
+    # normalized 5-tuple packed into an int, both directions of a connection give the same key
+    one = source << 16 | source_port
+    two = destination << 16 | destination_port
+    if one > two:
+        one, two = two, one
+    return protocol << 96 | one << 48 | two
+
+
+def packet_flow_key(info):
+    # None for blocks that are not ipv4 packets
+    if isinstance(info, PacketView):
+        data = info.data
+        if info.link_type != LINKTYPE_ETHERNET or len(data) < TRANSPORT_OFFSET:
+            return None
+        if data[ETHERNET_TYPE_OFFSET] << 8 | data[ETHERNET_TYPE_OFFSET + 1] != TYPE_IPV4:
+            return None
+
+        protocol = data[IPV4_OFFSET + IPV4_HEADER.layout['protocol'][0]]
+        source_port = destination_port = 0
+        if len(data) >= TRANSPORT_OFFSET + TRANSPORT_SIZES.get(protocol, len(data)):
+            source_port = data[TRANSPORT_OFFSET] << 8 | data[TRANSPORT_OFFSET + 1]
+            destination_port = data[TRANSPORT_OFFSET + 2] << 8 | data[TRANSPORT_OFFSET + 3]
+        source = IPV4_OFFSET + IPV4_HEADER.layout['source'][0]
+        destination = IPV4_OFFSET + IPV4_HEADER.layout['destination'][0]
+        return flow_key(protocol,
+                        int.from_bytes(data[source:source + 4], 'big'), source_port,
+                        int.from_bytes(data[destination:destination + 4], 'big'), destination_port)
+
+    if 'ipv4_data' not in info:
+        return None
+
+    ipv4_data = info['ipv4_data']
+    source_port = destination_port = 0
+    for name in PROTOCOL_LAYERS.values():
+        if name in info:
+            source_port = info[name]['source_port']
+            destination_port = info[name]['destination_port']
+    return flow_key(ipv4_data['protocol'],
+                    int.from_bytes(bytes(ipv4_data['source']), 'big'), source_port,
+                    int.from_bytes(bytes(ipv4_data['destination']), 'big'), destination_port)
+
+
+def yaml_flow_key(text):
+    match = YAML_FLOW.search(text)
+    if match is None:
+        if b'ipv4_data' not in text:
+            return None
+        info = YamlReader(io.StringIO(text.decode('utf-8'))).read_block()
+        return packet_flow_key(info) if info is not None else None
+
+    protocol, source, destination, source_port, destination_port = match.groups()
+    return flow_key(int(protocol),
+                    int.from_bytes(bytes(int(x, 0) for x in source.split(b',')), 'big'), int(source_port or 0),
+                    int.from_bytes(bytes(int(x, 0) for x in destination.split(b',')), 'big'), int(destination_port or 0))
+
+
+def run_processors(processors, batch):
+    # every processor sees the blocks in order, so running them processor by processor is
+    # equivalent to running them block by block
+    for processor in processors:
+        if hasattr(processor, 'process_batch'):
+            processor.process_batch(batch)
+        else:
+            for info in batch:
+                processor.process(info)
+
+
+def finish_processors(processors):
+    for processor in processors:
+        if hasattr(processor, 'finish'):
+            processor.finish()
+
+
+def _shard_worker(requests, results, processors, is_binary_input, is_binary_output,
+                  payload_format, filter_expression, yaml_backend):
+    # runs the processors on the blocks of one shard, the section and interface blocks are sent to
+    # every shard so the reader and the writer follow the sections, but only the first shard outputs them
+    try:
+        set_yaml_backend(yaml_backend)
+        packet_filter = None
+        if filter_expression is not None:
+            from wiregr.filters import PacketFilter
+            packet_filter = PacketFilter(filter_expression)
+
+        stream = io.BytesIO() if is_binary_output else io.StringIO()
+        if is_binary_output:
+            from wiregr.pcap_writer import PcapBlockWriter
+            writer = PcapBlockWriter(stream)
+        else:
+            writer = YamlWriter(stream, payload_format)
+
+        while True:
+            request = requests.get()
+            if request is None:
+                break
+
+            context, context_blocks, data, owned = request
+            if is_binary_input:
+                from wiregr.pcap_reader import PcapBlockReader
+                reader = PcapBlockReader(BufferReader(context + data), lazy=True)
+            else:
+                reader = YamlReader(io.StringIO(data.decode('utf-8')))
+            for _ in range(context_blocks):
+                reader.read_block()
+
+            infos = []
+            for flag in owned:
+                info = reader.read_block()
+                if flag and packet_filter is not None and not packet_filter.match(info):
+                    info = None
+                infos.append(info)
+            run_processors(processors, [x for x, flag in zip(infos, owned) if flag and x is not None])
+
+            lengths = []
+            for info, flag in zip(infos, owned):
+                start = stream.tell()
+                if info is not None:
+                    writer.write(info)
+                if flag:
+                    lengths.append(stream.tell() - start)
+                else:
+                    stream.seek(start)
+                    stream.truncate()
+
+            results.put((stream.getvalue(), lengths))
+            stream.seek(0)
+            stream.truncate()
+
+        finish_processors(processors)
+        writer.close()
+    except BaseException as ex:
+        results.put(ex)
+
 
 class YamlProcessor(BaseWorker):
 
-    def __init__(self, input_file, output_file, processors):
-        super().__init__(input_file, False, output_file, '.yaml', False)
+    BATCH_SIZE = 256
+    # blocks sharded at once in parallel runs
+    SHARD_ROUND_SIZE = 4096
+
+    def __init__(self, input_file, output_file, processors, payload_format=None, use_mmap=False,
+                 packet_filter=None, jobs=1, output_format=None):
+        self.__is_binary_input = is_pcapng_file(input_file)
+        self.__is_binary_output = is_pcapng_output(output_file, self.__is_binary_input)
+
+        super().__init__(input_file, self.__is_binary_input,
+                         output_file, '.pcapng' if self.__is_binary_output else '.yaml', self.__is_binary_output,
+                         payload_format, use_mmap, lazy=True, output_format=output_format)
         self.__processors = processors
+        self.__payload_format = payload_format
+        self.__packet_filter = packet_filter
+        self.__jobs = jobs
 
     def process(self):
+        # shards are cut from pcapng or yaml input and merged as pcapng or yaml output
+        binary_blocks = self._is_binary_blocks_input or self._is_binary_blocks_output
+        if self.__jobs > 1 and not binary_blocks and self.__process_parallel():
+            return
+
+        batch = []
         for info in self._reader.read():
-            for processor in self.__processors:
-                processor.process(info)
+            # filtered out packets are not seen by any processor, move-timeline starts at the first kept one
+            if self.__packet_filter is not None and not self.__packet_filter.match(info):
+                continue
+            batch.append(info)
+            if len(batch) == self.BATCH_SIZE:
+                self.__process_batch(batch)
+        self.__process_batch(batch)
+        finish_processors(self.__processors)
+
+    def __process_batch(self, batch):
+        run_processors(self.__processors, batch)
+
+        for info in batch:
             self._writer.write(info)
+        batch.clear()
+
+    def __process_parallel(self):
+        # Packets are sharded to worker processes by their flow, so a worker sees whole connections
+        # and keeps the flow state of its processors, other blocks are spread over the workers.
+        # The blocks are sent in rounds and the outputs of a round are merged back in input order.
+        try:
+            buffer = mmap.mmap(self._input_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError, io.UnsupportedOperation):
+            return False # not a regular file, processed serially
+
+        with buffer:
+            self.__resolve_origins(self.__scan(buffer))
+
+            # packets of pcapng input are keyed by a lazy reader that only follows the section blocks
+            key_buffer = key_reader = None
+            if self.__is_binary_input:
+                from wiregr.pcap_reader import PcapBlockReader
+                key_buffer = BufferReader(buffer)
+                key_reader = PcapBlockReader(key_buffer, lazy=True)
+
+            filter_expression = self.__packet_filter.expression if self.__packet_filter is not None else None
+            workers = []
+            for _ in range(self.__jobs):
+                requests = multiprocessing.Queue()
+                results = multiprocessing.Queue()
+                process = multiprocessing.Process(target=_shard_worker, args=(
+                    requests, results, self.__processors, self.__is_binary_input, self.__is_binary_output,
+                    self.__payload_format, filter_expression, common.yaml_backend), daemon=True)
+                process.start()
+                workers.append((process, requests, results))
+
+            completed = False
+            try:
+                blocks = self.__scan(buffer)
+                pending = None
+                section = []
+                while True:
+                    round_blocks = list(itertools.islice(blocks, self.SHARD_ROUND_SIZE))
+                    if not round_blocks:
+                        break
+                    shards, section = self.__send_round(buffer, round_blocks, section, key_reader, workers)
+                    # the next round is already queued while this one is merged
+                    if pending is not None:
+                        self.__merge_round(pending, workers)
+                    pending = shards
+                if pending is not None:
+                    self.__merge_round(pending, workers)
+                completed = True
+            finally:
+                for process, requests, _ in workers:
+                    if completed:
+                        requests.put(None)
+                        process.join()
+                    else:
+                        process.terminate() # unread results would block joining it
+                if key_buffer is not None:
+                    key_buffer.buffer.release()
+
+        return True
+
+    def __scan(self, buffer):
+        from wiregr.block_index import scan_pcapng, scan_yaml
+
+        if self.__is_binary_input:
+            return scan_pcapng(buffer)
+        buffer.seek(0) # yaml is scanned by lines from the current position of the map
+        return scan_yaml(iter(buffer.readline, b''))
+
+    def __resolve_origins(self, blocks):
+        # processors depending on the first packet, like MoveTimeline, get it before the blocks are sharded
+        processors = [x for x in self.__processors if hasattr(x, 'set_origin')]
+        if not processors:
+            return
+
+        for offset, block_type, _, _, _ in blocks:
+            if block_type not in (BLOCK_TYPE_SHB, BLOCK_TYPE_IDB, BLOCK_TYPE_ISB, BLOCK_TYPE_EPB):
+                continue
+
+            self._reader.seek(offset)
+            info = self._reader.read_block()
+            if block_type == BLOCK_TYPE_ISB or block_type == BLOCK_TYPE_EPB and (
+                    self.__packet_filter is None or self.__packet_filter.match(info)):
+                for processor in processors:
+                    processor.set_origin(info)
+                return
+
+    def __send_round(self, buffer, blocks, section, key_reader, workers):
+        # returns the shard of every block of the round and the section context after it
+        jobs = len(workers)
+        # yaml blocks do not depend on each other, pcapng readers replay the section blocks first
+        context = b''
+        context_blocks = 0
+        if self.__is_binary_input:
+            context = b''.join(buffer[offset:offset + length] for offset, length in section)
+            context_blocks = len(section)
+        datas = [[] for _ in range(jobs)]
+        owned = [[] for _ in range(jobs)]
+        shards = []
+
+        for number, (offset, block_type, length, _, _) in enumerate(blocks):
+            data = buffer[offset:offset + length]
+            if not self.__is_binary_input:
+                data += b'\n' if data.endswith(b'\n') else b'\n\n'
+
+            if block_type == BLOCK_TYPE_SHB or block_type == BLOCK_TYPE_IDB:
+                section = [(offset, length)] if block_type == BLOCK_TYPE_SHB else section + [(offset, length)]
+                if key_reader is not None:
+                    key_reader.seek(offset)
+                    key_reader.read_block()
+                for shard in range(jobs):
+                    datas[shard].append(data)
+                    owned[shard].append(shard == 0)
+                shards.append(0)
+                continue
+
+            key = None
+            if block_type == BLOCK_TYPE_EPB and key_reader is not None:
+                key_reader.seek(offset)
+                key = packet_flow_key(key_reader.read_block())
+            elif block_type == BLOCK_TYPE_EPB:
+                key = yaml_flow_key(data)
+            shard = (number if key is None else hash(key)) % jobs
+            datas[shard].append(data)
+            owned[shard].append(True)
+            shards.append(shard)
+
+        for shard, (_, requests, _) in enumerate(workers):
+            requests.put((context, context_blocks, b''.join(datas[shard]), owned[shard]))
+        return shards, section
+
+    def __merge_round(self, shards, workers):
+        outputs = []
+        for process, _, results in workers:
+            while True:
+                try:
+                    result = results.get(timeout=1)
+                    break
+                except queue.Empty:
+                    if not process.is_alive():
+                        raise RuntimeError('worker process exited with code {}'.format(process.exitcode))
+            if isinstance(result, BaseException):
+                raise result
+            outputs.append([result[0], 0, iter(result[1])])
+
+        for shard in shards:
+            output = outputs[shard]
+            length = next(output[2])
+            self._output_file.write(output[0][output[1]:output[1] + length])
+            output[1] += length
+
+
+class FieldChanges:
+
+    def __init__(self):
+        self.__blocks = {}
+
+    def record(self, info, layer, name, old, new):
+        if old == new:
+            return
+
+        changes = self.__blocks.setdefault(id(info), [])
+        if changes is not None:
+            changes.append((layer, name, old, new))
+
+    def invalidate(self, info):
+        self.__blocks[id(info)] = None
+
+    def pop(self, info):
+        # None means the block has to be checksummed from scratch
+        return self.__blocks.pop(id(info), [])
 
 
 class CleanMac:
@@ -44,21 +403,40 @@ class CleanMac:
 class MoveTimeline:
 
     def __init__(self, start_time):
-        self.__start_time = start_time
-        self.__timespan = None
+        self.__start_time = Timestamp.from_value(start_time)
+        self.__origin = None
+        self.__shifts = {}
 
     def process(self, info):
         if info['block_type'] != 0x5 and info['block_type'] != 0x6:
             return
 
-        if self.__timespan is None:
-            self.__timespan = info['datetime'] - self.__start_time
+        if self.__origin is None:
+            self.set_origin(info)
+
+        value = info['datetime']
+        if isinstance(value, Timestamp):
+            info['datetime'] = Timestamp(value.ticks - self.__shift(value.tsresol), value.tsresol)
+        else:
+            info['datetime'] = Timestamp(datetime_to_ticks(value, MICROSECONDS) - self.__shift(MICROSECONDS)).to_datetime()
 
-        info['datetime'] = info['datetime'] - self.__timespan
+    def set_origin(self, info):
+        # the first timed block, resolved up front when the blocks are processed in parallel
+        self.__origin = Timestamp.from_value(info['datetime'])
+        self.__shifts.clear()
+
+    def __shift(self, tsresol):
+        # the move in ticks of each resolution met, exact as long as it matches the origin resolution
+        if tsresol not in self.__shifts:
+            self.__shifts[tsresol] = self.__origin.to_ticks(tsresol) - self.__start_time.to_ticks(tsresol)
+        return self.__shifts[tsresol]
 
 
 class FixLengths:
 
+    def __init__(self, changes=None):
+        self.__changes = changes
+
     def process(self, info):
 
         if info['block_type'] != 0x6:
@@ -67,102 +445,274 @@ class FixLengths:
         total_length = 0
 
         if 'unknown_payload' in info:
-            phw = StructWriter(io.BytesIO())
-            phw.pack_payload(info['unknown_payload'])
-            total_length += phw.stream.tell()
+            total_length += payload_length(info['unknown_payload'])
 
         if 'udp_data' in info:
             udp_data = info['udp_data']
-
-            phw = StructWriter(io.BytesIO())
-            udp_header_pack(phw, udp_data)
-
-            udp_data['length'] = phw.stream.tell() + total_length
-            total_length += phw.stream.tell()
+            self.__update(info, udp_data, 'length', udp_header_length(udp_data) + total_length)
+            total_length += udp_header_length(udp_data)
 
         if 'tcp_data' in info:
             tcp_data = info['tcp_data']
-
-            phw = StructWriter(io.BytesIO())
-            tcp_header_pack(phw, tcp_data)
-
-            tcp_data['header_length'] = phw.stream.tell() // 4
-            total_length += phw.stream.tell()
+            self.__update(info, tcp_data, 'header_length', tcp_header_length(tcp_data) // 4)
+            total_length += tcp_header_length(tcp_data)
 
         if 'ipv4_data' in info:
             ipv4_data = info['ipv4_data']
-
-            phw = StructWriter(io.BytesIO())
-            ipv4_header_pack(phw, ipv4_data)
-
-            ipv4_data['total_length'] = phw.stream.tell() + total_length
-            total_length += phw.stream.tell()
+            self.__update(info, ipv4_data, 'total_length', ipv4_header_length(ipv4_data) + total_length)
+            total_length += ipv4_header_length(ipv4_data)
 
         if 'ethernet_data' in info:
-            ethernet_data = info['ethernet_data']
-
-            phw = StructWriter(io.BytesIO())
-            ethernet_header_pack(phw, ethernet_data)
-
-            total_length += phw.stream.tell()
+            total_length += ethernet_header_length(info['ethernet_data'])
 
         if info['captured_length'] == info['packet_length']:
             info['packet_length'] = total_length
         info['captured_length'] = total_length
 
-
-class FixChecksums:
-
-    def process(self, info):
-
-        if info['block_type'] != 0x6:
+    def __update(self, info, data, key, value):
+        if data[key] == value:
             return
 
-        if 'ipv4_data' in info:
-            ipv4_data = info['ipv4_data']
-            ipv4_data['header_checksum'] = 0
+        data[key] = value
+        if self.__changes is not None:
+            # lengths also feed the pseudo header, leave them to a full recompute
+            self.__changes.invalidate(info)
 
-            phw = StructWriter(io.BytesIO())
-            ipv4_header_pack(phw, ipv4_data)
-            ipv4_data['header_checksum'] = HexInt(calc_carry_add_checksum(phw.stream))
 
-        if 'udp_data' in info:
-            udp_data = info['udp_data']
-            udp_data['checksum'] = 0
+class FixChecksums:
 
-            phw = StructWriter(io.BytesIO())
-            if 'ipv4_data' in info:
-                phw.pack_bytes(ipv4_data['source'])
-                phw.pack_bytes(ipv4_data['destination'])
-                phw.pack_fmt('>H', ipv4_data['protocol'])
-                phw.pack_fmt('>H', ipv4_data['total_length'] - 4 * ipv4_data['header_length'])
+    PSEUDO_HEADER = struct.Struct('>4s4sHH')
+    TRANSPORTS = (
+        ('udp_data', udp_header_pack),
+        ('tcp_data', tcp_header_pack),
+    )
+    HEADERS = {
+        'ipv4_data': (IPV4_HEADER, 'header_checksum'),
+        'udp_data': (UDP_HEADER, 'checksum'),
+        'tcp_data': (TCP_HEADER, 'checksum'),
+    }
+    PSEUDO_HEADER_FIELDS = ('source', 'destination', 'protocol')
+    LENGTH_FIELDS = ('header_length', 'total_length', 'length')
+
+    def __init__(self, changes=None):
+        # with a change log only the recorded field changes are applied to the existing checksums
+        self.__writer = BufferWriter()
+        self.__changes = changes
 
-            udp_header_pack(phw, udp_data)
-            phw.pack_payload(info['unknown_payload'])
+    def process(self, info):
+        self.process_batch([info])
 
-            udp_data['checksum'] = HexInt(calc_carry_add_checksum(phw.stream))
+    def process_batch(self, infos):
+        self.__writer.reset()
+        targets = []
+        bounds = []
 
-        if 'tcp_data' in info:
-            tcp_data = info['tcp_data']
-            tcp_data['checksum'] = 0
+        for info in infos:
+            if info['block_type'] != 0x6:
+                continue
+
+            if self.__changes is not None and self.__adjust(info, self.__changes.pop(info)):
+                continue
 
-            phw = StructWriter(io.BytesIO())
             if 'ipv4_data' in info:
-                phw.pack_bytes(ipv4_data['source'])
-                phw.pack_bytes(ipv4_data['destination'])
-                phw.pack_fmt('>H', ipv4_data['protocol'])
-                phw.pack_fmt('>H', ipv4_data['total_length'] - 4 * ipv4_data['header_length'])
+                ipv4_data = info['ipv4_data']
+                ipv4_data['header_checksum'] = 0
+
+                start = self.__begin()
+                ipv4_header_pack(self.__writer, ipv4_data)
+                targets.append((ipv4_data, 'header_checksum'))
+                bounds.append((start, self.__writer.tell()))
+
+            for name, header_pack in self.TRANSPORTS:
+                if name not in info:
+                    continue
+
+                data = info[name]
+                data['checksum'] = 0
+
+                start = self.__begin()
+                self.__pack_pseudo_header(info)
+                header_pack(self.__writer, data)
+                if 'unknown_payload' in info:
+                    self.__writer.pack_payload(info['unknown_payload'])
+                targets.append((data, 'checksum'))
+                bounds.append((start, self.__writer.tell()))
+
+        if not bounds:
+            return
 
-            tcp_header_pack(phw, tcp_data)
-            if 'unknown_payload' in info:
-                phw.pack_payload(info['unknown_payload'])
+        with self.__writer.getbuffer() as buffer:
+            checksums = calc_internet_checksums(buffer, bounds)
+
+        for (data, key), checksum in zip(targets, checksums):
+            data[key] = HexInt(checksum)
+
+    def __adjust(self, info, changes):
+        if changes is None:
+            return False
+
+        deltas = {}
+        for layer, name, old, new in changes:
+            if layer not in self.HEADERS:
+                continue
+
+            header, checksum_name = self.HEADERS[layer]
+            if name not in header.layout or name in self.LENGTH_FIELDS or name == checksum_name:
+                return False
+
+            offset, size, shift = header.layout[name]
+            targets = [layer]
+            if layer == 'ipv4_data' and name in self.PSEUDO_HEADER_FIELDS:
+                targets.extend(x for x, _ in self.TRANSPORTS if x in info)
+
+            for target in targets:
+                delta = deltas.setdefault(target, [0, 0])
+                delta[0] += word_contribution(self.__field_value(old) << shift, offset + size)
+                delta[1] += word_contribution(self.__field_value(new) << shift, offset + size)
+
+        for layer, (removed, added) in deltas.items():
+            data = info[layer]
+            checksum_name = self.HEADERS[layer][1]
+            if layer == 'udp_data' and data[checksum_name] == 0:
+                continue # checksum is not used
+            data[checksum_name] = HexInt(adjust_checksum(data[checksum_name], removed, added))
+
+        return True
+
+    @staticmethod
+    def __field_value(value):
+        if isinstance(value, int):
+            return value
+        return int.from_bytes(bytes(value), 'big')
+
+    def __begin(self):
+        # every checksummed segment starts on a word boundary
+        if self.__writer.tell() & 1:
+            self.__writer.pack_bytes(b'\x00')
+        return self.__writer.tell()
+
+    def __pack_pseudo_header(self, info):
+        if 'ipv4_data' in info:
+            ipv4_data = info['ipv4_data']
+            self.__writer.pack_struct(self.PSEUDO_HEADER,
+                                      bytes(ipv4_data['source']),
+                                      bytes(ipv4_data['destination']),
+                                      ipv4_data['protocol'],
+                                      ipv4_data['total_length'] - 4 * ipv4_data['header_length'])
+
+TCP_FIN = 0x001
+TCP_SYN = 0x002
+TCP_RST = 0x004
+TCP_ACK = 0x010
+
+
+class TcpFlow:
+
+    __slots__ = ('seq_nums', 'last_seen', 'fins', 'closed')
+
+    def reset(self, seq_num, ack_num, direction, last_seen):
+        # seq_nums holds the next sequence number of both directions, indexed by the direction
+        self.seq_nums = [ack_num, seq_num] if direction else [seq_num, ack_num]
+        self.last_seen = last_seen
+        self.fins = 0 # bit per direction that sent a FIN
+        self.closed = False
+        return self
+
+
+class FlowTable:
+
+    # Flows in least recently seen order. Flows idle for longer than idle_timeout of capture time
+    # and the least recently seen flows over max_flows are evicted, evicted records are reused.
+    # Closed flows still correct late retransmissions, they are kept apart and only the last
+    # CLOSED_FLOWS of them are remembered.
+
+    FREE_RECORDS = 1024
+    CLOSED_FLOWS = 1 << 16
+
+    def __init__(self, idle_timeout=None, max_flows=None):
+        self.idle_timeout = idle_timeout
+        self.max_flows = max_flows
+        self.evicted = 0
+        self.expired = 0
+        self.reused = 0
+        self.__flows = OrderedDict()
+        self.__closed = OrderedDict()
+        self.__free = []
+
+    @property
+    def active(self):
+        return len(self.__flows)
+
+    def stats(self):
+        return {'active': self.active, 'closed': len(self.__closed),
+                'evicted': self.evicted, 'expired': self.expired, 'reused': self.reused}
+
+    def get(self, key, now):
+        self.__expire(now)
+        flow = self.__flows.get(key)
+        if flow is not None:
+            self.__flows.move_to_end(key)
+        else:
+            flow = self.__closed.get(key)
+            if flow is None:
+                return None
+            self.__closed.move_to_end(key)
+        flow.last_seen = now
+        return flow
+
+    def add(self, key, seq_num, ack_num, direction, now):
+        if self.__free:
+            flow = self.__free.pop()
+            self.reused += 1
+        else:
+            flow = TcpFlow()
+        self.__flows[key] = flow.reset(seq_num, ack_num, direction, now)
+
+        if self.max_flows is not None:
+            while len(self.__flows) > self.max_flows:
+                self.__release(self.__flows.popitem(last=False)[1])
+                self.evicted += 1
+        return flow
+
+    def close(self, key):
+        flow = self.__flows.pop(key)
+        flow.closed = True
+        self.__closed[key] = flow
+        if len(self.__closed) > self.CLOSED_FLOWS:
+            self.__release(self.__closed.popitem(last=False)[1])
+            self.expired += 1
+
+    def reopen(self, key):
+        # the connection is opened again with the same ports, the earlier corrections still apply
+        flow = self.__closed.pop(key)
+        flow.closed = False
+        flow.fins = 0
+        self.__flows[key] = flow
+
+    def __expire(self, now):
+        # capture time is expected to grow, so the least recently seen flow is also the oldest one
+        if self.idle_timeout is None:
+            return
+        limit = now - self.idle_timeout
+        while self.__flows and next(iter(self.__flows.values())).last_seen < limit:
+            self.__release(self.__flows.popitem(last=False)[1])
+            self.evicted += 1
+
+    def __release(self, flow):
+        if len(self.__free) < self.FREE_RECORDS:
+            self.__free.append(flow)
 
-            tcp_data['checksum'] = HexInt(calc_carry_add_checksum(phw.stream))
 
 class FixTcpStreams:
 
-    def __init__(self):
-        self.__streams = {}
+    # a stream seen again after it is evicted is started anew and loses the corrections of its earlier
+    # payload edits, so open streams are kept unless a timeout or a limit is asked for
+    IDLE_TIMEOUT = None
+    MAX_FLOWS = None
+
+    def __init__(self, changes=None, idle_timeout=IDLE_TIMEOUT, max_flows=MAX_FLOWS):
+        self.flows = FlowTable(idle_timeout, max_flows)
+        self.__changes = changes
 
     def process(self, info):
 
@@ -175,34 +725,47 @@ class FixTcpStreams:
                              - 4 * ipv4_data['header_length']\
                              - 4 * tcp_data['header_length']
 
-        stream, direction = self.__get_stream(ipv4_data, tcp_data)
-        tcp_data['seq_num'] = stream[direction]
-        tcp_data['ack_num'] = stream[not direction]
-        stream[direction] += tcp_segment_length
-
-    def __get_stream(self, ipv4_data, tcp_data):
-        one = '.'.join(str(x) for x in ipv4_data['source']) + ':' + str(tcp_data['source_port'])
-        two = '.'.join(str(x) for x in ipv4_data['destination']) + ':' + str(tcp_data['destination_port'])
-        direction = one < two
-        key = one + '_' + two if direction else two + '_' + one
-
-        if key in self.__streams:
-            stream = self.__streams[key]
-        else:
-            stream = {
-                direction: tcp_data['seq_num'],
-                not direction: tcp_data['ack_num']
-            }
-            self.__streams[key] = stream
-
-        if tcp_data['flags'] & 0x002:
-            if tcp_data['flags'] & 0x010:
-                stream[direction] = tcp_data['seq_num']
+        # endpoints packed as address << 16 | port, the key is the lower one followed by the higher one
+        one = int.from_bytes(bytes(ipv4_data['source']), 'big') << 16 | tcp_data['source_port']
+        two = int.from_bytes(bytes(ipv4_data['destination']), 'big') << 16 | tcp_data['destination_port']
+        direction = int(one < two)
+        key = one << 48 | two if direction else two << 48 | one
+
+        flags = tcp_data['flags']
+        seq_num = tcp_data['seq_num']
+        flow = self.flows.get(key, info['datetime'])
+        if flow is None:
+            flow = self.flows.add(key, seq_num, tcp_data['ack_num'], direction, info['datetime'])
+        elif flow.closed and flags & TCP_SYN and not flags & TCP_ACK:
+            self.flows.reopen(key)
+
+        seq_nums = flow.seq_nums
+        if flags & TCP_SYN:
+            if flags & TCP_ACK:
+                seq_nums[direction] = seq_num
             else:
-                stream[not direction] = 0
+                seq_nums[not direction] = 0
 
-            self.__streams[key] = { k: v for k, v in stream.items() }
-            self.__streams[key][direction] = tcp_data['seq_num'] + 1
+        if self.__changes is not None:
+            self.__changes.record(info, 'tcp_data', 'seq_num', seq_num, seq_nums[direction])
+            self.__changes.record(info, 'tcp_data', 'ack_num', tcp_data['ack_num'], seq_nums[not direction])
+        tcp_data['seq_num'] = seq_nums[direction]
+        tcp_data['ack_num'] = seq_nums[not direction]
 
-        return stream, direction
+        if flags & TCP_SYN:
+            seq_nums[direction] = seq_num + 1
+        else:
+            seq_nums[direction] += tcp_segment_length
 
+        if flow.closed:
+            return
+        # a reset closes the flow at once, a finished one with the acknowledgement after both FINs
+        if flags & TCP_RST or flow.fins == 3 and not flags & TCP_FIN:
+            self.flows.close(key)
+        elif flags & TCP_FIN:
+            flow.fins |= 1 << direction
+
+    def finish(self):
+        if self.flows.evicted:
+            print('Evicted tcp streams', self.flows.evicted, '(their later packets start from raw seq/ack numbers)',
+                  file=sys.stderr)